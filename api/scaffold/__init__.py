@@ -18,17 +18,28 @@
 
 
 from enum import Enum
-import serial
+from collections import deque
+import math
+import json
+import threading
 from binascii import hexlify
+from time import perf_counter
+from .transport import open_transport
 
 
 class TimeoutError(Exception):
     """ Thrown when a polling read or write command timed out. """
-    def __init__(self, data=None, size=None):
+    def __init__(
+            self, data=None, size=None, address=None, offset=0, expected=None):
         """
         :param data: The received data until timeout. None if timeout occured
         during a write operation.
         :param size: The number of successfully proceeded bytes.
+        :param address: Address of the register accessed by the failing
+            command, if known.
+        :param offset: Position in the read or written data of the first byte
+            of the failing command.
+        :param expected: Number of bytes of the failing command.
         """
         self.data = data
         if self.data is not None:
@@ -36,19 +47,65 @@ class TimeoutError(Exception):
             self.size = len(data)
         else:
             self.size = size
+        self.address = address
+        self.offset = offset
+        self.expected = expected
+        # When many operations of a lazy section failed, list of all the
+        # errors.
+        self.errors = [self]
 
     def __str__(self):
         s = "Timeout."
         if self.data is not None:
             if len(self.data):
                 h = hexlify(self.data).decode()
-                return (
+                s = (
                     f'Read timeout: partially received {len(self.data)} '
                     f'bytes {h}.')
             else:
-                return 'Read timeout: no data received.'
+                s = 'Read timeout: no data received.'
+        else:
+            s = f'Write timeout. Only {self.size} bytes written.'
+        if self.address is not None:
+            s += (
+                f' Register 0x{self.address:04x}, command of {self.expected} '
+                f'bytes at offset {self.offset}.')
+        if len(self.errors) > 1:
+            s += f' {len(self.errors)} operations timed out.'
+        return s
+
+
+class BusStallError(Exception):
+    """
+    Thrown when the board does not respond before the host deadline: the bus
+    bridge or the serial link is unresponsive. This differs from
+    :class:`TimeoutError`, which reports a polling timeout measured by the
+    board itself. The operations which were in flight are lost.
+    """
+    def __init__(self, received=0, expected=0, resynced=None):
+        """
+        :param received: Number of bytes received before the deadline.
+        :param expected: Number of bytes expected.
+        :param resynced: True if the bus answered the resynchronization probe
+            run after the stall and can be used again, False if it did not.
+            None if the error has been raised for an operation aborted by the
+            stall of another thread.
+        """
+        self.received = received
+        self.expected = expected
+        self.resynced = resynced
+
+    def __str__(self):
+        if self.resynced is None:
+            return 'Bus stalled: operation aborted.'
+        s = (
+            f'Bus stalled: received {self.received} of {self.expected} '
+            'bytes before the deadline.')
+        if self.resynced:
+            s += ' Bus resynchronized.'
         else:
-            return f'Write timeout. Only {self.size} bytes written.'
+            s += ' Bus not responding.'
+        return s
 
 
 class Signal:
@@ -111,6 +168,10 @@ class Module:
     """
     Class to facilitate signals and registers declaration.
     """
+    # Settings of the module saved in profiles, mapped to their Enum type, or
+    # to None for plain values. See Scaffold.get_profile.
+    _PROFILE = {}
+
     def __init__(self, parent, path=None):
         """
         :param parent: The Scaffold instance owning the object.
@@ -118,6 +179,7 @@ class Module:
         """
         self.__parent = parent
         self.__path = path
+        self.__regs = None
 
     def add_signal(self, name):
         """
@@ -153,13 +215,10 @@ class Module:
         self.__dict__[attr_name] = Register(self.__parent, *args, **kwargs)
 
     def __setattr__(self, key, value):
-        if key in self.__dict__:
-            item = self.__dict__[key]
-            if isinstance(item, Register):
-                item.set(value)
-                return
-            else:
-                super().__setattr__(key, value)
+        item = self.__dict__.get(key)
+        if type(item) is Register:
+            item.set(value)
+            return
         super().__setattr__(key, value)
 
     @property
@@ -167,15 +226,182 @@ class Module:
         """ Scaffold instance the module belongs to. Read-only. """
         return self.__parent
 
+    @property
+    def regs(self):
+        """
+        :class:`RegisterMap` giving fast access to the registers of the
+        module, without the checks of :class:`Register`. For instance
+        ``pgen.regs.delay = n`` writes the delay register. Created on first
+        access. Read-only.
+        """
+        if self.__regs is None:
+            self.__regs = RegisterMap.create(self)
+        return self.__regs
+
+    def _get_state(self):
+        """
+        :return: dict of the settings of the module known by the host which
+            are not register values, such as a target baudrate. Saved by
+            :meth:`Scaffold.get_state`. Values must be JSON serializable.
+        """
+        return {}
+
+    def _set_state(self, state):
+        """
+        Restore settings returned by :meth:`_get_state`, without accessing the
+        board.
+
+        :param state: dict returned by :meth:`_get_state`.
+        """
+        pass
+
+    def _get_profile(self):
+        """
+        :return: dict of the settings listed in _PROFILE, for
+            :meth:`Scaffold.get_profile`. Enum values are given by name.
+            Settings unknown by the host are omitted.
+        """
+        profile = {}
+        for name, enum in self._PROFILE.items():
+            try:
+                value = getattr(self, name)
+            except RuntimeError:
+                continue
+            if value is not None:
+                profile[name] = value if enum is None else value.name
+        return profile
+
+    def _check_profile(self, profile):
+        """
+        Validate settings of a profile, without accessing the board.
+
+        :param profile: dict of settings, as returned by :meth:`_get_profile`.
+        :return: dict of settings, with Enum names converted to values.
+        :raises ValueError: if a setting is unknown or invalid.
+        """
+        result = {}
+        for name, value in profile.items():
+            if name not in self._PROFILE:
+                raise ValueError(f'Unknown setting \'{name}\'')
+            enum = self._PROFILE[name]
+            if (enum is not None) and isinstance(value, str):
+                if value not in enum.__members__:
+                    raise ValueError(f'Invalid value \'{value}\' for {name}')
+                value = enum[value]
+            result[name] = value
+        return result
+
+    def _apply_profile(self, profile):
+        """
+        Apply settings returned by :meth:`_check_profile`. Settings equal to
+        the value known by the host are skipped.
+
+        :param profile: dict of settings.
+        """
+        for name, value in profile.items():
+            try:
+                if getattr(self, name) == value:
+                    continue
+            except RuntimeError:
+                pass
+            setattr(self, name, value)
+
+
+class RegisterMap:
+    """
+    Base class of the register accessors of the modules, see
+    :attr:`Module.regs`. For each register layout, a class is generated with
+    one property per register, named after the register without the 'reg\\_'
+    prefix. The addresses and wideness are constants of the generated code,
+    and the instances have no __dict__.
+
+    Writes queue the command directly in the bus and update the cache of the
+    :class:`Register`. The value is not checked against the minimum and
+    maximum values of the register, write elision does not apply and writes
+    are not deferred by transactions. Reading a register returns its cache
+    when it is not volatile, as :meth:`Register.get` does.
+    """
+    __slots__ = ('_bus',)
+
+    # Generated classes, by register layout.
+    __classes = {}
+
+    def __init__(self, bus):
+        """
+        :param bus: :class:`ScaffoldBus` instance.
+        """
+        self._bus = bus
+
+    @classmethod
+    def create(cls, module):
+        """
+        :return: Accessor for the registers of a module, instance of a class
+            generated for the layout of its registers.
+        :param module: :class:`Module` instance.
+        """
+        registers = list((name[4:], register)
+            for name, register in vars(module).items()
+            if type(register) is Register)
+        layout = (type(module).__name__,) + tuple(
+            (name, r.address, r.wideness, r.readable, r.writable, r.volatile)
+            for name, r in registers)
+        map_class = cls.__classes.get(layout)
+        if map_class is None:
+            map_class = cls.__classes[layout] = cls.__generate(layout)
+        regs = map_class(module.parent.bus)
+        for name, register in registers:
+            setattr(regs, '_r_' + name, register)
+        return regs
+
+    @classmethod
+    def __generate(cls, layout):
+        """
+        :return: New subclass of :class:`RegisterMap` for a register layout.
+        :param layout: Tuple starting with the module class name, followed by
+            (name, address, wideness, readable, writable, volatile) tuples.
+        """
+        class_name = layout[0] + 'Registers'
+        slots = tuple('_r_' + entry[0] for entry in layout[1:])
+        lines = [
+            f'class {class_name}(RegisterMap):',
+            f'    __slots__ = {slots!r}']
+        for name, address, wideness, readable, writable, volatile \
+                in layout[1:]:
+            reg = 'self._r_' + name
+            lines += [
+                f'    def _get_{name}(self):',
+                f'        return {reg}.get()']
+            setter = 'None'
+            if writable:
+                setter = f'_set_{name}'
+                # The cache is only updated once the value has been converted
+                # and the write queued.
+                lines += [
+                    f'    def _set_{name}(self, value):',
+                    f'        data = value.to_bytes({wideness}, \'big\')',
+                    f'        self._bus._queue_write({address:#06x}, '
+                    f'{wideness}, data)',
+                    f'        {reg}._store(value)']
+            lines += [
+                f'    {name} = property(_get_{name}, {setter})']
+        namespace = {'RegisterMap': RegisterMap}
+        exec('\n'.join(lines), namespace)
+        return namespace[class_name]
+
 
 class Register:
     """
     Manages accesses to a register of a module. Implements value cache
     mechanism whenever possible.
     """
+    __slots__ = (
+        '__parent', '__address', '__w', '__r', '__volatile', '__wideness',
+        '__min_value', '__max_value', '__cache', '__no_elide',
+        'host_authoritative')
+
     def __init__(
             self, parent, mode, address, wideness=1, min_value=None,
-            max_value=None):
+            max_value=None, no_elide=False):
         """
         :param parent: The Scaffold instance owning the register.
         :param address: 16-bits address of the register.
@@ -189,6 +415,9 @@ class Register:
             0 by default.
         :param max_value: Maximum allowed value. If None, maximum value will be
             2^(wideness*8)-1 by default.
+        :param no_elide: True for strobe or command registers, which trigger
+            an action each time they are written: the writes are never
+            elided nor deferred by transactions.
         """
         self.__parent = parent
 
@@ -230,6 +459,10 @@ class Register:
                 'value')
 
         self.__cache = None
+        self.__no_elide = no_elide
+        # When True, the value of a volatile register is only changed by the
+        # host: it is then cached as if the register was not volatile.
+        self.host_authoritative = False
 
     def set(self, value, poll=None, poll_mask=0xff, poll_value=0x00):
         """
@@ -242,6 +475,14 @@ class Register:
             required.
         :param poll_mask: Register polling mask.
         :param poll_value: Register polling value.
+
+        Writes without polling to a register which is not volatile, or host
+        authoritative, are deferred in a transaction (see
+        :meth:`ScaffoldBus.transaction`), and skipped when the value is
+        already cached and :attr:`ScaffoldBus.write_elision` is enabled. This
+        does not apply to the registers created with no_elide, nor while a
+        program is recorded (see :meth:`ScaffoldBus.record_program`). All the
+        writes are deferred in a dry run transaction.
         """
         if value < self.__min_value:
             raise ValueError('Value too low')
@@ -249,22 +490,45 @@ class Register:
             raise ValueError('Value too high')
         if not self.__w:
             raise RuntimeError('Register cannot be written')
+        bus = self.__parent.bus
+        transaction = bus.current_transaction
+        if (poll is None) and (not self.__no_elide) and \
+                (not bus.recording) and \
+                ((not self.__volatile) or self.host_authoritative):
+            if transaction is not None:
+                transaction._defer(self, self.__cache)
+                self.__cache = value
+                return
+            if bus.write_elision and (value == self.__cache):
+                return
+        elif (transaction is not None) and transaction.dry_run:
+            transaction._defer(self, self.__cache)
+            self.__cache = value
+            return
         # Handle wideness
         value_bytes = value.to_bytes(self.__wideness, 'big', signed=False)
-        self.__parent.bus.write(self.__address, value_bytes, poll, poll_mask,
-            poll_value)
+        bus.write(self.__address, value_bytes, poll, poll_mask, poll_value)
         # Save as int
         self.__cache = value
 
+    def _flush(self):
+        """
+        Write the cached value to the board. Called when a transaction is
+        committed.
+        """
+        self.__parent.bus.write(self.__address,
+            self.__cache.to_bytes(self.__wideness, 'big', signed=False))
+
     def get(self):
         """
         :return: Current register value.
         If the register is not volatile and the value has been cached, no
         access to the board is performed and the cache is returned. If the
         register is not volatile but can't be read, the cached value is
-        returned or an exception is raised if cache is not set.
+        returned or an exception is raised if cache is not set. Host
+        authoritative registers are handled as if not volatile.
         """
-        if self.__volatile:
+        if self.__volatile and not self.host_authoritative:
             if not self.__r:
                 raise RuntimeError('Register cannot be read')
             return self.__parent.bus.read(self.__address)[0]
@@ -278,6 +542,61 @@ class Register:
                     raise RuntimeError('Register cannot be read')
             return self.__cache
 
+    @property
+    def cache(self):
+        """
+        Value of the register known by the host, or None if unknown. Setting
+        this attribute does not access the board: this is used to restore the
+        state of a board configured by another process. The cache of volatile
+        registers is not used by :meth:`get`.
+        """
+        return self.__cache
+
+    @cache.setter
+    def cache(self, value):
+        if (value is not None) and not \
+                (self.__min_value <= value <= self.__max_value):
+            raise ValueError('Value out of range')
+        self.__cache = value
+
+    def _store(self, value):
+        """
+        Update the cache after a write issued without :meth:`set`, without
+        checking the value. Used by the generated :class:`RegisterMap`
+        accessors.
+
+        :param value: Written value.
+        """
+        self.__cache = value
+
+    @property
+    def wideness(self):
+        """ :return: Number of bytes stored by the register. """
+        return self.__wideness
+
+    @property
+    def volatile(self):
+        """ :return: True if the register is volatile. """
+        return self.__volatile
+
+    @property
+    def no_elide(self):
+        """
+        :return: True if the writes to the register are never elided nor
+            deferred by transactions.
+        """
+        return self.__no_elide
+
+    @property
+    def readable(self):
+        """ :return: True if the register can be read. """
+        return self.__r
+
+    @property
+    def writable(self):
+        """ :return: True if the register can be written. """
+        return self.__w
+
     def or_set(self, value):
         """
         Sets some bits to 1 in the register.
@@ -351,6 +670,40 @@ class Register:
         return self.__parent.bus.read(
             self.__address, size, poll, poll_mask, poll_value)
 
+    async def write_async(
+            self, data, poll=None, poll_mask=0xff, poll_value=0x00):
+        """ Coroutine version of :meth:`write`. """
+        if not self.__w:
+            raise RuntimeError('Register cannot be written')
+        await self.__parent.bus.write_async(
+            self.__address, data, poll, poll_mask, poll_value)
+
+    async def read_async(
+            self, size=1, poll=None, poll_mask=0xff, poll_value=0x00):
+        """ Coroutine version of :meth:`read`. """
+        if not self.__r:
+            raise RuntimeError('Register cannot be read')
+        return await self.__parent.bus.read_async(
+            self.__address, size, poll, poll_mask, poll_value)
+
+    def readinto(self, buf, poll=None, poll_mask=0xff, poll_value=0x00):
+        """
+        Raw read the register into a buffer, without intermediate copies. The
+        number of bytes read is the size of the buffer. This method raises a
+        RuntimeError if the register cannot be read.
+        :param buf: Writable contiguous buffer (bytearray, memoryview, NumPy
+            array...).
+        :param poll: Register instance or address. None if polling is not
+            required.
+        :param poll_mask: Register polling mask.
+        :param poll_value: Register polling value.
+        :return: Number of bytes read.
+        """
+        if not self.__r:
+            raise RuntimeError('Register cannot be read')
+        return self.__parent.bus.readinto(
+            self.__address, buf, poll, poll_mask, poll_value)
+
     @property
     def address(self):
         """ :return: Register address. """
@@ -426,6 +779,8 @@ class LED:
 
 class LEDs(Module):
     """ LEDs module of Scaffold. """
+    _PROFILE = {'brightness': None, 'disabled': None, 'override': None}
+
     def __init__(self, parent):
         """
         :param parent: The Scaffold instance owning the version module.
@@ -448,6 +803,50 @@ class LEDs(Module):
         self.reg_brightness.set(20)
         self.reg_mode.set(0)
 
+    def __leds(self):
+        """ :return: dict of the :class:`LED` instances, by name. """
+        return dict((name, led) for name, led in vars(self).items()
+            if isinstance(led, LED))
+
+    def _get_profile(self):
+        """
+        :return: Module settings, and the mode of each LED by name under the
+            'modes' key. See :meth:`Module._get_profile`.
+        """
+        profile = super()._get_profile()
+        if self.reg_mode.cache is not None:
+            profile['modes'] = dict((name, led.mode.name)
+                for name, led in self.__leds().items())
+        return profile
+
+    def _check_profile(self, profile):
+        """ See :meth:`Module._check_profile`. """
+        profile = dict(profile)
+        modes = profile.pop('modes', {})
+        result = super()._check_profile(profile)
+        leds = self.__leds()
+        checked = {}
+        for name, mode in modes.items():
+            if name not in leds:
+                raise ValueError(f'Unknown LED \'{name}\'')
+            if isinstance(mode, str):
+                if mode not in LEDMode.__members__:
+                    raise ValueError(f'Invalid LED mode \'{mode}\'')
+                mode = LEDMode[mode]
+            checked[name] = mode
+        if len(checked):
+            result['modes'] = checked
+        return result
+
+    def _apply_profile(self, profile):
+        """ See :meth:`Module._apply_profile`. """
+        profile = dict(profile)
+        modes = profile.pop('modes', {})
+        super()._apply_profile(profile)
+        leds = self.__leds()
+        for name, mode in modes.items():
+            leds[name].mode = mode
+
     @property
     def brightness(self):
         """
@@ -492,6 +891,7 @@ class UART(Module):
     """
     __REG_CONTROL_BIT_FLUSH = 0
     __REG_CONFIG_BIT_TRIGGER = 3
+    _PROFILE = {'baudrate': None}
 
     def __init__(self, parent, index):
         """
@@ -505,7 +905,7 @@ class UART(Module):
         # Declare the registers
         self.__addr_base = base = 0x0400 + 0x0010 * index
         self.add_register('status', 'rv', base)
-        self.add_register('control', 'w', base + 1)
+        self.add_register('control', 'w', base + 1, no_elide=True)
         self.add_register('config', 'w', base + 2)
         self.add_register('divisor', 'w', base + 3, wideness=2, min_value=1)
         self.add_register('data', 'rwv', base + 4)
@@ -561,6 +961,14 @@ class UART(Module):
         self.reg_divisor.set(d)
         self.__cache_baudrate = real
 
+    def _get_state(self):
+        """ :return: Target baudrate. See :meth:`Module._get_state`. """
+        return {'baudrate': self.__cache_baudrate}
+
+    def _set_state(self, state):
+        """ Restore target baudrate. See :meth:`Module._set_state`. """
+        self.__cache_baudrate = state.get('baudrate')
+
     def transmit(self, data, trigger=False):
         """
         Transmit data using the UART.
@@ -569,25 +977,47 @@ class UART(Module):
         :param trigger: True or 1 to enable trigger on last byte, False or 0 to
             disable trigger.
         """
-        if trigger:
-            buf = data[:-1]
-        else:
-            buf = data
-        # Polling on status.ready bit before sending each character.
+        if not trigger:
+            # Polling on status.ready bit before sending each character.
+            self.reg_data.write(
+                data, poll=self.reg_status, poll_mask=0x01, poll_value=0x01)
+            return
+        # The whole sequence is sent as a single batch to avoid paying the
+        # serial latency for each write. Bus flow control prevents the polling
+        # writes from overflowing the bridge input FIFO.
+        with self.parent.lazy_section():
+            self.__queue_transmit_trigger(data)
+
+    async def transmit_async(self, data, trigger=False):
+        """ Coroutine version of :meth:`transmit`. """
+        async with self.parent.lazy_section():
+            if trigger:
+                self.__queue_transmit_trigger(data)
+            else:
+                self.reg_data.write(
+                    data, poll=self.reg_status, poll_mask=0x01,
+                    poll_value=0x01)
+
+    def __queue_transmit_trigger(self, data):
+        """
+        Issue the register writes to transmit data with trigger on last byte.
+        Must be called in a lazy section.
+
+        :param data: Data to be transmitted. bytes or bytearray.
+        """
+        config = self.reg_config.get()
         self.reg_data.write(
-            buf, poll=self.reg_status, poll_mask=0x01, poll_value=0x01)
-        if trigger:
-            config = self.reg_config.get()
-            # Enable trigger as soon as previous transmission ends
-            self.reg_config.write(
-                config | (1 << self.__REG_CONFIG_BIT_TRIGGER),
-                poll=self.reg_status, poll_mask=0x01, poll_value=0x01)
-            # Send the last byte. No need for polling here, because it has
-            # already been done when enabling trigger.
-            self.reg_data.write(data[-1])
-            # Disable trigger
-            self.reg_config.write(
-                config, poll=self.reg_status, poll_mask=0x01, poll_value=0x01)
+            data[:-1], poll=self.reg_status, poll_mask=0x01, poll_value=0x01)
+        # Enable trigger as soon as previous transmission ends
+        self.reg_config.write(
+            config | (1 << self.__REG_CONFIG_BIT_TRIGGER),
+            poll=self.reg_status, poll_mask=0x01, poll_value=0x01)
+        # Send the last byte. No need for polling here, because it has
+        # already been done when enabling trigger.
+        self.reg_data.write(data[-1])
+        # Disable trigger
+        self.reg_config.write(
+            config, poll=self.reg_status, poll_mask=0x01, poll_value=0x01)
 
     def receive(self, n=1):
         """
@@ -597,9 +1027,27 @@ class UART(Module):
         return self.reg_data.read(
             n, poll=self.reg_status, poll_mask=0x04, poll_value=0x00)
 
+    async def receive_async(self, n=1):
+        """ Coroutine version of :meth:`receive`. """
+        return await self.reg_data.read_async(
+            n, poll=self.reg_status, poll_mask=0x04, poll_value=0x00)
+
+    def receive_into(self, buf):
+        """
+        Receive bytes from the UART directly into a buffer, until it is full.
+        This function blocks until all bytes have been received or the timeout
+        expires and a TimeoutError is thrown.
+
+        :param buf: Writable contiguous buffer (bytearray, memoryview, NumPy
+            array...).
+        :return: Number of received bytes.
+        """
+        return self.reg_data.readinto(
+            buf, poll=self.reg_status, poll_mask=0x04, poll_value=0x00)
+
     def flush(self):
         """ Discard all the received bytes in the FIFO. """
-        self.reg_control.set_bit(self.__REG_CONTROL_BIT_FLUSH, 1)
+        self.reg_control.write(1 << self.__REG_CONTROL_BIT_FLUSH)
 
 
 class PulseGenerator(Module):
@@ -607,6 +1055,8 @@ class PulseGenerator(Module):
     Pulse generator module of Scaffold.
     Usually abreviated as pgen.
     """
+    _PROFILE = {'delay': None, 'interval': None, 'width': None, 'count': None}
+
     def __init__(self, parent, index):
         """
         :param parent: The Scaffold instance owning the UART module.
@@ -694,6 +1144,7 @@ class PulseGenerator(Module):
 class Power(Module):
     """ Controls the platform and DUT sockets power supplies. """
     __ADDR_CONTROL = 0x0600
+    _PROFILE = {'dut': None, 'platform': None}
 
     def __init__(self, parent):
         """ :param parent: The Scaffold instance owning the power module. """
@@ -723,7 +1174,7 @@ class Power(Module):
 
     @platform.setter
     def platform(self, value):
-        self.reg_control.set_bit(1, value)
+        self.__set_bit(1, value)
 
     @property
     def dut(self):
@@ -732,7 +1183,34 @@ class Power(Module):
 
     @dut.setter
     def dut(self, value):
-        self.reg_control.set_bit(0, value)
+        self.__set_bit(0, value)
+
+    def __set_bit(self, index, value):
+        """
+        Set the state of one power supply. While a program is recorded, the
+        control register cannot be read: the other power supply keeps the last
+        state written by the host, or 0.
+
+        :param index: 0 for the DUT power supply, 1 for the platform one.
+        :param value: True, False, 0 or 1.
+        """
+        reg = self.reg_control
+        if self.parent.bus.recording:
+            current = reg.cache or 0
+            reg.set((current & ~(1 << index)) | (int(bool(value)) << index))
+        else:
+            reg.set_bit(index, value)
+
+    def _apply_profile(self, profile):
+        """
+        Set both power supplies with a single write, without reading the
+        control register first. A missing setting keeps the last value known
+        by the host, or 0. See :meth:`Module._apply_profile`.
+        """
+        current = self.reg_control.cache or 0
+        dut = profile.get('dut', current & 1)
+        platform = profile.get('platform', (current >> 1) & 1)
+        self.all = int(bool(dut)) | (int(bool(platform)) << 1)
 
 
 class ISO7816ParityMode(Enum):
@@ -755,6 +1233,10 @@ class ISO7816(Module):
     __REG_CONFIG_TRIGGER_RX = 1
     __REG_CONFIG_TRIGGER_LONG = 2
     __REG_CONFIG_PARITY_MODE = 3
+    _PROFILE = {
+        'clock_frequency': None, 'etu': None,
+        'parity_mode': ISO7816ParityMode, 'trigger_tx': None,
+        'trigger_rx': None, 'trigger_long': None}
 
     def __init__(self, parent):
         """
@@ -764,11 +1246,13 @@ class ISO7816(Module):
         self.add_signals('io_in', 'io_out', 'clk', 'trigger')
         self.__addr_base = base = 0x0500
         self.add_register('status', 'rv', base)
-        self.add_register('control', 'w', base + 1)
+        self.add_register('control', 'w', base + 1, no_elide=True)
         self.add_register('config', 'w', base + 2)
         self.add_register('divisor', 'w', base + 3)
         self.add_register('etu', 'w', base + 4, wideness=2)
         self.add_register('data', 'rwv', base + 5)
+        # Current target clock frequency (this is not the effective one)
+        self.__cache_clock_frequency = None
         # Accuracy parameter
         self.max_err = 0.01
 
@@ -816,6 +1300,14 @@ class ISO7816(Module):
         self.reg_divisor.set(d)
         self.__cache_clock_frequency = real
 
+    def _get_state(self):
+        """ :return: Clock frequency. See :meth:`Module._get_state`. """
+        return {'clock_frequency': self.__cache_clock_frequency}
+
+    def _set_state(self, state):
+        """ Restore clock frequency. See :meth:`Module._set_state`. """
+        self.__cache_clock_frequency = state.get('clock_frequency')
+
     @property
     def etu(self):
         """
@@ -845,6 +1337,26 @@ class ISO7816(Module):
             n, poll=self.reg_status,
             poll_mask=(1 << self.__REG_STATUS_BIT_EMPTY), poll_value=0x00)
 
+    async def receive_async(self, n=1):
+        """ Coroutine version of :meth:`receive`. """
+        return await self.reg_data.read_async(
+            n, poll=self.reg_status,
+            poll_mask=(1 << self.__REG_STATUS_BIT_EMPTY), poll_value=0x00)
+
+    def receive_into(self, buf):
+        """
+        Receive bytes directly into a buffer, until it is full. This function
+        blocks until all bytes have been received or the timeout expires and a
+        TimeoutError is thrown.
+
+        :param buf: Writable contiguous buffer (bytearray, memoryview, NumPy
+            array...).
+        :return: Number of received bytes.
+        """
+        return self.reg_data.readinto(
+            buf, poll=self.reg_status,
+            poll_mask=(1 << self.__REG_STATUS_BIT_EMPTY), poll_value=0x00)
+
     def transmit(self, data):
         """
         Transmit data.
@@ -858,6 +1370,13 @@ class ISO7816(Module):
             poll_mask=(1 << self.__REG_STATUS_BIT_READY),
             poll_value=(1 << self.__REG_STATUS_BIT_READY))
 
+    async def transmit_async(self, data):
+        """ Coroutine version of :meth:`transmit`. """
+        await self.reg_data.write_async(
+            data, poll=self.reg_status,
+            poll_mask=(1 << self.__REG_STATUS_BIT_READY),
+            poll_value=(1 << self.__REG_STATUS_BIT_READY))
+
     @property
     def empty(self):
         """ True if reception FIFO is empty. """
@@ -954,6 +1473,7 @@ class I2C(Module):
     __REG_CONFIG_BIT_TRIGGER_START = 0
     __REG_CONFIG_BIT_TRIGGER_END = 1
     __REG_CONFIG_BIT_CLOCK_STRETCHING = 2
+    _PROFILE = {'frequency': None, 'clock_stretching': None}
 
     def __init__(self, parent, index):
         """
@@ -967,7 +1487,7 @@ class I2C(Module):
         # Declare the registers
         self.__addr_base = base = 0x0700 + 0x0010 * index
         self.add_register('status', 'rv', base)
-        self.add_register('control', 'w', base + 1)
+        self.add_register('control', 'w', base + 1, no_elide=True)
         self.add_register('config', 'w', base + 2)
         self.add_register('divisor', 'w', base + 3, wideness=2, min_value=1)
         self.add_register('data', 'rwv', base + 4)
@@ -1013,60 +1533,129 @@ class I2C(Module):
         :type trigger: int or str.
         :raises I2CNackError: If a NACK is received during the transaction.
         """
+        return bytes(self.__transaction(data, read_size, trigger))
+
+    def __transaction(self, data, read_size, trigger, into=None):
+        """
+        Executes an I2C transaction. See :meth:`raw_transaction`.
+
+        :param into: If not None, a writable memoryview where the received
+            bytes are stored. Received bytes which do not fit in are
+            discarded.
+        :return: Received bytes as a bytearray, or the number of bytes stored
+            in into.
+        """
         # Verify trigger parameter before doing anything
-        t_start = False
-        t_end = False
-        if type(trigger) is int:
-            if trigger not in range(2):
-                raise ValueError('Invalid trigger parameter')
-            t_start = (trigger == 1)
-        elif type(trigger) is str:
-            t_start = ('a' in trigger)
-            t_end = ('b' in trigger)
-        else:
-            if trigger is not None:
-                raise ValueError('Invalid trigger parameter')
+        t_start, t_end = self.__parse_trigger(trigger)
         # We are going to update many registers. We start a lazy section to make
         # the update faster: all the acknoledgements of bus write operations are
         # checked at the end.
         with self.parent.lazy_section():
-            self.flush()
-            self.reg_size_h = read_size >> 8
-            self.reg_size_l = read_size & 0xff
-            # Preload the FIFO
-            self.reg_data.write(data)
-            # Configure trigger for this transaction
-            config_value = 0
-            if t_start:
-                config_value |= (1 << self.__REG_CONFIG_BIT_TRIGGER_START)
-            if t_end:
-                config_value |= (1 << self.__REG_CONFIG_BIT_TRIGGER_END)
-            # Write config with mask to avoid overwritting clock_stretching
-            # option bit
-            self.reg_config.set_mask(
-                config_value,
-                (1 << self.__REG_CONFIG_BIT_TRIGGER_START) |
-                (1 << self.__REG_CONFIG_BIT_TRIGGER_END) )
-            # Start the transaction
-            self.reg_control.write(1 << self.__REG_CONTROL_BIT_START)
+            st = self.__queue_transaction(data, read_size, t_start, t_end)
             # End of lazy section. Leaving the scope will automatically check
             # the responses of the Scaffold write operations.
-        # Wait until end of transaction and read NACK flag
-        st = self.reg_status.read(
-            poll=self.reg_status,
-            poll_mask=(1 << self.__REG_STATUS_BIT_READY),
-            poll_value=(1 << self.__REG_STATUS_BIT_READY))[0]
+        st = st[0]
         nacked = (st & (1 << self.__REG_STATUS_BIT_NACK)) != 0
-        # Fetch all the bytes which are stored in the FIFO.
+        # Fetch all the bytes which are stored in the FIFO. Without NACK, the
+        # read_size received bytes are fetched with a single read.
         fifo = bytearray()
+        count = 0
+        if (not nacked) and read_size:
+            if into is None:
+                fifo += self.reg_data.read(read_size)
+            else:
+                count = min(read_size, len(into))
+                self.reg_data.readinto(into[:count])
+                if count < read_size:
+                    self.reg_data.read(read_size - count)
         while (self.reg_status.get() & (1 << self.__REG_STATUS_BIT_DATA_AVAIL)):
-            fifo.append(self.reg_data.read()[0])
+            if into is None:
+                fifo.append(self.reg_data.read()[0])
+            elif count < len(into):
+                self.reg_data.readinto(into[count:count + 1])
+                count += 1
+            else:
+                self.reg_data.read()
         if nacked:
             # Get the number of bytes remaining.
             remaining = ((self.reg_size_h.get() << 8)
                 + self.reg_size_l.get())
             raise I2CNackError(len(data) - remaining - 1)
-        return bytes(fifo)
+        if into is None:
+            return fifo
+        return count
+
+    async def raw_transaction_async(self, data, read_size, trigger=None):
+        """ Coroutine version of :meth:`raw_transaction`. """
+        t_start, t_end = self.__parse_trigger(trigger)
+        async with self.parent.lazy_section():
+            st = self.__queue_transaction(data, read_size, t_start, t_end)
+        st = st[0]
+        nacked = (st & (1 << self.__REG_STATUS_BIT_NACK)) != 0
+        # Fetch all the bytes which are stored in the FIFO. Without NACK, the
+        # read_size received bytes are fetched with a single read.
+        fifo = bytearray()
+        if (not nacked) and read_size:
+            fifo += await self.reg_data.read_async(read_size)
+        while ((await self.reg_status.read_async())[0]
+                & (1 << self.__REG_STATUS_BIT_DATA_AVAIL)):
+            fifo += await self.reg_data.read_async()
+        if nacked:
+            # Get the number of bytes remaining.
+            remaining = (((await self.reg_size_h.read_async())[0] << 8)
+                + (await self.reg_size_l.read_async())[0])
+            raise I2CNackError(len(data) - remaining - 1)
+        return fifo
+
+    def __parse_trigger(self, trigger):
+        """
+        Verify the trigger parameter of a transaction.
+
+        :return: Tuple of booleans (t_start, t_end).
+        """
+        if type(trigger) is int:
+            if trigger not in range(2):
+                raise ValueError('Invalid trigger parameter')
+            return (trigger == 1, False)
+        elif type(trigger) is str:
+            return ('a' in trigger, 'b' in trigger)
+        else:
+            if trigger is not None:
+                raise ValueError('Invalid trigger parameter')
+            return (False, False)
+
+    def __queue_transaction(self, data, read_size, t_start, t_end):
+        """
+        Issue the register accesses starting a transaction and waiting for its
+        end. Must be called in a lazy section.
+
+        :return: Status register read result, available when leaving the lazy
+            section.
+        """
+        self.flush()
+        self.reg_size_h = read_size >> 8
+        self.reg_size_l = read_size & 0xff
+        # Preload the FIFO
+        self.reg_data.write(data)
+        # Configure trigger for this transaction
+        config_value = 0
+        if t_start:
+            config_value |= (1 << self.__REG_CONFIG_BIT_TRIGGER_START)
+        if t_end:
+            config_value |= (1 << self.__REG_CONFIG_BIT_TRIGGER_END)
+        # Write config with mask to avoid overwritting clock_stretching
+        # option bit
+        self.reg_config.set_mask(
+            config_value,
+            (1 << self.__REG_CONFIG_BIT_TRIGGER_START) |
+            (1 << self.__REG_CONFIG_BIT_TRIGGER_END) )
+        # Start the transaction
+        self.reg_control.write(1 << self.__REG_CONTROL_BIT_START)
+        # Wait until end of transaction and read NACK flag.
+        return self.reg_status.read(
+            poll=self.reg_status,
+            poll_mask=(1 << self.__REG_STATUS_BIT_READY),
+            poll_value=(1 << self.__REG_STATUS_BIT_READY))
 
     def __make_header(self, address, rw):
         """
@@ -1121,6 +1710,26 @@ class I2C(Module):
         data = self.__make_header(address, 1)
         return self.raw_transaction(data, size, trigger)
 
+    def read_into(self, buf, address=None, trigger=None):
+        """
+        Perform an I2C read transaction, storing the bytes from the slave
+        directly in a buffer. The number of bytes requested to the slave is the
+        size of the buffer.
+
+        :param buf: Writable contiguous buffer (bytearray, memoryview, NumPy
+            array...).
+        :param address: Slave device address. If None, self.address is used by
+            default. If defined and addressing mode is 7 bits, LSB must be 0
+            (this is the R/W bit). If defined and addressing mode is 10 bits,
+            bit 8 must be 0.
+        :type address: int or None
+        :return: Number of bytes received.
+        :raises I2CNackError: If a NACK is received during the transaction.
+        """
+        view = memoryview(buf).cast('B')
+        data = self.__make_header(address, 1)
+        return self.__transaction(data, len(view), trigger, view)
+
     def write(self, data, address=None, trigger=None):
         """
         Perform an I2C write transaction.
@@ -1135,6 +1744,16 @@ class I2C(Module):
         data = self.__make_header(address, 0) + data
         self.raw_transaction(data, 0, trigger)
 
+    async def read_async(self, size, address=None, trigger=None):
+        """ Coroutine version of :meth:`read`. """
+        data = self.__make_header(address, 1)
+        return await self.raw_transaction_async(data, size, trigger)
+
+    async def write_async(self, data, address=None, trigger=None):
+        """ Coroutine version of :meth:`write`. """
+        data = self.__make_header(address, 0) + data
+        await self.raw_transaction_async(data, 0, trigger)
+
     @property
     def clock_stretching(self):
         """
@@ -1171,10 +1790,18 @@ class I2C(Module):
             raise ValueError('Target frequency is too low.')
         if d < 1:
             raise ValueError('Target frequency is too high.')
-        real = self.parent.SYS_FREQ / (d + 1)
+        real = self.parent.SYS_FREQ / (4 * (d + 1))
         self.reg_divisor.set(d)
         self.__cache_frequency = real
 
+    def _get_state(self):
+        """ :return: Bus frequency. See :meth:`Module._get_state`. """
+        return {'frequency': self.__cache_frequency}
+
+    def _set_state(self, state):
+        """ Restore bus frequency. See :meth:`Module._set_state`. """
+        self.__cache_frequency = state.get('frequency')
+
 
 class IO(Signal):
     """
@@ -1268,77 +1895,1600 @@ class ScaffoldBusLazySection:
     def __exit__(self, type, value, traceback):
         self.bus.lazy_end()
 
+    async def __aenter__(self):
+        self.bus.lazy_start()
+
+    async def __aexit__(self, type, value, traceback):
+        await self.bus.lazy_end_async()
 
-class ScaffoldBus:
+
+class TimeoutScope:
     """
-    Low level methods to drive the Scaffold device.
+    Context manager returned by :meth:`Scaffold.timeout_scope`.
     """
-    MAX_CHUNK = 255
+    def __init__(self, scaffold, value):
+        self.scaffold = scaffold
+        self.value = value
 
-    def __init__(self):
-        self.ser = None
-        self.__lazy_writes = []
-        self.__lazy_stack = 0
+    def __enter__(self):
+        self.scaffold.push_timeout(self.value)
 
-    def connect(self, dev):
+    def __exit__(self, type, value, traceback):
+        self.scaffold.pop_timeout()
+
+
+class RoutingPlan:
+    """
+    Set of connections of the routing matrix, returned by
+    :meth:`Scaffold.routing_plan`. Connections are validated when added, and
+    :meth:`apply` writes only the ones which differ from the state of the
+    matrix known by the host (see :attr:`Scaffold.routes`), in a single
+    batch. When used with the python 'with' statement, the plan is applied
+    when leaving the block, unless an exception is raised. The known state is
+    cleared when connecting without resuming a saved state.
+    """
+    def __init__(self, scaffold, routes=None):
         """
-        Connect to Scaffold board using the given serial port.
-        :param dev: Serial port device path. For instance '/dev/ttyUSB0' on
-            linux, 'COM0' on Windows.
+        :param scaffold: :class:`Scaffold` instance.
+        :param routes: Optional dict of connections, mapping destinations to
+            sources. See :meth:`connect`.
         """
-        self.ser = serial.Serial(dev, baudrate=2000000)
+        self.scaffold = scaffold
+        # Resolved connections, by destination path. See Scaffold._route.
+        self.__routes = {}
+        if routes is not None:
+            for dest, src in routes.items():
+                self.connect(dest, src)
 
-    def prepare_datagram(
-            self, rw, addr, size, poll, poll_mask, poll_value):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.apply()
+
+    def connect(self, dest, src):
         """
-        Helper function to build the datagrams to be sent to the Scaffold
-        device. Also performs basic check on arguments.
-        :rw: 1 for a write command, 0 for a read command.
-        :addr: Register address.
-        :size: Size of the data to be sent or received. Maximum size is 255.
-        :param poll: Register instance or address. None if polling is not
-            required.
-        :poll_mask: Register polling mask.
-        :poll_value: Register polling value.
-        :return: A bytearray.
+        Add a connection to the plan.
+
+        :param dest: Destination :class:`Signal` or path, for instance
+            scaffold.d0 or '/io/d0'.
+        :param src: Source :class:`Signal`, path, 0, 1 or None for high
+            impedance.
+        :raises ValueError: if the signals cannot be connected, or if the
+            destination is already fed by another source in the plan.
         """
-        if rw not in range(2):
-            raise ValueError('Invalid rw argument')
-        if size not in range(1, self.MAX_CHUNK+1):
-            raise ValueError('Invalid size')
-        if addr not in range(0x10000):
-            raise ValueError('Invalid address')
-        if isinstance(poll, Register):
-            poll = poll.address
-        if (poll is not None) and (poll not in range(0x10000)):
-            raise ValueError('Invalid polling address')
-        command = rw
-        if size > 1:
-            command |= 2
-        if poll is not None:
-            command |= 4
-        datagram = bytearray()
-        datagram.append(command)
-        datagram.append(addr >> 8)
-        datagram.append(addr & 0xff)
-        if poll is not None:
-            datagram.append(poll >> 8)
-            datagram.append(poll & 0xff)
-            datagram.append(poll_mask)
-            datagram.append(poll_value)
-        if size > 1:
-            datagram.append(size)
-        return datagram
+        route = self.scaffold._route(dest, src)
+        previous = self.__routes.get(route[0])
+        if (previous is not None) and (previous[1] != route[1]):
+            raise ValueError(
+                f'\'{route[0]}\' is fed by both \'{previous[1]}\' and '
+                f'\'{route[1]}\'')
+        self.__routes[route[0]] = route
 
-    def write(
-            self, addr, data, poll=None, poll_mask=0xff, poll_value=0x00):
+    @property
+    def routes(self):
         """
-        Write data to a register.
-        :param addr: Register address.
-        :param data: Data to be written. Can be a byte, bytes or bytearray.
-        :param poll: Register instance or address. None if polling is not
-            required.
-        :param poll_mask: Register polling mask.
+        dict of the sources of the plan, by destination path. Read-only copy.
+        """
+        return dict((dest, route[1]) for dest, route in self.__routes.items())
+
+    def diff(self):
+        """
+        :return: dict of the connections of the plan which differ from the
+            state of the matrix known by the host, by destination path.
+            Connections which state is unknown are included.
+        """
+        current = self.scaffold.routes
+        return dict((dest, route[1]) for dest, route in self.__routes.items()
+            if current.get(dest) != route[1])
+
+    def apply(self, force=False):
+        """
+        Write the connections returned by :meth:`diff` in a single batch.
+
+        :param force: If True, write all the connections of the plan, even
+            the ones known to be already set. Used when the board may have
+            been modified without the host knowing it.
+        :return: Number of connections written.
+        """
+        changes = self.routes if force else self.diff()
+        with self.scaffold.lazy_section():
+            for dest in changes:
+                self.scaffold._set_route(*self.__routes[dest])
+        return len(changes)
+
+
+class ScaffoldTransaction:
+    """
+    Groups register writes. Returned by :meth:`ScaffoldBus.transaction`, to
+    be used with the python 'with' statement.
+
+    In the with block, the writes without polling to registers which are not
+    volatile, or host authoritative, only update the register caches. The
+    registers which value changed are written in a single batch before the
+    next bus operation which is not deferred, so that the operations of the
+    block are executed in order, and when leaving the block. The writes to
+    strobe or command registers (see :attr:`Register.no_elide`) are not
+    deferred. The other operations are executed as usual: reads return their
+    result.
+
+    If the block raises an exception, the deferred writes which have not
+    been sent are discarded, and the register caches and the host state of
+    the modules are restored. Nested transactions are merged with the
+    outermost one. Transactions are private to each thread.
+
+    A dry run transaction sends nothing to the board and is always rolled
+    back: all the register writes are deferred, and the other operations are
+    dropped, so their reads have no result. It is used to check values which
+    are only validated by setters, such as baudrates. A dry run is never
+    merged with an open transaction.
+    """
+    def __init__(self, bus, states=(), dry_run=False):
+        """
+        :param bus: :class:`ScaffoldBus` instance.
+        :param states: List of (get, set) functions saving and restoring host
+            state which is not held in registers, such as the settings of the
+            modules (see :meth:`Module._get_state`). Restored when the block
+            raises an exception.
+        :param dry_run: True for a dry run transaction.
+        """
+        self.bus = bus
+        self.dry_run = dry_run
+        # Cached value of the registers modified and not written yet, before
+        # the transaction, in modification order.
+        self.registers = {}
+        self.__states = states
+        # Values returned by the get functions of states, when entering the
+        # block or when the deferred writes were last sent.
+        self.__saved = None
+        self.__outer = None
+
+    def _defer(self, register, previous):
+        """
+        Called by :meth:`Register.set` when a write is deferred.
+
+        :param register: :class:`Register` instance.
+        :param previous: Cached value of the register before the write.
+        """
+        if register not in self.registers:
+            self.registers[register] = previous
+
+    def _send(self):
+        """
+        Write the registers which value changed. Called by the bus before an
+        operation which is not deferred, and when leaving the block. These
+        writes can no longer be rolled back.
+        """
+        registers = self.registers
+        self.registers = {}
+        bus = self.bus
+        bus.lazy_start()
+        try:
+            for register, previous in registers.items():
+                if register.no_elide or (register.cache != previous):
+                    register._flush()
+        finally:
+            bus.lazy_end()
+        self.__save()
+
+    def __save(self):
+        """ Save the host state to be restored on rollback. """
+        self.__saved = [get() for get, _ in self.__states]
+
+    def __enter__(self):
+        self.__outer = self.bus._start_transaction(self)
+        if self.__outer is self:
+            self.__save()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.__outer is not self:
+            return
+        self.bus._end_transaction(self)
+        if (type is None) and not self.dry_run:
+            self._send()
+            return
+        for register, previous in self.registers.items():
+            register.cache = previous
+        self.registers = {}
+        for (_, set_state), state in zip(self.__states, self.__saved):
+            set_state(state)
+
+
+class ScaffoldBusFuture:
+    """
+    Result of a read operation issued during a lazy-update section. The
+    response of the board is fetched when all the lazy sections are closed;
+    until then the result is not available.
+    """
+    def __init__(self, size, target=None):
+        """
+        :param size: Number of bytes expected for the read operation.
+        :param target: If not None, a writable memoryview of at least size
+            bytes where the received data is stored, instead of being
+            accumulated in a new bytearray.
+        """
+        self.__size = size
+        self.__target = target
+        self.__data = bytearray()
+        # Number of bytes stored in target
+        self.__count = 0
+        self.__error = None
+        self.__done = (size == 0)
+
+    @property
+    def size(self):
+        """ Number of bytes requested by the read operation. Read-only. """
+        return self.__size
+
+    @property
+    def done(self):
+        """ True when the response has been received. Read-only. """
+        return self.__done
+
+    def _feed(self, data, failed=None):
+        """
+        Append response data to the result. Called by :class:`ScaffoldBus`
+        when flushing a batch. If the read is split in many chunks, this method
+        is called once per chunk.
+
+        :param data: Received bytes.
+        :param failed: :class:`ScaffoldBusOperation` of the chunk if it timed
+            out, None otherwise.
+        """
+        if self.__error is not None:
+            # Previous chunk timed-out: the following chunks are meaningless.
+            return
+        if self.__target is not None:
+            n = len(data)
+            self.__target[self.__count:self.__count + n] = data
+            self._advance(n, failed)
+            return
+        self.__data += data
+        if failed is not None:
+            self.__error = self.__timeout_error(failed, self.__data)
+            self.__done = True
+        elif len(self.__data) == self.__size:
+            self.__done = True
+
+    def _advance(self, n, failed=None):
+        """
+        Account for bytes which have been directly received in the target
+        buffer.
+
+        :param n: Number of received bytes.
+        :param failed: :class:`ScaffoldBusOperation` of the chunk if it timed
+            out, None otherwise.
+        """
+        if self.__error is not None:
+            return
+        self.__count += n
+        if failed is not None:
+            self.__error = self.__timeout_error(
+                failed, bytearray(self.__target[:self.__count]))
+            self.__done = True
+        elif self.__count == self.__size:
+            self.__done = True
+
+    def _fail(self, error):
+        """
+        Terminate the read with an error. Called by :class:`ScaffoldBus` when
+        the operation is lost after a bus stall.
+
+        :param error: Exception raised by :meth:`result`.
+        """
+        if not self.__done:
+            self.__error = error
+            self.__done = True
+
+    def __timeout_error(self, op, data):
+        """
+        :return: TimeoutError for a read which timed out.
+        :param op: :class:`ScaffoldBusOperation` of the chunk which timed out.
+        :param data: All the data received for the read operation.
+        """
+        return TimeoutError(
+            data=data, address=op.addr, offset=op.offset, expected=op.size)
+
+    def result(self):
+        """
+        :return: Read data as a bytearray. If the data is received in a target
+            buffer, the number of received bytes is returned instead.
+        :raises RuntimeError: If the lazy section has not been closed yet.
+        :raises TimeoutError: If the read operation timed out.
+        """
+        if not self.__done:
+            raise RuntimeError(
+                'Read result not available: lazy section still open.')
+        if self.__error is not None:
+            raise self.__error
+        if self.__target is not None:
+            return self.__count
+        return self.__data
+
+    def __getitem__(self, key):
+        return self.result()[key]
+
+    def __len__(self):
+        return len(self.result())
+
+    def __bytes__(self):
+        return bytes(self.result())
+
+
+class ScaffoldBusOperation:
+    """
+    A command queued in the bus, waiting to be sent to the board. Write
+    commands carry their data, read commands carry the
+    :class:`ScaffoldBusFuture` receiving the response. Raw commands without
+    response, such as the timeout configuration command, have rw set to None
+    and their full datagram in data.
+    """
+    __slots__ = (
+        'rw', 'addr', 'size', 'poll', 'poll_mask', 'poll_value', 'data',
+        'future', 'offset', 'target')
+
+    def __init__(
+            self, rw, addr, size, poll, poll_mask, poll_value, data=None,
+            future=None, offset=0, target=None):
+        """
+        :param rw: 1 for a write command, 0 for a read command, None for a
+            raw command.
+        :param addr: Register address.
+        :param size: Number of bytes to be written or read.
+        :param poll: Register instance or address. None if polling is not
+            required.
+        :param poll_mask: Register polling mask.
+        :param poll_value: Register polling value.
+        :param data: Data to be written, for write commands.
+        :param future: :class:`ScaffoldBusFuture` for read commands.
+        :param offset: Position of the first byte of this command in the data
+            of the originating read or write call.
+        :param target: For read commands, writable memoryview of size bytes
+            where the data can be directly received. None if the data must be
+            passed to the future.
+        """
+        self.rw = rw
+        self.addr = addr
+        self.size = size
+        self.poll = poll
+        self.poll_mask = poll_mask
+        self.poll_value = poll_value
+        self.data = data
+        self.future = future
+        self.offset = offset
+        self.target = target
+
+    def timeout_error(self, ack, data=None):
+        """
+        :return: TimeoutError describing the failure of this command.
+        :param ack: Acknowledge byte returned by the board: number of bytes
+            successfully processed.
+        :param data: For read commands, the received bytes.
+        """
+        if self.rw:
+            return TimeoutError(
+                size=self.offset+ack, address=self.addr, offset=self.offset,
+                expected=self.size)
+        return TimeoutError(
+            data=bytearray(data), address=self.addr, offset=self.offset,
+            expected=self.size)
+
+    @property
+    def response_size(self):
+        """
+        Number of bytes returned by the board for this command: the ack byte,
+        preceded by the read data for read commands. Raw commands have no
+        response.
+        """
+        if self.rw is None:
+            return 0
+        if self.rw:
+            return 1
+        return self.size + 1
+
+
+class ScaffoldBusBatch:
+    """
+    Group of operations sent to the board with a single serial write. The
+    expected response is precomputed when the operations are added, so that
+    all the acknowledge bytes can be verified at once when the response is
+    received.
+    """
+    def __init__(self):
+        # List of ScaffoldBusOperation
+        self.ops = []
+        # Bytes sent to the board
+        self.datagrams = bytearray()
+        # Expected response. Read data is zero.
+        self.expected = bytearray()
+        # Mask of the acknowledge bytes in the response. Read data is masked
+        # out.
+        self.mask = bytearray()
+        # List of (op, position) tuples for read operations, where position is
+        # the offset of the read data in the response.
+        self.reads = []
+        # True if an operation may stall the bus bridge.
+        self.stalls = False
+        # Number of bytes transferred by polling operations.
+        self.polled = 0
+        # ScaffoldBusResponse in full-duplex mode.
+        self.pending = None
+        # Host deadline of the response in seconds, in full-duplex mode.
+        self.deadline = None
+
+    def add(self, op, datagram):
+        """
+        Append an operation to the batch.
+
+        :param op: :class:`ScaffoldBusOperation` instance.
+        :param datagram: Bytes to be sent for this operation.
+        """
+        self.ops.append(op)
+        self.datagrams += datagram
+        if op.rw is None:
+            return
+        if op.poll is not None:
+            self.polled += op.size
+        if op.rw == 0:
+            self.reads.append((op, len(self.expected)))
+            self.expected += bytes(op.size)
+            self.mask += bytes(op.size)
+        self.expected.append(op.size)
+        self.mask.append(0xff)
+
+    def dispatch(self, res):
+        """
+        Verify the response of the board, and pass the read data to the
+        futures of the read operations.
+
+        :param res: Received response.
+        :return: List of TimeoutError for the write operations which timed
+            out.
+        """
+        if self.check(res):
+            # All commands succeeded. Only read results must be dispatched.
+            for op, pos in self.reads:
+                op.future._feed(res[pos:pos + op.size])
+            return []
+        # Some commands timed out: find which ones.
+        errors = []
+        pos = 0
+        for op in self.ops:
+            if op.rw is None:
+                continue
+            ack = res[pos + op.response_size - 1]
+            if op.rw:
+                if ack != op.size:
+                    # Timeout error !
+                    assert op.poll is not None
+                    errors.append(op.timeout_error(ack))
+            else:
+                if ack != op.size:
+                    assert op.poll is not None
+                    op.future._feed(res[pos:pos + ack], op)
+                else:
+                    op.future._feed(res[pos:pos + op.size])
+            pos += op.response_size
+        return errors
+
+    def check(self, res):
+        """
+        :return: True if all the acknowledge bytes of a response are the
+            expected ones, meaning no operation timed out.
+        :param res: Received response.
+        """
+        if len(self.reads) == 0:
+            return res == self.expected
+        # Use big integers to compare all masked bytes at once.
+        mask = int.from_bytes(self.mask, 'big')
+        return (int.from_bytes(res, 'big') & mask) == \
+            int.from_bytes(self.expected, 'big')
+
+
+class ScaffoldBusProgram:
+    """
+    Sequence of bus operations captured once and replayed many times. The
+    datagrams are serialized in a single byte blob, and the expected response
+    is a template where the read data is masked out: each run is a single
+    serial write followed by a single serial read, verified with one
+    comparison.
+
+    Some bytes of the blob can be declared as parameter slots with
+    :meth:`add_slot`, and patched at each run. Programs are created with
+    :meth:`ScaffoldBus.record_program`.
+    """
+    def __init__(self, bus):
+        """
+        :param bus: :class:`ScaffoldBus` instance.
+        """
+        self.bus = bus
+        # Recorded ScaffoldBusOperation, with the position of their datagram
+        # in the blob.
+        self.ops = []
+        self.blob = bytearray()
+        self.expected = bytearray()
+        self.mask = bytearray()
+        # Integer versions of expected and mask, for fast verification
+        self.__expected_int = 0
+        self.__mask_int = 0
+        # Positions of the read data in the response, as (start, end)
+        self.__reads = []
+        # Slices of the blob sent with a single write, and of their
+        # responses, as (blob_start, blob_end, res_start, res_end). There is
+        # more than one segment only if the program may overflow the bridge
+        # input FIFO.
+        self.segments = []
+        # Slots positions in the blob, by name, as (start, end)
+        self.__slots = {}
+        # Registers written by the slots. Their value is unknown once the
+        # slots have been patched.
+        self.__slot_registers = []
+        # Number of bytes transferred by polling operations.
+        self.polled = 0
+        # Board timeout after a run, None if the program does not set it.
+        self.timeout = None
+        self.response = None
+
+    def __enter__(self):
+        self.bus._start_recording(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.bus._stop_recording(self, type is None)
+
+    def _compile(self, ops, datagrams):
+        """
+        Build the blob, the response template and the segments. Called by the
+        bus when the recording ends.
+
+        :param ops: List of :class:`ScaffoldBusOperation`.
+        :param datagrams: Bytes to be sent for each operation.
+        """
+        window = self.bus.credit_window
+        seg_blob = seg_res = 0
+        stalls = False
+        for op, datagram in zip(ops, datagrams):
+            op_stalls = self.bus.may_stall(op)
+            if (window is not None) and (op_stalls or stalls) and \
+                    (len(self.blob) - seg_blob + len(datagram) > window) and \
+                    (len(self.blob) > seg_blob):
+                self.segments.append(
+                    (seg_blob, len(self.blob), seg_res, len(self.expected)))
+                seg_blob = len(self.blob)
+                seg_res = len(self.expected)
+                stalls = False
+            stalls = stalls or op_stalls
+            self.ops.append((op, len(self.blob)))
+            self.blob += datagram
+            if op.rw is None:
+                continue
+            if op.poll is not None:
+                self.polled += op.size
+            if op.rw == 0:
+                self.__reads.append(
+                    (len(self.expected), len(self.expected) + op.size))
+                self.expected += bytes(op.size)
+                self.mask += bytes(op.size)
+            self.expected.append(op.size)
+            self.mask.append(0xff)
+        self.segments.append(
+            (seg_blob, len(self.blob), seg_res, len(self.expected)))
+        self.__expected_int = int.from_bytes(self.expected, 'big')
+        self.__mask_int = int.from_bytes(self.mask, 'big')
+
+    def add_slot(self, name, register, occurrence=0):
+        """
+        Declare the data of a recorded write to a register as a parameter
+        which can be changed at each run.
+
+        :param name: Slot name, used as keyword argument of :meth:`run`.
+        :param register: :class:`Register` instance or register address.
+        :param occurrence: Index of the write to the register in the program,
+            if it is written more than once.
+        :raises ValueError: If the write cannot be found.
+
+        When a :class:`Register` instance is given, its cache is cleared after
+        each run, since the value written by the slot is not tracked.
+        """
+        addr = register.address if isinstance(register, Register) \
+            else register
+        count = 0
+        for op, pos in self.ops:
+            if (op.rw == 1) and (op.addr == addr):
+                if count == occurrence:
+                    start = pos + len(self.bus.prepare_datagram(
+                        1, op.addr, op.size, op.poll, op.poll_mask,
+                        op.poll_value))
+                    self.__slots[name] = (start, start + op.size)
+                    if isinstance(register, Register):
+                        self.__slot_registers.append(register)
+                    return
+                count += 1
+        raise ValueError(f'No write to register 0x{addr:04x} in program')
+
+    def run(self, **values):
+        """
+        Patch the slots and execute the program.
+
+        :param values: Value of the slots, by name. int values are converted
+            to big-endian bytes of the size of the slot; bytes values must
+            have the size of the slot. Slots which are not given keep their
+            last value.
+        :return: List of the data of the recorded reads, in order.
+        :raises TimeoutError: If an operation timed out.
+        """
+        blob = self.blob
+        for name, value in values.items():
+            start, end = self.__slots[name]
+            if type(value) is int:
+                value = value.to_bytes(end - start, 'big')
+            elif len(value) != end - start:
+                raise ValueError(f'Invalid size for slot {name}')
+            blob[start:end] = value
+        res = self.response = self.bus._run_program(self)
+        for register in self.__slot_registers:
+            register.cache = None
+        if (int.from_bytes(res, 'big') & self.__mask_int) != \
+                self.__expected_int:
+            self.__raise_errors(res)
+        return [res[start:end] for start, end in self.__reads]
+
+    def __raise_errors(self, res):
+        """
+        Find the operations which timed out and raise the error of the first
+        one. Its errors attribute lists all the errors.
+
+        :param res: Response of the board.
+        """
+        errors = []
+        pos = 0
+        for op, _ in self.ops:
+            if op.rw is None:
+                continue
+            ack = res[pos + op.response_size - 1]
+            if ack != op.size:
+                errors.append(op.timeout_error(ack, res[pos:pos + ack]))
+            pos += op.response_size
+        errors[0].errors = errors
+        raise errors[0]
+
+
+class ScaffoldBusResponse:
+    """
+    Response expected by a :class:`ScaffoldBusReader` for sent commands.
+    """
+    def __init__(self, size):
+        """
+        :param size: Expected number of bytes.
+        """
+        self.size = size
+        self.data = None
+        self.__event = threading.Event()
+
+    def _set(self, data):
+        """
+        Called by the reader thread when the response is complete, or with
+        None when the response is aborted.
+        """
+        self.data = data
+        self.__event.set()
+
+    @property
+    def aborted(self):
+        """ True if the response will never be received. Read-only. """
+        return self.__event.is_set() and (self.data is None)
+
+    def wait(self, timeout=None):
+        """
+        Block until the response has been received.
+
+        :param timeout: Maximum waiting time in seconds, or None.
+        :return: Response bytes, or None if the timeout expired or the
+            response has been aborted.
+        """
+        self.__event.wait(timeout)
+        return self.data
+
+
+class ScaffoldBusReader(threading.Thread):
+    """
+    Background thread draining the serial port of a full-duplex
+    :class:`ScaffoldBus`. Received bytes are stored in a buffer and matched
+    in order to the expected responses of the sent commands.
+
+    :ivar error: Exception raised by the transport which stopped the thread,
+        for instance when the board is unplugged, or None.
+    """
+    def __init__(self, ser):
+        """
+        :param ser: Serial port instance.
+        """
+        super().__init__(daemon=True)
+        self.ser = ser
+        self.__cond = threading.Condition()
+        self.__buffer = bytearray()
+        self.__expected = deque()
+        self.__running = True
+        self.error = None
+
+    def expect(self, size):
+        """
+        Register a new expected response. Responses are expected in the same
+        order as the commands are sent.
+
+        :param size: Number of bytes of the response.
+        :return: :class:`ScaffoldBusResponse` instance.
+        """
+        response = ScaffoldBusResponse(size)
+        with self.__cond:
+            if not self.__running:
+                # The thread is stopped: the response will never come.
+                response._set(None)
+                return response
+            self.__expected.append(response)
+            self.__dispatch()
+        return response
+
+    def __dispatch(self):
+        """ Complete all the expected responses which have been received. """
+        buf = self.__buffer
+        while len(self.__expected) and (len(buf) >= self.__expected[0].size):
+            response = self.__expected.popleft()
+            response._set(bytes(buf[:response.size]))
+            del buf[:response.size]
+
+    def run(self):
+        while self.__running:
+            try:
+                data = self.ser.read(max(1, self.ser.in_waiting))
+            except Exception as e:
+                if not self.__running:
+                    break
+                # The transport is broken: abort the waiters, which would
+                # otherwise block forever when they have no deadline.
+                self.error = e
+                self.__abort()
+                raise
+            with self.__cond:
+                self.__buffer += data
+                self.__dispatch()
+
+    def __abort(self):
+        """
+        Mark the reader as stopped and abort the responses which have not
+        been received.
+        """
+        with self.__cond:
+            self.__running = False
+            while len(self.__expected):
+                self.__expected.popleft()._set(None)
+
+    def stop(self):
+        """
+        Stop the thread. The responses which have not been received are
+        aborted.
+        """
+        self.__running = False
+        self.ser.cancel_read()
+        self.join()
+        self.__abort()
+
+
+class ScaffoldBusAsyncReader:
+    """
+    Receives the responses of the board from an asyncio event loop, without
+    blocking it. The serial port file descriptor is watched by the loop, and
+    the received bytes are matched in order to the expected responses of the
+    sent batches. Only available on POSIX systems.
+    """
+    def __init__(self, ser, loop):
+        """
+        :param ser: Serial port instance.
+        :param loop: asyncio event loop.
+        """
+        self.ser = ser
+        self.loop = loop
+        self.__buffer = bytearray()
+        # Sent ScaffoldBusBatch awaiting for their responses
+        self.__expected = deque()
+        # Bytes sent and number of stalling batches in __expected
+        self.__sent = 0
+        self.__stalls = 0
+        loop.add_reader(ser.fileno(), self.__on_readable)
+
+    def close(self):
+        """ Stop watching the serial port. """
+        self.loop.remove_reader(self.ser.fileno())
+
+    def transmit(self, batch):
+        """
+        Send the datagrams of a batch. batch.pending is set to an asyncio
+        future, which result is the list of write errors of the batch.
+
+        :param batch: :class:`ScaffoldBusBatch` instance.
+        """
+        batch.pending = self.loop.create_future()
+        self.__expected.append(batch)
+        self.__sent += len(batch.datagrams)
+        self.__stalls += batch.stalls
+        self.ser.write(batch.datagrams)
+        self.__dispatch()
+
+    def inflight_bytes(self):
+        """
+        :return: Number of sent bytes for which the response has not been
+            received yet.
+        """
+        return self.__sent
+
+    def stalls(self):
+        """
+        :return: True if any batch awaiting for its response may stall the
+            bus bridge.
+        """
+        return self.__stalls > 0
+
+    async def wait_oldest(self):
+        """ Wait until the response of the oldest sent batch is received. """
+        if len(self.__expected):
+            # Imported by the coroutines only: asyncio takes most of the
+            # import time of this package.
+            import asyncio
+            await asyncio.shield(self.__expected[0].pending)
+
+    def __on_readable(self):
+        self.__buffer += self.ser.read(self.ser.in_waiting)
+        self.__dispatch()
+
+    def __dispatch(self):
+        """ Complete all the expected responses which have been received. """
+        buf = self.__buffer
+        while len(self.__expected) and \
+                (len(buf) >= len(self.__expected[0].expected)):
+            batch = self.__expected.popleft()
+            self.__sent -= len(batch.datagrams)
+            self.__stalls -= batch.stalls
+            size = len(batch.expected)
+            errors = batch.dispatch(bytes(buf[:size]))
+            del buf[:size]
+            if not batch.pending.done():
+                batch.pending.set_result(errors)
+
+
+class ScaffoldBusThreadState(threading.local):
+    """
+    State of a :class:`ScaffoldBus` which is private to each thread: lazy
+    sections, queued operations and program recording.
+    """
+    def __init__(self):
+        self.lazy_stack = 0
+        # Queued ScaffoldBusOperation
+        self.lazy_ops = []
+        # Write errors met while fetching responses, raised when all the
+        # responses have been fetched.
+        self.errors = []
+        # Sent ScaffoldBusBatch awaiting for their response, in full-duplex
+        # mode.
+        self.batches = []
+        # ScaffoldBusProgram being recorded
+        self.program = None
+        # Current ScaffoldTransaction
+        self.transaction = None
+        # Transactions suspended by dry runs
+        self.suspended = []
+
+
+class ScaffoldBus:
+    """
+    Low level methods to drive the Scaffold device.
+
+    The bus can be shared by many threads. Lazy sections are private to each
+    thread, and each operation or batch of operations is sent atomically. In
+    half-duplex mode, a thread holds the bus until it has received its
+    responses; in full-duplex mode, the threads only hold the bus while
+    sending, and the reader thread routes the responses back to them. Note
+    that the polling timeout is a global setting of the board.
+    """
+    MAX_CHUNK = 255
+    # Maximum number of entries in the datagram header cache
+    HEADER_CACHE_SIZE = 4096
+    # Size of the bus bridge input FIFO
+    FIFO_SIZE = 512
+    # Bytes of the bridge input FIFO kept free by the default credit window,
+    # for the commands injected by the API (polling timeout changes) and the
+    # bytes received by the bridge while it pops the previous ones.
+    CREDIT_HEADROOM = 32
+    # Baudrate of the serial link of the bus bridge
+    BAUDRATE = 2000000
+    # Duration of one unit of the polling timeout register, in seconds
+    TIMEOUT_UNIT = 3.0 / 100e6
+    # Silence duration ending the discarding of late responses by resync, in
+    # seconds.
+    RESYNC_QUIET_TIME = 0.05
+    # Number of probes sent by resync before giving up
+    RESYNC_ATTEMPTS = 3
+
+    def __init__(self):
+        self.ser = None
+        # Precomputed datagram headers, indexed by (rw, addr, size, poll,
+        # poll_mask, poll_value).
+        self.__header_cache = {}
+        # Lazy sections and queued operations of each thread
+        self.__state = ScaffoldBusThreadState()
+        # Held while sending, and in half-duplex mode until the responses are
+        # received.
+        self.__lock = threading.RLock()
+        # Sent batches awaiting for their response, all threads included
+        self.__inflight = deque()
+        # Running totals over the in-flight batches: bytes sent, bytes
+        # expected, bytes transferred by polling and number of batches which
+        # may stall the bus bridge.
+        self.__inflight_sent = 0
+        self.__inflight_received = 0
+        self.__inflight_polled = 0
+        self.__inflight_stalls = 0
+        # Maximum number of bytes which can be sent to the board without
+        # having received their response, when a command may stall the bus
+        # bridge. None to disable flow control.
+        self.credit_window = self.FIFO_SIZE - self.CREDIT_HEADROOM
+        # Background reader thread, in full-duplex mode only.
+        self.__reader = None
+        # Reader attached to an asyncio event loop, created by the first
+        # coroutine call.
+        self.__async_reader = None
+        # TraceRecorder when recording the bus traffic.
+        self.__trace = None
+        # Round-trip time measured by measure_latency, in seconds.
+        self.latency = None
+        # When enabled, consecutive writes to the same register with the same
+        # polling parameters queued in a lazy section are merged in a single
+        # command. Disabled by default.
+        self.write_combining = False
+        # When enabled, Register.set skips the writes of a value equal to the
+        # cached one, for registers which are not volatile or are host
+        # authoritative. The caches must then reflect the board state: raw
+        # writes with Register.write are not tracked. Disabled by default.
+        self.write_elision = False
+        # Allowance added to the host deadlines for the latency of the link
+        # and of the operating system, in seconds. None disables the
+        # deadlines.
+        self.deadline_margin = 1.0
+        # Longest time the board may wait for each byte of a polling
+        # operation when no polling timeout is set, in seconds, used for the
+        # host deadlines. None to wait forever.
+        self.max_poll_time = None
+        # Register read by resync to probe the bus bridge: version register.
+        self.probe_address = 0x0100
+        # Polling timeout register value requested with set_timeout, or None
+        # if never set.
+        self.__timeout = None
+        # Polling timeout register value sent to the board, or None if
+        # unknown. The board is updated only before a polling operation.
+        self.__board_timeout = None
+        # Read timeout currently set in the transport
+        self.__read_timeout = None
+
+    def connect(
+            self, dev, full_duplex=False, transport='serial',
+            low_latency=False):
+        """
+        Connect to Scaffold board using the given serial port.
+        :param dev: Serial port device path. For instance '/dev/ttyUSB0' on
+            linux, 'COM0' on Windows. For the 'tcp' transport, 'host:port'
+            string. Can also be an already opened transport instance, see
+            :class:`scaffold.transport.Transport`, in which case the transport
+            parameter is ignored.
+        :param transport: Transport backend used to open dev. 'serial' uses
+            pyserial, 'raw' uses termios and os.read/os.write directly (lower
+            latency, POSIX only), 'tcp' connects to a serial-to-network bridge
+            (POSIX only), 'emulator' uses an in-process emulated board, see
+            :mod:`scaffold.emulator`.
+        :type transport: str
+        :param full_duplex: If True, a background thread continuously reads
+            the serial port and matches the responses to the sent commands.
+            In lazy sections, commands are then streamed to the board while
+            the previous responses are still in flight, instead of being sent
+            all at once when the section is closed.
+        :param low_latency: If True, tune the transport to reduce the
+            round-trip time of the bus: on Linux, the ASYNC_LOW_LATENCY flag of
+            the serial port is set and the latency timer of FTDI converters is
+            lowered to 1 ms when its sysfs attribute is writable. See the
+            set_low_latency method of the transports in
+            :mod:`scaffold.transport`. Settings which cannot be applied are
+            silently skipped; use :meth:`measure_latency` to check the result.
+        """
+        if self.__reader is not None:
+            self.__reader.stop()
+            self.__reader = None
+        if self.__async_reader is not None:
+            self.__async_reader.close()
+            self.__async_reader = None
+        self.ser = open_transport(dev, transport)
+        if self.__trace is not None:
+            self.ser = self.__trace.wrap(self.ser)
+        self.__read_timeout = None
+        self.__board_timeout = None
+        self.latency = None
+        if low_latency and hasattr(self.ser, 'set_low_latency'):
+            self.ser.set_low_latency()
+        if full_duplex:
+            self.__reader = ScaffoldBusReader(self.ser)
+            self.__reader.start()
+
+    @property
+    def full_duplex(self):
+        """ True if the bus runs a background reader thread. Read-only. """
+        return self.__reader is not None
+
+    def start_trace(self, path, size=1 << 24):
+        """
+        Start recording all the bytes sent to and received from the board in
+        a trace file. See :class:`scaffold.trace.TraceRecorder` for the file
+        format, and :func:`scaffold.trace.replay` to replay a trace. The
+        recording is kept when reconnecting, until :meth:`stop_trace` is
+        called.
+
+        :param path: Trace file path. An existing file is overwritten.
+        :param size: Initial size of the trace file, in bytes.
+        :return: :class:`scaffold.trace.TraceRecorder` instance. Its tag
+            attribute can be set to mark the following records.
+        """
+        if self.__trace is not None:
+            raise RuntimeError('Trace already started')
+        self.__check_idle()
+        # Imported here so the trace module can be run as a script.
+        from .trace import TraceRecorder
+        self.__trace = TraceRecorder(path, size)
+        if self.ser is not None:
+            self.__set_transport(self.__trace.wrap(self.ser))
+        return self.__trace
+
+    def stop_trace(self):
+        """ Stop recording the bus traffic and close the trace file. """
+        if self.__trace is None:
+            raise RuntimeError('No trace started')
+        self.__check_idle()
+        if self.ser is not None:
+            self.__set_transport(self.ser.transport)
+        self.__trace.close()
+        self.__trace = None
+
+    @property
+    def trace(self):
+        """
+        :class:`scaffold.trace.TraceRecorder` of the current recording, or
+        None. Read-only.
+        """
+        return self.__trace
+
+    def __check_idle(self):
+        """
+        :raises RuntimeError: If a lazy section is open or responses are still
+            expected.
+        """
+        state = self.__state
+        if state.lazy_stack or len(self.__inflight) or len(state.lazy_ops):
+            raise RuntimeError('Bus is busy')
+
+    def __set_transport(self, ser):
+        """ Replace the transport used by the bus and its readers. """
+        self.ser = ser
+        if self.__reader is not None:
+            self.__reader.ser = ser
+        if self.__async_reader is not None:
+            self.__async_reader.ser = ser
+
+    def measure_latency(self, addr, count=32):
+        """
+        Measure the round-trip time of the bus, by timing single byte reads.
+        The result is also saved in the latency attribute.
+
+        :param addr: Address of a register which can be read without side
+            effect.
+        :param count: Number of reads. Must be at least 1.
+        :return: Median round-trip time, in seconds.
+        :raises ValueError: If count is less than 1.
+        """
+        if count < 1:
+            raise ValueError('At least one read is required')
+        times = []
+        for i in range(count):
+            t = perf_counter()
+            self.read(addr)
+            times.append(perf_counter() - t)
+        times.sort()
+        self.latency = times[count // 2]
+        return self.latency
+
+    def prepare_datagram(
+            self, rw, addr, size, poll, poll_mask, poll_value):
+        """
+        Helper function to build the datagrams to be sent to the Scaffold
+        device. Also performs basic check on arguments.
+        :rw: 1 for a write command, 0 for a read command.
+        :addr: Register address.
+        :size: Size of the data to be sent or received. Maximum size is 255.
+        :param poll: Register instance or address. None if polling is not
+            required.
+        :poll_mask: Register polling mask.
+        :poll_value: Register polling value.
+        :return: A bytearray.
+        """
+        if rw not in range(2):
+            raise ValueError('Invalid rw argument')
+        if size not in range(1, self.MAX_CHUNK+1):
+            raise ValueError('Invalid size')
+        if addr not in range(0x10000):
+            raise ValueError('Invalid address')
+        if isinstance(poll, Register):
+            poll = poll.address
+        if (poll is not None) and (poll not in range(0x10000)):
+            raise ValueError('Invalid polling address')
+        command = rw
+        if size > 1:
+            command |= 2
+        if poll is not None:
+            command |= 4
+        datagram = bytearray()
+        datagram.append(command)
+        datagram.append(addr >> 8)
+        datagram.append(addr & 0xff)
+        if poll is not None:
+            datagram.append(poll >> 8)
+            datagram.append(poll & 0xff)
+            datagram.append(poll_mask)
+            datagram.append(poll_value)
+        if size > 1:
+            datagram.append(size)
+        return datagram
+
+    def __header(self, op):
+        """
+        :return: Datagram header bytes for an operation. Headers are validated
+            and built by :meth:`prepare_datagram` the first time, then cached:
+            registers are usually accessed many times with the same
+            parameters.
+        :param op: :class:`ScaffoldBusOperation` instance.
+        """
+        key = (op.rw, op.addr, op.size, op.poll, op.poll_mask, op.poll_value)
+        try:
+            return self.__header_cache[key]
+        except KeyError:
+            pass
+        header = bytes(self.prepare_datagram(*key))
+        if len(self.__header_cache) >= self.HEADER_CACHE_SIZE:
+            self.__header_cache.clear()
+        self.__header_cache[key] = header
+        return header
+
+    def __queue(self, op):
+        """
+        Queue an operation. Outside of lazy sections, the operation is
+        executed immediately.
+
+        :param op: :class:`ScaffoldBusOperation` instance.
+        """
+        state = self.__state
+        transaction = state.transaction
+        if transaction is not None:
+            if transaction.dry_run:
+                return
+            if len(transaction.registers):
+                # Deferred writes are sent before the other operations.
+                transaction._send()
+        if (op.poll is not None) and (self.__timeout != self.__board_timeout):
+            self.__sync_timeout()
+        lazy_ops = state.lazy_ops
+        if self.write_combining and (op.rw == 1) and len(lazy_ops):
+            last = lazy_ops[-1]
+            if self.__can_combine(last, op):
+                last.data = bytearray(last.data)
+                last.data += op.data
+                last.size += op.size
+                return
+        if (state.lazy_stack == 0) and (self.__reader is None):
+            with self.__lock:
+                self.__execute(op)
+            return
+        lazy_ops.append(op)
+        if state.lazy_stack == 0:
+            self.__flush()
+        elif (self.__reader is not None) and (len(lazy_ops) > 1) and \
+                (state.program is None):
+            # Full-duplex mode: stream the queued operations without waiting
+            # for the responses. The last operation is kept in the queue so
+            # it can still be merged with the next write.
+            ops = lazy_ops[:-1]
+            del lazy_ops[:-1]
+            with self.__lock:
+                self.__send(ops)
+
+    def __can_combine(self, a, b):
+        """
+        :return: True if write operation b can be appended to the queued write
+            operation a to form a single command.
+        :param a: Queued :class:`ScaffoldBusOperation`.
+        :param b: New write :class:`ScaffoldBusOperation`.
+        """
+        if (a.rw != 1) or (a.addr != b.addr):
+            return False
+        if a.size + b.size > self.MAX_CHUNK:
+            return False
+        poll_a = a.poll.address if isinstance(a.poll, Register) else a.poll
+        poll_b = b.poll.address if isinstance(b.poll, Register) else b.poll
+        if poll_a != poll_b:
+            return False
+        if poll_a is None:
+            # Polling mask and value are not sent
+            return True
+        return (a.poll_mask == b.poll_mask) and (a.poll_value == b.poll_value)
+
+    def __flush(self):
+        """
+        Send all the queued operations to the board with a single serial
+        write, then fetch all the responses with a single serial read. Read
+        results are dispatched to their futures.
+
+        :raises TimeoutError: If a write operation timed out. If many write
+            operations timed out, the last error is raised.
+        """
+        state = self.__state
+        ops = state.lazy_ops
+        if self.__reader is None:
+            # Half-duplex mode: the responses must be read before another
+            # thread sends commands.
+            with self.__lock:
+                if len(ops):
+                    state.lazy_ops = []
+                    self.__send(ops)
+                self.__complete()
+            return
+        if len(ops):
+            state.lazy_ops = []
+            with self.__lock:
+                self.__send(ops)
+        self.__complete()
+
+    def __send(self, ops):
+        """
+        Send operations to the board. The expected responses are fetched later
+        by :meth:`__complete`.
+
+        When some commands may stall the bus bridge (see :meth:`may_stall`),
+        the bytes sent to the board are accumulated in its input FIFO until
+        the stalling commands complete. To avoid overflowing this FIFO, the
+        number of bytes sent but not yet acknowledged is limited to
+        :attr:`credit_window`: if the window is full, the responses of the
+        oldest sent commands are awaited before sending more.
+
+        :param ops: List of :class:`ScaffoldBusOperation`.
+        """
+        window = self.credit_window
+        batch = ScaffoldBusBatch()
+        for op in ops:
+            datagram = self.__datagram(op)
+            if window is not None:
+                stalls = self.may_stall(op)
+                if (stalls or batch.stalls or self.__inflight_stalls) and \
+                        (self.__inflight_sent + len(batch.datagrams)
+                            + len(datagram) > window):
+                    # Credit window is full. Send what we have, then wait for
+                    # the oldest responses until there is enough room.
+                    if len(batch.ops):
+                        self.__transmit(batch)
+                        batch = ScaffoldBusBatch()
+                    while len(self.__inflight) and (
+                            self.__inflight_sent + len(datagram) > window):
+                        self.__complete_one()
+                batch.stalls = batch.stalls or stalls
+            batch.add(op, datagram)
+        if len(batch.ops):
+            self.__transmit(batch)
+
+    def __datagram(self, op):
+        """
+        :return: Bytes to be sent to the board for an operation.
+        :param op: :class:`ScaffoldBusOperation` instance.
+        """
+        if op.rw is None:
+            return op.data
+        if op.rw:
+            return self.__header(op) + op.data
+        return self.__header(op)
+
+    def __transmit(self, batch):
+        """
+        Write the datagrams of a batch to the serial port and register the
+        expected response.
+
+        :param batch: :class:`ScaffoldBusBatch` instance.
+        """
+        if self.__reader is not None:
+            # The response must be expected before the command is sent, in
+            # case the reader thread receives it very quickly. It may have to
+            # wait for the responses of the other threads.
+            batch.deadline = self.__deadline(
+                self.__inflight_sent + len(batch.datagrams),
+                self.__inflight_received + len(batch.expected),
+                self.__inflight_polled + batch.polled)
+            batch.pending = self.__reader.expect(len(batch.expected))
+            self.__state.batches.append(batch)
+        self.ser.write(batch.datagrams)
+        self.__inflight.append(batch)
+        self.__track(batch, 1)
+
+    def __track(self, batch, sign):
+        """
+        Update the running totals of the in-flight batches.
+
+        :param batch: :class:`ScaffoldBusBatch` added to or removed from the
+            in-flight batches.
+        :param sign: 1 when the batch is added, -1 when it is removed.
+        """
+        self.__inflight_sent += sign * len(batch.datagrams)
+        self.__inflight_received += sign * len(batch.expected)
+        self.__inflight_polled += sign * batch.polled
+        self.__inflight_stalls += sign * batch.stalls
+
+    def __deadline(self, sent, received, polled):
+        """
+        :return: Host deadline of a transfer in seconds: the longest time the
+            board may take to respond, plus :attr:`deadline_margin`. None if
+            this time is unbounded (polling without timeout, unless
+            :attr:`max_poll_time` is set) or the deadlines are disabled.
+        :param sent: Number of bytes sent to the board.
+        :param received: Number of bytes expected from the board.
+        :param polled: Number of bytes transferred by polling operations.
+        """
+        margin = self.deadline_margin
+        if margin is None:
+            return None
+        t = margin + (sent + received) * 10 / self.BAUDRATE
+        if polled:
+            if self.__timeout:
+                t += polled * self.__timeout * self.TIMEOUT_UNIT
+            elif self.max_poll_time is not None:
+                t += polled * self.max_poll_time
+            else:
+                # Polling without timeout may wait forever.
+                return None
+        # Rounded so the timeout of the transport is rarely changed.
+        return math.ceil(t * 1000) / 1000
+
+    def __arm(self, timeout):
+        """
+        Set the read timeout of the transport, if it changed.
+
+        :param timeout: Timeout in seconds, or None.
+        """
+        if timeout != self.__read_timeout:
+            self.ser.timeout = timeout
+            self.__read_timeout = timeout
+
+    def __stall(self, received, expected, ops=()):
+        """
+        Handle a response which has not been received before its deadline.
+        All the operations in flight are lost: their futures fail, and the
+        bus is resynchronized with :meth:`resync`. Called with the bus
+        locked.
+
+        :param received: Number of bytes received before the deadline.
+        :param expected: Number of bytes expected.
+        :param ops: Lost operations which are not in the in-flight batches.
+        :raises BusStallError: Always.
+        """
+        error = BusStallError(received, expected)
+        state = self.__state
+        lost = list(ops)
+        for batch in list(self.__inflight) + state.batches:
+            lost += batch.ops
+        for op in lost:
+            if op.future is not None:
+                op.future._fail(error)
+        self.__inflight.clear()
+        self.__inflight_sent = self.__inflight_received = 0
+        self.__inflight_polled = self.__inflight_stalls = 0
+        state.batches = []
+        state.errors = []
+        # A timeout command may have been lost.
+        self.__board_timeout = None
+        error.resynced = self.resync()
+        raise error
+
+    def resync(self):
+        """
+        Resynchronize the bus, after a :class:`BusStallError`. The late
+        responses of the lost operations are discarded until the link stays
+        quiet for :attr:`RESYNC_QUIET_TIME`, then the bus bridge is probed by
+        reading the register at :attr:`probe_address`, the version register
+        by default. This is tried up to :attr:`RESYNC_ATTEMPTS` times, since
+        the bridge may still be completing the lost operations. In full-duplex
+        mode, the reader thread is restarted and the responses awaited by the
+        other threads are aborted.
+
+        :return: True if the bus bridge answered the probe.
+        """
+        with self.__lock:
+            reader = self.__reader
+            if reader is not None:
+                reader.stop()
+            try:
+                ser = self.ser
+                probe = self.prepare_datagram(
+                    0, self.probe_address, 1, None, 0, 0)
+                timeout = self.__deadline(len(probe), 2, 0) or 1.0
+                for _ in range(self.RESYNC_ATTEMPTS):
+                    ser.timeout = self.RESYNC_QUIET_TIME
+                    while len(ser.read(4096)):
+                        pass
+                    ser.timeout = timeout
+                    ser.write(probe)
+                    res = ser.read(2)
+                    if (len(res) == 2) and (res[1] == 1):
+                        return True
+                return False
+            finally:
+                self.__read_timeout = None
+                self.ser.timeout = None
+                if reader is not None:
+                    self.__reader = ScaffoldBusReader(self.ser)
+                    self.__reader.start()
+
+    def may_stall(self, op):
+        """
+        :return: True if an operation may keep the bus bridge busy longer
+            than the time required to receive the next commands. This is the
+            case of polling operations, and of reads returning more bytes than
+            their command size.
+        :param op: :class:`ScaffoldBusOperation` instance.
+        """
+        if op.rw is None:
+            return False
+        if op.poll is not None:
+            return True
+        return (op.rw == 0) and (op.size > 3)
+
+    def __execute(self, op):
+        """
+        Fast path to execute immediately a single operation in half-duplex
+        mode, outside of lazy sections.
+
+        :param op: :class:`ScaffoldBusOperation` instance. Read operations
+            may have no future, in which case the result is returned.
+        :return: Read data for read operations without future.
+        :raises TimeoutError: If the operation timed out.
+        """
+        if op.rw is None:
+            self.ser.write(op.data)
+            return
+        polled = 0 if op.poll is None else op.size
+        if op.rw:
+            datagram = self.__header(op) + op.data
+            self.__arm(self.__deadline(len(datagram), 1, polled))
+            self.ser.write(datagram)
+            res = self.ser.read(1)
+            if len(res) == 0:
+                self.__stall(0, 1, (op,))
+            ack = res[0]
+            if ack != op.size:
+                # Timeout error !
+                assert op.poll is not None
+                raise op.timeout_error(ack)
+            return
+        header = self.__header(op)
+        self.__arm(self.__deadline(len(header), op.size + 1, polled))
+        self.ser.write(header)
+        if op.target is not None:
+            # Receive the data directly in the target buffer, and the ack byte
+            # separately.
+            n = self.ser.readinto(op.target)
+            res = self.ser.read(1) if n == op.size else b''
+            if len(res) == 0:
+                self.__stall(n, op.size + 1, (op,))
+            ack = res[0]
+            op.future._advance(
+                min(ack, op.size), op if (ack != op.size) else None)
+            return
+        res = self.ser.read(op.size + 1)
+        if len(res) != op.size + 1:
+            self.__stall(len(res), op.size + 1, (op,))
+        ack = res[-1]
+        if op.future is None:
+            # Caller expects the result directly
+            if ack != op.size:
+                assert op.poll is not None
+                raise op.timeout_error(ack, res[:ack])
+            return bytearray(res[:-1])
+        if ack != op.size:
+            assert op.poll is not None
+            op.future._feed(res[:ack], op)
+        else:
+            op.future._feed(res[:-1])
+
+    def __complete_one(self):
+        """
+        Wait for the response of the oldest sent batch. In half-duplex mode,
+        the response is also dispatched, and write errors are saved and raised
+        later by :meth:`__complete`. In full-duplex mode, the batch may belong
+        to another thread, which dispatches the response.
+        """
+        batch = self.__inflight.popleft()
+        self.__track(batch, -1)
+        if batch.pending is not None:
+            if batch.pending.wait(batch.deadline) is None:
+                self.__inflight.appendleft(batch)
+                self.__track(batch, 1)
+                self.__pending_stall(batch)
+            return
+        size = len(batch.expected)
+        if size == 0:
+            return
+        self.__arm(self.__deadline(len(batch.datagrams), size, batch.polled))
+        res = self.ser.read(size)
+        if len(res) != size:
+            self.__stall(len(res), size, batch.ops)
+        self.__state.errors += batch.dispatch(res)
+
+    def __pending_stall(self, batch):
+        """
+        Handle a full-duplex response which has not been received before its
+        deadline, or which has been aborted by the stall of another thread.
+
+        :param batch: :class:`ScaffoldBusBatch` instance.
+        :raises BusStallError: Always.
+        """
+        with self.__lock:
+            if batch.pending.aborted:
+                raise BusStallError()
+            self.__stall(0, len(batch.expected))
+
+    def __complete(self):
+        """
+        Wait for the responses of all the sent operations and dispatch them.
+
+        :raises TimeoutError: If a write operation timed out. If many write
+            operations timed out, the first error is raised, and its errors
+            attribute lists all of them.
+        """
+        state = self.__state
+        if self.__reader is None:
+            while len(self.__inflight):
+                self.__complete_one()
+        else:
+            batches = state.batches
+            state.batches = []
+            for batch in batches:
+                res = batch.pending.wait(batch.deadline)
+                if res is None:
+                    state.batches = batches
+                    self.__pending_stall(batch)
+                with self.__lock:
+                    if batch in self.__inflight:
+                        self.__inflight.remove(batch)
+                        self.__track(batch, -1)
+                state.errors += batch.dispatch(res)
+        errors = state.errors
+        if len(errors):
+            state.errors = []
+            errors[0].errors = errors
+            raise errors[0]
+
+    def write(
+            self, addr, data, poll=None, poll_mask=0xff, poll_value=0x00):
+        """
+        Write data to a register. If :attr:`write_combining` is enabled and
+        the write is queued in a lazy section right after another write to the
+        same register with the same polling parameters, both are merged in a
+        single command (up to :attr:`MAX_CHUNK` bytes). In that case, the size
+        reported by an eventual TimeoutError counts the bytes of the merged
+        command.
+        :param addr: Register address.
+        :param data: Data to be written. Can be a byte, bytes or bytearray.
+        :param poll: Register instance or address. None if polling is not
+            required.
+        :param poll_mask: Register polling mask.
         :param poll_value: Register polling value.
         """
         if self.ser is None:
@@ -1348,28 +3498,43 @@ class ScaffoldBus:
         if type(data) is int:
             data = bytes([data])
 
+        size = len(data)
+        if size <= self.MAX_CHUNK:
+            # Fast path for the most common case: a single command.
+            if size:
+                self.__queue(ScaffoldBusOperation(
+                    1, addr, size, poll, poll_mask, poll_value,
+                    data=bytes(data)))
+            return
+
         offset = 0
         remaining = len(data)
         while remaining:
             chunk_size = min(self.MAX_CHUNK, remaining)
-            datagram = self.prepare_datagram(
-                1, addr, chunk_size, poll, poll_mask, poll_value)
-            datagram += data[offset:offset + chunk_size]
-            self.ser.write(datagram)
-            if self.__lazy_stack == 0:
-                # Check immediately the result of the write operation.
-                ack = self.ser.read(1)[0]
-                if ack != chunk_size:
-                    assert poll is not None
-                    # Timeout error !
-                    raise TimeoutError(size=offset+ack)
-            else:
-                # Lazy-update section. The write result will be checked later,
-                # when all lazy-sections are closed.
-                self.__lazy_writes.append(chunk_size)
+            self.__queue(ScaffoldBusOperation(
+                1, addr, chunk_size, poll, poll_mask, poll_value,
+                data=data[offset:offset + chunk_size], offset=offset))
             remaining -= chunk_size
             offset += chunk_size
 
+    def _queue_write(self, addr, size, data):
+        """
+        Queue a write command without polling and without any check. Used by
+        the generated :class:`RegisterMap` accessors.
+
+        :param addr: Register address.
+        :param size: Number of bytes, at most :attr:`MAX_CHUNK`.
+        :param data: bytes of the given size.
+        """
+        op = ScaffoldBusOperation(1, addr, size, None, 0xff, 0x00, data)
+        state = self.__state
+        if (state.lazy_stack > 0) and (self.__reader is None) and \
+                (not self.write_combining) and (state.transaction is None):
+            # Fast path in half-duplex lazy sections: nothing else to do.
+            state.lazy_ops.append(op)
+            return
+        self.__queue(op)
+
     def read(
             self, addr, size=1, poll=None, poll_mask=0xff,
             poll_value=0x00):
@@ -1380,81 +3545,366 @@ class ScaffoldBus:
             required.
         :param poll_mask: Register polling mask.
         :param poll_value: Register polling value.
-        :return: bytearray
+        :return: bytearray. During a lazy-update section, a
+            :class:`ScaffoldBusFuture` is returned instead, and the data will
+            be available when all lazy sections are closed.
         """
         if self.ser is None:
             raise RuntimeError('Not connected to board')
-        # Read operation not permitted during lazy-update sections
-        if self.__lazy_stack > 0:
-            raise RuntimeError('Read operations not allowed during lazy-update '
-                'section.')
-        result = bytearray()
+        state = self.__state
+        if (state.lazy_stack == 0) and (self.__reader is None) and \
+                (state.transaction is None) and \
+                (0 < size <= self.MAX_CHUNK) and ((poll is None) or
+                    (self.__timeout == self.__board_timeout)):
+            # Fastest path: single command executed immediately.
+            with self.__lock:
+                return self.__execute(ScaffoldBusOperation(
+                    0, addr, size, poll, poll_mask, poll_value))
+        future = ScaffoldBusFuture(size)
+        if size <= self.MAX_CHUNK:
+            # Fast path for the most common case: a single command.
+            if size:
+                self.__queue(ScaffoldBusOperation(
+                    0, addr, size, poll, poll_mask, poll_value,
+                    future=future))
+            if state.lazy_stack > 0:
+                return future
+            return future.result()
+        offset = 0
         remaining = size
         while remaining:
             chunk_size = min(self.MAX_CHUNK, remaining)
-            datagram = self.prepare_datagram(
-                0, addr, chunk_size, poll, poll_mask, poll_value)
-            self.ser.write(datagram)
-            res = self.ser.read(chunk_size+1)
-            ack = res[-1]
-            if ack != chunk_size:
-                assert poll is not None
-                result += res[:ack]
-                raise TimeoutError(data=result)
-            result += res[:-1]
+            self.__queue(ScaffoldBusOperation(
+                0, addr, chunk_size, poll, poll_mask, poll_value,
+                future=future, offset=offset))
+            if future.done:
+                # A chunk timed out, stop here.
+                break
             remaining -= chunk_size
-        return result
+            offset += chunk_size
+        if self.__state.lazy_stack > 0:
+            return future
+        return future.result()
+
+    def readinto(
+            self, addr, buf, poll=None, poll_mask=0xff, poll_value=0x00):
+        """
+        Read data from a register directly into a buffer. This avoids
+        allocating and copying intermediate bytearrays when reading large
+        amounts of data. The number of bytes to be read is the size of the
+        buffer.
+        :param addr: Register address.
+        :param buf: Writable buffer: bytearray, memoryview, array, or NumPy
+            array for instance. Must be contiguous.
+        :param poll: Register instance or address. None if polling is not
+            required.
+        :param poll_mask: Register polling mask.
+        :param poll_value: Register polling value.
+        :return: Number of bytes read. During a lazy-update section, a
+            :class:`ScaffoldBusFuture` is returned instead, and the buffer
+            will be filled when all lazy sections are closed.
+        """
+        if self.ser is None:
+            raise RuntimeError('Not connected to board')
+        view = memoryview(buf).cast('B')
+        size = len(view)
+        future = ScaffoldBusFuture(size, view)
+        offset = 0
+        remaining = size
+        while remaining:
+            chunk_size = min(self.MAX_CHUNK, remaining)
+            self.__queue(ScaffoldBusOperation(
+                0, addr, chunk_size, poll, poll_mask, poll_value,
+                future=future, offset=offset,
+                target=view[offset:offset + chunk_size]))
+            if future.done:
+                # A chunk timed out, stop here.
+                break
+            remaining -= chunk_size
+            offset += chunk_size
+        if self.__state.lazy_stack > 0:
+            return future
+        return future.result()
 
     def set_timeout(self, value):
         """
         Configure the polling timeout register.
+
+        The timeout only matters to polling operations, so the timeout command
+        is not sent immediately: it is queued right before the next polling
+        operation, and only if the board is not already configured with this
+        value. Setting the timeout many times between two polling operations
+        therefore costs at most one command. Board timeout is a global setting
+        shared by all the threads.
+
         :param value: Timeout register value. If 0 the timeout is disabled.
         """
         if (value < 0) or (value > 0xffffffff):
             raise ValueError('Timeout value out of range')
+        self.__timeout = value
+
+    @property
+    def timeout(self):
+        """
+        Polling timeout register value set with :meth:`set_timeout`, or None
+        if not set. Read-only.
+        """
+        return self.__timeout
+
+    def __sync_timeout(self):
+        """
+        Queue a timeout command if the board timeout differs from the one set
+        with :meth:`set_timeout`. Called before queuing a polling operation.
+        """
+        value = self.__timeout
+        self.__board_timeout = value
         datagram = bytearray()
         datagram.append(0x08)
         datagram += value.to_bytes(4, 'big', signed=False)
-        self.ser.write(datagram)
-        # No response expected from the board
+        # No response expected from the board. The command is queued to keep
+        # it ordered with the operations of an eventual lazy section.
+        self.__queue(ScaffoldBusOperation(
+            None, None, 0, None, 0, 0, data=datagram))
 
     @property
     def is_connected(self):
         return self.set is not None
 
+    def __get_async_reader(self):
+        """
+        :return: :class:`ScaffoldBusAsyncReader` attached to the running event
+            loop. It is created if needed.
+        """
+        # See wait_oldest.
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if self.__reader is not None:
+            raise RuntimeError(
+                'Coroutines cannot be used in full-duplex mode')
+        reader = self.__async_reader
+        if (reader is None) or (reader.loop is not loop):
+            if reader is not None:
+                reader.close()
+            reader = ScaffoldBusAsyncReader(self.ser, loop)
+            self.__async_reader = reader
+        return reader
+
+    async def __flush_async(self):
+        """
+        Coroutine version of :meth:`__flush`: send all the queued operations
+        and wait for their responses without blocking the event loop. Flow
+        control is applied as in :meth:`__send`.
+
+        :raises TimeoutError: If a write operation timed out.
+        """
+        reader = self.__get_async_reader()
+        state = self.__state
+        ops = state.lazy_ops
+        state.lazy_ops = []
+        window = self.credit_window
+        batches = []
+        batch = ScaffoldBusBatch()
+        for op in ops:
+            datagram = self.__datagram(op)
+            if window is not None:
+                stalls = self.may_stall(op)
+                if (stalls or batch.stalls or reader.stalls()) and \
+                        (reader.inflight_bytes() + len(batch.datagrams)
+                            + len(datagram) > window):
+                    if len(batch.ops):
+                        reader.transmit(batch)
+                        batches.append(batch)
+                        batch = ScaffoldBusBatch()
+                    while reader.inflight_bytes() + len(datagram) > window:
+                        await reader.wait_oldest()
+                batch.stalls = batch.stalls or stalls
+            batch.add(op, datagram)
+        if len(batch.ops):
+            reader.transmit(batch)
+            batches.append(batch)
+        errors = []
+        for batch in batches:
+            errors += await batch.pending
+        if len(errors):
+            errors[0].errors = errors
+            raise errors[0]
+
+    async def lazy_end_async(self):
+        """
+        Coroutine version of :meth:`lazy_end`. If this was the last lazy
+        section, the queued operations are sent and their responses awaited
+        without blocking the event loop. This is what
+        ``async with bus.lazy_section()`` calls when leaving the block.
+
+        Many coroutines can use the bus concurrently: each one flushes its own
+        operations, and the responses are matched in order. Coroutines should
+        not be mixed with blocking calls while operations are in flight.
+        """
+        state = self.__state
+        if state.lazy_stack == 0:
+            raise RuntimeError('No lazy section started')
+        state.lazy_stack -= 1
+        if state.lazy_stack == 0:
+            await self.__flush_async()
+
+    async def write_async(
+            self, addr, data, poll=None, poll_mask=0xff, poll_value=0x00):
+        """
+        Coroutine version of :meth:`write`. Requires a POSIX serial port.
+        """
+        async with self.lazy_section():
+            self.write(addr, data, poll, poll_mask, poll_value)
+
+    async def read_async(
+            self, addr, size=1, poll=None, poll_mask=0xff, poll_value=0x00):
+        """
+        Coroutine version of :meth:`read`. Requires a POSIX serial port.
+
+        :return: bytearray
+        """
+        async with self.lazy_section():
+            future = self.read(addr, size, poll, poll_mask, poll_value)
+        return future.result()
+
+    async def readinto_async(
+            self, addr, buf, poll=None, poll_mask=0xff, poll_value=0x00):
+        """
+        Coroutine version of :meth:`readinto`. Requires a POSIX serial port.
+
+        :return: Number of bytes read.
+        """
+        async with self.lazy_section():
+            future = self.readinto(addr, buf, poll, poll_mask, poll_value)
+        return future.result()
+
     def lazy_start(self):
         """
         Enters lazy-check update block, or add a block level if already in
-        lazy-check mode. When lazy-check is enabled, the result of write
-        operations on Scaffold bus are not checked immediately, but only when
+        lazy-check mode. When lazy-check is enabled, the operations on Scaffold
+        bus are not executed immediately but queued, and sent all at once when
         leaving all blocks. This allows updating many different registers
-        without the serial latency because all the responses will be checked at
-        once.
+        without the serial latency because all the responses will be fetched
+        and checked at once. Read operations return a
+        :class:`ScaffoldBusFuture` which is resolved when leaving the last
+        block.
+
+        Lazy sections are private to the calling thread.
         """
-        self.__lazy_stack += 1
+        self.__state.lazy_stack += 1
 
     def lazy_end(self):
         """
         Close current lazy-update block. If this was the last lazy section,
-        fetch all responses from Scaffold and check that all write operations
-        went good. If any write-operation timed-out, the last TimeoutError is
-        thrown.
+        send all queued operations, fetch all responses from Scaffold and check
+        that all write operations went good. If any write-operation timed-out,
+        a TimeoutError is thrown for the first failing operation. Its errors
+        attribute lists the errors of all the failing operations.
         """
-        if self.__lazy_stack == 0:
+        state = self.__state
+        if state.lazy_stack == 0:
             raise RuntimeError('No lazy section started')
-        self.__lazy_stack -= 1
-        last_error = None
-        if self.__lazy_stack == 0:
-            # We closes all update blocks, we must now check all responses of
-            # write requests.
-            for expected_size in self.__lazy_writes:
-                ack = self.ser.read(1)[0]
-                if ack != expected_size:
-                    # Timeout error !
-                    last_error = TimeoutError(size=ack)
-        self.__lazy_writes.clear()
-        if last_error is not None:
-            raise last_error
+        state.lazy_stack -= 1
+        if state.lazy_stack == 0:
+            # We closes all update blocks, we must now send the operations and
+            # check all responses.
+            self.__flush()
+
+    def record_program(self):
+        """
+        :return: :class:`ScaffoldBusProgram` to be used with the python
+            'with' statement. The bus operations issued in the with block are
+            not sent to the board but recorded in the program, which can then
+            be run many times. The recorded reads return
+            :class:`ScaffoldBusFuture` instances which are never resolved:
+            their data is returned by :meth:`ScaffoldBusProgram.run`. The
+            register caches are updated during the recording as if the
+            operations were executed. Writes are neither elided nor deferred
+            by transactions while recording, so that each one is part of the
+            program.
+        """
+        return ScaffoldBusProgram(self)
+
+    def _start_recording(self, program):
+        """ Called when entering the with block of a program recording. """
+        state = self.__state
+        if state.program is not None:
+            raise RuntimeError('A program is already being recorded')
+        if state.lazy_stack or len(state.lazy_ops):
+            raise RuntimeError('Bus is busy')
+        transaction = state.transaction
+        if (transaction is not None) and (not transaction.dry_run) and \
+                len(transaction.registers):
+            # The writes deferred before the recording are not part of the
+            # program.
+            transaction._send()
+        state.program = program
+        # The board timeout is unknown when the program runs: the first
+        # polling operation of the program must set it.
+        program.timeout = self.__board_timeout
+        self.__board_timeout = None
+        self.lazy_start()
+
+    def _stop_recording(self, program, commit):
+        """
+        Called when leaving the with block of a program recording.
+
+        :param commit: False if the recording is aborted.
+        """
+        state = self.__state
+        ops = state.lazy_ops
+        state.lazy_ops = []
+        state.lazy_stack -= 1
+        state.program = None
+        # Board timeout after a run of the program, and restore the one before
+        # the recording.
+        program.timeout, self.__board_timeout = \
+            self.__board_timeout, program.timeout
+        if commit:
+            program._compile(ops, [self.__datagram(op) for op in ops])
+
+    def _run_program(self, program):
+        """
+        Send the blob of a program and return the response of the board.
+
+        :param program: :class:`ScaffoldBusProgram` instance.
+        """
+        if self.__state.lazy_stack:
+            raise RuntimeError('Programs cannot run in lazy sections')
+        with self.__lock:
+            # The segments of the program are sized for an empty credit
+            # window: wait for the batches of the other threads.
+            while len(self.__inflight):
+                self.__complete_one()
+            res = self.__run_program(program)
+            if program.timeout is not None:
+                self.__board_timeout = program.timeout
+            return res
+
+    def __run_program(self, program):
+        """ Implementation of :meth:`_run_program`, with the bus locked. """
+        ser = self.ser
+        blob = program.blob
+        res = bytearray()
+        for blob_start, blob_end, res_start, res_end in program.segments:
+            size = res_end - res_start
+            deadline = self.__deadline(
+                blob_end - blob_start, size, program.polled)
+            if self.__reader is not None:
+                pending = self.__reader.expect(size)
+                ser.write(blob[blob_start:blob_end])
+                data = pending.wait(deadline)
+                if data is None:
+                    self.__stall(0, size)
+            else:
+                self.__arm(deadline)
+                ser.write(blob[blob_start:blob_end])
+                data = ser.read(size)
+                if len(data) != size:
+                    self.__stall(len(data), size)
+            if len(program.segments) == 1:
+                return data
+            res += data
+        return res
 
     def lazy_section(self):
         """
@@ -1463,6 +3913,59 @@ class ScaffoldBus:
         """
         return ScaffoldBusLazySection(self)
 
+    def transaction(self, states=(), dry_run=False):
+        """
+        :return: :class:`ScaffoldTransaction` to be used with the python
+            'with' statement. Register writes of the with block are collected
+            and only the registers which changed are written, in one batch,
+            before the next operation which is not deferred or when leaving
+            the block.
+        :param states: List of (get, set) functions of the host state
+            restored if the block raises an exception. See
+            :class:`ScaffoldTransaction`.
+        :param dry_run: If True, nothing is sent and the block is always
+            rolled back.
+        """
+        return ScaffoldTransaction(self, states, dry_run)
+
+    @property
+    def recording(self):
+        """
+        True if a program is being recorded by the calling thread. Read-only.
+        """
+        return self.__state.program is not None
+
+    @property
+    def current_transaction(self):
+        """
+        Outermost :class:`ScaffoldTransaction` open in the calling thread, or
+        None. Read-only.
+        """
+        return self.__state.transaction
+
+    def _start_transaction(self, transaction):
+        """
+        Called when entering a transaction.
+
+        :return: Outermost transaction.
+        """
+        state = self.__state
+        if transaction.dry_run:
+            # Suspends the open transaction until the dry run ends.
+            state.suspended.append(state.transaction)
+            state.transaction = transaction
+        elif state.transaction is None:
+            state.transaction = transaction
+        return state.transaction
+
+    def _end_transaction(self, transaction):
+        """ Called when leaving the outermost transaction. """
+        state = self.__state
+        if transaction.dry_run:
+            state.transaction = state.suspended.pop()
+        else:
+            state.transaction = None
+
 
 class IODir(Enum):
     """
@@ -1511,13 +4014,68 @@ class Scaffold:
     __ADDR_MTXR_BASE = 0xf100
     __ADDR_MTXL_BASE = 0xf000
 
-    def __init__(self, dev="/dev/scaffold"):
+    # FPGA left matrix input signals
+    mtxl_in = (
+        ('0', '1', '/io/a0', '/io/a1', '/io/b0', '/io/b1', '/io/c0', '/io/c1')
+        + tuple(f'/io/d{i}' for i in range(__IO_D_COUNT)))
+
+    # FPGA left matrix output signals
+    mtxl_out = (
+        tuple(f'/uart{i}/rx' for i in range(__UART_COUNT))
+        + ('/iso7816/io_in',)
+        + tuple(f'/pgen{i}/start' for i in range(__PULSE_GENERATOR_COUNT))
+        + tuple(f'/i2c{i}/{name}' for i in range(__I2C_COUNT)
+            for name in ('sda_in', 'scl_in')))
+
+    # FPGA right matrix input signals
+    mtxr_in = (
+        ('z', '0', '1', '/power/dut_trigger', '/power/platform_trigger')
+        + tuple(f'/uart{i}/{name}' for i in range(__UART_COUNT)
+            for name in ('tx', 'trigger'))
+        + ('/iso7816/io_out', '/iso7816/clk', '/iso7816/trigger')
+        + tuple(f'/pgen{i}/out' for i in range(__PULSE_GENERATOR_COUNT))
+        + tuple(f'/i2c{i}/{name}' for i in range(__I2C_COUNT)
+            for name in ('sda_out', 'scl_out', 'trigger')))
+
+    # FPGA right matrix output signals
+    mtxr_out = (
+        ('/io/a0', '/io/a1', '/io/b0', '/io/b1', '/io/c0', '/io/c1')
+        + tuple(f'/io/d{i}' for i in range(__IO_D_COUNT)))
+
+    # Positions of the signals in the matrices, by path.
+    __MTXL_IN_INDEX = dict((path, i) for i, path in enumerate(mtxl_in))
+    __MTXL_OUT_INDEX = dict((path, i) for i, path in enumerate(mtxl_out))
+    __MTXR_IN_INDEX = dict((path, i) for i, path in enumerate(mtxr_in))
+    __MTXR_OUT_INDEX = dict((path, i) for i, path in enumerate(mtxr_out))
+
+    # Peripherals reset when connecting, with the name of their reset method.
+    __RESETS = dict(
+        [(f'uart{i}', 'reset') for i in range(__UART_COUNT)]
+        + [('leds', 'reset'), ('iso7816', 'reset_config')]
+        + [(f'i2c{i}', 'reset_config') for i in range(__I2C_COUNT)])
+
+    # Constructors of the modules and I/Os created on first access, by
+    # attribute name. Built once by __get_factories.
+    __factories = None
+    __factories_lock = threading.RLock()
+
+    def __init__(
+            self, dev="/dev/scaffold", full_duplex=False, transport='serial',
+            low_latency=False):
         """
         Create Scaffold API instance.
 
         :param dev: If specified, connect to the hardware Scaffold board using
             the given serial device. If None, call connect method later to
             establish the communication.
+        :param full_duplex: If True, use a background thread to receive the
+            responses of the board. See :meth:`ScaffoldBus.connect`.
+        :param transport: Transport backend: 'serial', 'raw' or 'tcp'. See
+            :meth:`ScaffoldBus.connect`.
+        :param low_latency: If True, tune the transport for low latency. See
+            :meth:`connect`.
+
+        The modules and I/Os are created on first access.
         """
         # Hardware version module
         # There is no need to expose it.
@@ -1525,51 +4083,10 @@ class Scaffold:
         # Cache the version string once read
         self.__version_string = None
 
-        # Power module
-        self.power = Power(self)
-        # Leds module
-        self.leds = LEDs(self)
-
-        # Create the IO signals
-        self.a0 = IO(self, '/io/a0', 0)
-        self.a1 = IO(self, '/io/a1', 1)
-        self.b0 = IO(self, '/io/b0', 2)
-        self.b1 = IO(self, '/io/b1', 3)
-        self.c0 = IO(self, '/io/c0', 4)
-        self.c1 = IO(self, '/io/c1', 5)
-        for i in range(self.__IO_D_COUNT):
-            self.__setattr__(f'd{i}', IO(self, f'/io/d{i}', 6+i))
-
-        # Create the UART modules
-        self.uarts = []
-        for i in range(self.__UART_COUNT):
-            uart = UART(self, i)
-            self.uarts.append(uart)
-            self.__setattr__(f'uart{i}', uart)
-
-        # Create the pulse generator modules
-        self.pgens = []
-        for i in range(self.__PULSE_GENERATOR_COUNT):
-            pgen = PulseGenerator(self, i)
-            self.pgens.append(pgen)
-            self.__setattr__(f'pgen{i}', pgen)
-
-        # Declare the I2C peripherals
-        self.i2cs = []
-        for i in range(self.__I2C_COUNT):
-            i2c = I2C(self, i)
-            self.i2cs.append(i2c)
-            self.__setattr__(f'i2c{i}', i2c)
-
-        # Create the ISO7816 module
-        self.iso7816 = ISO7816(self)
-
         # Low-level management
         # Set as an attribute to avoid having all low level routines visible in
         # the higher API Scaffold class.
         self.bus = ScaffoldBus()
-        if dev is not None:
-            self.connect(dev)
 
         # Timeout value. This value can't be read from the board, so we cache
         # it there once set.
@@ -1578,72 +4095,147 @@ class Scaffold:
         # Timeout stack for push_timeout and pop_timeout methods.
         self.__timeout_stack = []
 
-        # FPGA left matrix input signals
-        self.mtxl_in = [
-            '0', '1', '/io/a0', '/io/a1', '/io/b0', '/io/b1', '/io/c0',
-            '/io/c1']
-        self.mtxl_in += list(f'/io/d{i}' for i in range(self.__IO_D_COUNT))
-
-        # FPGA left matrix output signals
-        self.mtxl_out = []
-        for i in range(self.__UART_COUNT):
-            self.mtxl_out.append(f'/uart{i}/rx')
-        self.mtxl_out.append('/iso7816/io_in')
-        for i in range(self.__PULSE_GENERATOR_COUNT):
-            self.mtxl_out.append(f'/pgen{i}/start')
-        for i in range(self.__I2C_COUNT):
-            self.mtxl_out.append(f'/i2c{i}/sda_in')
-            self.mtxl_out.append(f'/i2c{i}/scl_in')
+        # Sources of the matrix outputs set during this session, by
+        # destination path. The matrix can't be read from the board.
+        self.__routes = {}
 
-        # FPGA right matrix input signals
-        self.mtxr_in = [
-            'z', '0', '1', '/power/dut_trigger', '/power/platform_trigger']
-        for i in range(self.__UART_COUNT):
-            self.mtxr_in += [
-                f'/uart{i}/tx',
-                f'/uart{i}/trigger']
-        self.mtxr_in += [
-            '/iso7816/io_out',
-            '/iso7816/clk',
-            '/iso7816/trigger']
-        self.mtxr_in += list(
-            f'/pgen{i}/out' for i in range(self.__PULSE_GENERATOR_COUNT))
-        for i in range(self.__I2C_COUNT):
-            self.mtxr_in += [
-                f'/i2c{i}/sda_out',
-                f'/i2c{i}/scl_out',
-                f'/i2c{i}/trigger']
-
-        # FPGA right matrix output signals
-        self.mtxr_out = [
-            '/io/a0',
-            '/io/a1',
-            '/io/b0',
-            '/io/b1',
-            '/io/c0',
-            '/io/c1']
-        self.mtxr_out += list(f'/io/d{i}' for i in range(self.__IO_D_COUNT))
-
-    def connect(self, dev):
+        if dev is not None:
+            self.connect(dev, full_duplex, transport, low_latency)
+
+    @classmethod
+    def __get_factories(cls):
+        """
+        :return: dict of the functions creating the modules and I/Os, by
+            attribute name. Built on first call.
+        """
+        factories = Scaffold.__factories
+        if factories is not None:
+            return factories
+        factories = {'power': Power, 'leds': LEDs, 'iso7816': ISO7816}
+        ios = ('a0', 'a1', 'b0', 'b1', 'c0', 'c1') + tuple(
+            f'd{i}' for i in range(cls.__IO_D_COUNT))
+        for index, name in enumerate(ios):
+            factories[name] = (lambda scaffold, path=f'/io/{name}',
+                index=index: IO(scaffold, path, index))
+        for attr, module_class, count in (
+                ('uart', UART, cls.__UART_COUNT),
+                ('pgen', PulseGenerator, cls.__PULSE_GENERATOR_COUNT),
+                ('i2c', I2C, cls.__I2C_COUNT)):
+            names = tuple(f'{attr}{i}' for i in range(count))
+            for i, name in enumerate(names):
+                factories[name] = (lambda scaffold, module_class=module_class,
+                    i=i: module_class(scaffold, i))
+            factories[attr + 's'] = (lambda scaffold, names=names:
+                list(getattr(scaffold, name) for name in names))
+        Scaffold.__factories = factories
+        return factories
+
+    def __getattr__(self, name):
+        """
+        Create a module or an I/O on first access. It is then stored as a
+        regular attribute of the instance.
+        """
+        factory = self.__get_factories().get(name)
+        if factory is None:
+            raise AttributeError(
+                f'{type(self).__name__!r} object has no attribute {name!r}')
+        with Scaffold.__factories_lock:
+            item = self.__dict__.get(name)
+            if item is None:
+                item = factory(self)
+                setattr(self, name, item)
+        return item
+
+    def __dir__(self):
+        return list(super().__dir__()) + list(
+            name for name in self.__get_factories() if name not in
+            self.__dict__)
+
+    def connect(
+            self, dev, full_duplex=False, transport='serial',
+            low_latency=False, reset=True, resume=None, verify=False):
         """
         Connect to Scaffold board using the given serial port.
         :param dev: Serial port device path. For instance '/dev/ttyUSB0' on
-            linux, 'COM0' on Windows.
-        """
-        self.bus.connect(dev)
+            linux, 'COM0' on Windows. See :meth:`ScaffoldBus.connect` for the
+            other transports.
+        :param full_duplex: If True, use a background thread to receive the
+            responses of the board. See :meth:`ScaffoldBus.connect`.
+        :param transport: Transport backend: 'serial', 'raw' or 'tcp'. See
+            :meth:`ScaffoldBus.connect`.
+        :param low_latency: If True, tune the transport for low latency and
+            measure the achieved round-trip time, available in the
+            :attr:`latency` attribute. See :meth:`ScaffoldBus.connect`.
+        :param reset: If False, the peripherals are not reset to their default
+            configuration. This is used when the board is already configured,
+            for instance by :class:`scaffold.daemon.ScaffoldDaemon`. A list of
+            peripheral names can be given to reset only those peripherals, see
+            :meth:`reset_peripherals`. The reset is sent in a single batch.
+        :param resume: State saved by :meth:`get_state` or :meth:`save_state`,
+            as a dict or a file path. The host caches are restored from this
+            state instead of resetting the peripherals, so a script can
+            reattach to a board left configured by a previous run.
+        :param verify: If True and resume is set, read back all the readable
+            cached registers in a single batch to check the board matches the
+            resumed state. See :meth:`verify_state`.
+        """
+        self.bus.connect(dev, full_duplex, transport, low_latency)
         # Check hardware responds and has the correct version.
         self.__version_string = self.__version_module.get_string()
         if self.__version_string != 'scaffold-0.2':
             raise RuntimeError(
                 'Invalid hardware version \'' + self.__version_string + '\'')
-        # Reset to a default configuration
-        self.timeout = 0
-        for uart in self.uarts:
-            uart.reset()
-        self.leds.reset()
-        self.iso7816.reset_config()
-        for i2c in self.i2cs:
-            i2c.reset_config()
+        # The routes known from a previous connection may be wrong.
+        self.__routes = {}
+        if resume is not None:
+            if isinstance(resume, str):
+                resume = self.load_state(resume)
+            self.set_state(resume)
+            if verify:
+                self.verify_state()
+        elif reset:
+            self.timeout = 0
+            self.reset_peripherals(None if reset is True else reset)
+        if low_latency:
+            self.measure_latency()
+
+    def reset_peripherals(self, names=None):
+        """
+        Reset peripherals to their default configuration. All the register
+        writes are sent in a single batch, and their acknowledgements are
+        checked together.
+
+        :param names: Attribute names of the peripherals to be reset, such as
+            ['uart0', 'iso7816']. None resets the UARTs, the LEDs, the ISO7816
+            and the I2C peripherals.
+        :raises ValueError: if a peripheral cannot be reset.
+        """
+        if names is None:
+            names = self.__RESETS
+        for name in names:
+            if name not in self.__RESETS:
+                raise ValueError(f'Peripheral {name} cannot be reset')
+        with self.lazy_section():
+            for name in names:
+                getattr(getattr(self, name), self.__RESETS[name])()
+
+    def measure_latency(self, count=32):
+        """
+        Measure the round-trip time of the bus. See
+        :meth:`ScaffoldBus.measure_latency`.
+
+        :param count: Number of reads. Must be at least 1.
+        :return: Median round-trip time, in seconds.
+        """
+        return self.bus.measure_latency(self.uart0.reg_status.address, count)
+
+    @property
+    def latency(self):
+        """
+        Last measured round-trip time of the bus, in seconds, or None if it has
+        not been measured. Read-only.
+        """
+        return self.bus.latency
 
     @property
     def version(self):
@@ -1659,11 +4251,13 @@ class Scaffold:
     def __signal_to_path(self, signal):
         """
         Convert a signal, 0, 1 or None to a path. Verify the signal belongs to
-        the current Scaffold instance.
-        :param signal: Signal, 0, 1 or None.
+        the current Scaffold instance. Paths are returned as is.
+        :param signal: Signal, path, 0, 1 or None.
         :return: Path string.
         """
-        if isinstance(signal, Signal):
+        if isinstance(signal, str):
+            return signal
+        elif isinstance(signal, Signal):
             if signal.parent != self:
                 raise ValueError('Signal belongs to another Scaffold instance')
             return signal.path
@@ -1679,24 +4273,72 @@ class Scaffold:
             raise ValueError('Invalid signal type')
 
     def sig_connect(self, a, b):
+        """
+        Connect two signals through the routing matrix.
+
+        :param a: Destination :class:`Signal` or path.
+        :param b: Source :class:`Signal`, path, 0, 1 or None for high
+            impedance.
+        :raises ValueError: if the signals cannot be connected.
+        """
+        self._set_route(*self._route(a, b))
+
+    def _route(self, a, b):
+        """
+        Resolve a connection of the routing matrix. See :meth:`sig_connect`.
+
+        :return: Tuple (destination path, source path, register address,
+            source index).
+        :raises ValueError: if the signals cannot be connected.
+        """
         # Check both signals belongs to the current board instance
         # Convert signals to path names
         dest_path = self.__signal_to_path(a)
         src_path = self.__signal_to_path(b)
-
-        if dest_path in self.mtxr_out:
+        dst_index = self.__MTXR_OUT_INDEX.get(dest_path)
+        if dst_index is not None:
             # Connect a module output to an IO output
-            src_index = self.mtxr_in.index(src_path)
-            dst_index = self.mtxr_out.index(dest_path)
-            self.bus.write(self.__ADDR_MTXR_BASE + dst_index, src_index)
-        elif dest_path in self.mtxl_out:
-            # Connect a module input to an IO input (or 0 or 1).
-            src_index = self.mtxl_in.index(src_path)
-            dst_index = self.mtxl_out.index(dest_path)
-            self.bus.write(self.__ADDR_MTXL_BASE + dst_index, src_index)
+            address = self.__ADDR_MTXR_BASE + dst_index
+            src_index = self.__MTXR_IN_INDEX.get(src_path)
         else:
-            # Shall never happen unless there is a bug
-            raise RuntimeError(f'Invalid destination path \'{dest_path}\'')
+            # Connect a module input to an IO input (or 0 or 1).
+            dst_index = self.__MTXL_OUT_INDEX.get(dest_path)
+            if dst_index is None:
+                raise ValueError(f'Invalid destination path \'{dest_path}\'')
+            address = self.__ADDR_MTXL_BASE + dst_index
+            src_index = self.__MTXL_IN_INDEX.get(src_path)
+        if src_index is None:
+            raise ValueError(
+                f'Cannot connect \'{src_path}\' to \'{dest_path}\'')
+        return dest_path, src_path, address, src_index
+
+    def _set_route(self, dest_path, src_path, address, src_index):
+        """
+        Write a connection resolved by :meth:`_route` in the matrix.
+        """
+        self.bus.write(address, src_index)
+        self.__routes[dest_path] = src_path
+
+    @property
+    def routes(self):
+        """
+        dict of the sources of the matrix outputs known by the host, by
+        destination path, for instance {'/io/d0': '/uart0/tx'}. Only the
+        connections made during the session, or restored by
+        :meth:`set_state`, are known. Read-only copy.
+        """
+        return dict(self.__routes)
+
+    def routing_plan(self, routes=None):
+        """
+        :return: New :class:`RoutingPlan`, applying many connections of the
+            routing matrix in a single batch. Can be used with the python
+            'with' statement.
+
+        :param routes: Optional dict of connections, mapping destinations to
+            sources. See :meth:`RoutingPlan.connect`.
+        """
+        return RoutingPlan(self, routes)
 
     @property
     def timeout(self):
@@ -1705,7 +4347,7 @@ class Scaffold:
         disabled.
         """
         if self.__cache_timeout is None:
-            return RuntimeError('Timeout not set yet')
+            raise RuntimeError('Timeout not set yet')
         return self.__cache_timeout * self.__TIMEOUT_UNIT
 
     @timeout.setter
@@ -1714,6 +4356,21 @@ class Scaffold:
         self.bus.set_timeout(n)  # May throw is n out of range.
         self.__cache_timeout = n  # Must be after set_timeout
 
+    def timeout_scope(self, value):
+        """
+        :return: :class:`TimeoutScope` to be used with the python 'with'
+            statement. The timeout is set when entering the with block, and
+            the previous timeout is restored when leaving it. Since the board
+            is only updated before polling operations (see
+            :meth:`ScaffoldBus.set_timeout`), a scope costs no command when
+            the timeout is unchanged, and consecutive or nested scopes cost at
+            most one command at each boundary. Scopes can be used in lazy
+            sections.
+
+        :param value: Timeout value in seconds.
+        """
+        return TimeoutScope(self, value)
+
     def push_timeout(self, value):
         """
         Save previous timeout setting in a stack, and set a new timeout value.
@@ -1721,7 +4378,9 @@ class Scaffold:
 
         :param value: New timeout value, in seconds.
         """
-        self.__timeout_stack.append(self.timeout)
+        # The register value is saved, so restoring it gives the exact same
+        # value.
+        self.__timeout_stack.append(self.__cache_timeout)
         self.timeout = value
 
     def pop_timeout(self):
@@ -1732,11 +4391,340 @@ class Scaffold:
         """
         if len(self.__timeout_stack) == 0:
             raise RuntimeError('Timeout setting stack is empty')
-        self.timeout = self.__timeout_stack.pop()
+        n = self.__timeout_stack.pop()
+        if n is not None:
+            self.bus.set_timeout(n)
+            self.__cache_timeout = n
 
     def lazy_section(self):
         """
         :return: ScaffoldBusLazySection to be used with the python 'with'
-            tatement to start and close a lazy update section.
+            tatement to start and close a lazy update section. All bus
+            operations of the section are sent at once when leaving it. Reads
+            return :class:`ScaffoldBusFuture` instances resolved at that time.
         """
         return self.bus.lazy_section()
+
+    def transaction(self, dry_run=False):
+        """
+        :return: :class:`ScaffoldTransaction` to be used with the python
+            'with' statement. Register writes of the block are collected, and
+            only the registers which value changed are written, in a single
+            batch, before the next operation which is not deferred or when
+            leaving the block. If the block raises an exception, the host
+            state of the modules (see :meth:`Module._get_state`) is restored
+            too. The connections of the routing matrix are not deferred. See
+            :meth:`ScaffoldBus.transaction`.
+
+        :param dry_run: If True, nothing is sent and the block is always
+            rolled back. See :class:`ScaffoldTransaction`.
+        """
+        states = list((item._get_state, item._set_state)
+            for name, item in vars(self).items()
+            if (not name.startswith('_')) and isinstance(item, Module) and
+            (type(item)._get_state is not Module._get_state))
+        return self.bus.transaction(states, dry_run)
+
+    def record_program(self):
+        """
+        :return: :class:`ScaffoldBusProgram` recording the bus operations of
+            a with block, to be replayed many times with a single serial
+            write and read per run. See :meth:`ScaffoldBus.record_program`.
+        """
+        return self.bus.record_program()
+
+    def snapshot(self, registers=None, record=False):
+        """
+        Read many registers at once. All the read commands are sent with a
+        single serial write, and all the responses are fetched with a single
+        serial read.
+
+        :param registers: Registers to be read. Either a dict mapping names to
+            :class:`Register` instances, or a list of register paths relative
+            to this instance, such as 'uart0.reg_status' or 'a0.reg_event'.
+            By default, the status registers of all the peripherals, the I/O
+            value and event registers and the power control register are
+            read.
+        :param record: If True, return a NumPy structured record instead of a
+            dict. Requires NumPy.
+        :return: dict mapping names to register values, or NumPy record with
+            one uint8 field per register.
+        """
+        if registers is None:
+            registers = self.__snapshot_default_registers()
+        if not isinstance(registers, dict):
+            registers = dict((path, self.__register_from_path(path))
+                for path in registers)
+        with self.lazy_section():
+            futures = list(reg.read() for reg in registers.values())
+        values = list(f[0] for f in futures)
+        if record:
+            import numpy
+            dtype = numpy.dtype(list((name, 'u1') for name in registers))
+            return numpy.array(tuple(values), dtype=dtype)[()]
+        return dict(zip(registers, values))
+
+    def registers(self):
+        """
+        :return: dict of all the :class:`Register` instances of the modules
+            and I/Os, indexed by path such as 'uart0.reg_divisor'. All the
+            modules and I/Os are created.
+        """
+        for name in self.__get_factories():
+            getattr(self, name)
+        result = {}
+        seen = set()
+        for name, item in vars(self).items():
+            if name.startswith('_') or \
+                    (not isinstance(item, (Module, Signal))):
+                continue
+            for attr, register in vars(item).items():
+                if isinstance(register, Register) and \
+                        (id(register) not in seen):
+                    seen.add(id(register))
+                    result[f'{name}.{attr}'] = register
+        return result
+
+    def get_state(self):
+        """
+        Capture the state of the board known by the host: register caches,
+        routing matrix, settings derived from the registers (baudrates,
+        frequencies) and timeout. The board is not accessed. The state can be
+        restored later with :meth:`set_state` or when connecting, with the
+        resume parameter of :meth:`connect`.
+
+        Only the values set during the session are known: the caches of
+        volatile registers are not saved, unless they are host authoritative,
+        and the routes are the ones set with :meth:`sig_connect`.
+
+        :return: JSON serializable dict.
+        """
+        registers = {}
+        for path, register in self.registers().items():
+            if (register.cache is not None) and \
+                    ((not register.volatile) or register.host_authoritative):
+                registers[path] = register.cache
+        modules = {}
+        for name, item in vars(self).items():
+            if (not name.startswith('_')) and isinstance(item, Module):
+                module_state = item._get_state()
+                if len(module_state):
+                    modules[name] = module_state
+        return {
+            'version': self.__version_string,
+            'registers': registers,
+            'modules': modules,
+            'routes': dict(self.__routes),
+            'timeout': self.__cache_timeout}
+
+    def set_state(self, state):
+        """
+        Restore the host caches from a state returned by :meth:`get_state`.
+        The board is not accessed: it must already be in this state. The
+        timeout is sent to the board again before the next polling operation.
+
+        :param state: dict returned by :meth:`get_state`.
+        :raises ValueError: if the state does not match this instance.
+        """
+        version = state.get('version')
+        if (version is not None) and (self.__version_string is not None) \
+                and (version != self.__version_string):
+            raise ValueError(f'State saved for hardware version {version}')
+        registers = self.registers()
+        for path in state['registers']:
+            if path not in registers:
+                raise ValueError(f'Unknown register {path}')
+        for path in state['routes']:
+            if (path not in self.__MTXR_OUT_INDEX) and \
+                    (path not in self.__MTXL_OUT_INDEX):
+                raise ValueError(f'Invalid destination path \'{path}\'')
+        for path, value in state['registers'].items():
+            registers[path].cache = value
+        for name, module_state in state['modules'].items():
+            getattr(self, name)._set_state(module_state)
+        self.__routes = dict(state['routes'])
+        n = state['timeout']
+        if n is not None:
+            self.bus.set_timeout(n)
+            self.__cache_timeout = n
+
+    def verify_state(self):
+        """
+        Read back all the readable registers which value is cached, in a
+        single batch, and compare them to the cache. Host authoritative
+        registers are included, other volatile registers are not.
+
+        :raises RuntimeError: if a register does not match its cache.
+        """
+        registers = dict((path, register)
+            for path, register in self.registers().items()
+            if register.readable and (register.cache is not None) and
+            ((not register.volatile) or register.host_authoritative))
+        with self.lazy_section():
+            futures = list(reg.read() for reg in registers.values())
+        mismatches = list(path
+            for (path, register), future in zip(registers.items(), futures)
+            if future[0] != register.cache)
+        if len(mismatches):
+            raise RuntimeError(
+                'Board does not match the resumed state: '
+                + ', '.join(mismatches))
+
+    def save_state(self, path):
+        """
+        Save the state returned by :meth:`get_state` in a JSON file.
+
+        :param path: File path.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.get_state(), f, indent=2)
+
+    @staticmethod
+    def load_state(path):
+        """
+        :return: State saved with :meth:`save_state`.
+        :param path: File path.
+        """
+        with open(path) as f:
+            return json.load(f)
+
+    def get_profile(self):
+        """
+        Export the configuration of the board known by the host as a profile,
+        which can be applied later with :meth:`apply_profile`. The profile is
+        a dict with the following keys, all optional:
+
+        - 'timeout': Timeout in seconds.
+        - 'routes': Connections of the routing matrix, as a dict mapping
+          destination paths to source paths, see :attr:`routes`.
+        - A peripheral name, such as 'uart0', 'pgen1', 'iso7816', 'i2c0',
+          'leds' or 'power': dict of the settings of the peripheral, named
+          after their attributes, for instance {'baudrate': 115200}. Enum
+          values are given by name. The mode of the LEDs is set by the
+          'modes' setting of 'leds', for instance {'a0': 'VALUE'}.
+
+        Only the peripherals used during the session are exported, and
+        settings unknown by the host are omitted. The power state is read
+        from the board.
+
+        :return: dict which can be saved as JSON or YAML.
+        """
+        profile = {}
+        if self.__cache_timeout is not None:
+            profile['timeout'] = self.timeout
+        if len(self.__routes):
+            profile['routes'] = self.routes
+        for name, item in list(vars(self).items()):
+            if (not name.startswith('_')) and isinstance(item, Module):
+                module_profile = item._get_profile()
+                if len(module_profile):
+                    profile[name] = module_profile
+        return profile
+
+    def apply_profile(self, profile):
+        """
+        Configure the board as described by a profile, see
+        :meth:`get_profile`. The profile is compared to the state known by
+        the host, and only the registers and connections which change are
+        written, in a single batch. The whole profile is checked before
+        sending anything: if a setting is invalid, the board and the state
+        known by the host are left unchanged.
+
+        The power control register is written each time, unless it is host
+        authoritative (see :attr:`Register.host_authoritative`).
+
+        :param profile: dict describing the board configuration.
+        :raises ValueError: if the profile is invalid.
+        """
+        profile = dict(profile)
+        timeout = profile.pop('timeout', None)
+        if (timeout is not None) and \
+                not (0 <= int(timeout / self.__TIMEOUT_UNIT) <= 0xffffffff):
+            raise ValueError('Timeout value out of range')
+        plan = self.routing_plan(profile.pop('routes', None))
+        modules = []
+        for name, module_profile in profile.items():
+            module = None
+            if not name.startswith('_'):
+                module = getattr(self, name, None)
+            if not isinstance(module, Module):
+                raise ValueError(f'Unknown peripheral \'{name}\'')
+            modules.append((module, module._check_profile(module_profile)))
+        # Values such as baudrates are checked by the setters: they are tried
+        # first without sending anything.
+        with self.transaction(dry_run=True):
+            for module, module_profile in modules:
+                module._apply_profile(module_profile)
+        # The lazy section encloses the transaction, so that the writes which
+        # are not deferred, such as the power control register, and the
+        # deferred writes sent when leaving the transaction are queued in the
+        # same batch.
+        with self.bus.lazy_section(), self.transaction():
+            for module, module_profile in modules:
+                module._apply_profile(module_profile)
+            plan.apply()
+            if (timeout is not None) and ((self.__cache_timeout is None) or
+                    (timeout != self.timeout)):
+                self.timeout = timeout
+
+    def save_profile(self, path):
+        """
+        Save the profile returned by :meth:`get_profile` in a file. The file
+        is written in YAML if its name ends with '.yaml' or '.yml', which
+        requires PyYAML, and in JSON otherwise.
+
+        :param path: File path.
+        """
+        profile = self.get_profile()
+        with open(path, 'w') as f:
+            if path.endswith(('.yaml', '.yml')):
+                import yaml
+                yaml.safe_dump(profile, f, sort_keys=False)
+            else:
+                json.dump(profile, f, indent=2)
+
+    @staticmethod
+    def load_profile(path):
+        """
+        :return: Profile loaded from a YAML or JSON file, see
+            :meth:`save_profile`.
+        :param path: File path.
+        """
+        with open(path) as f:
+            if path.endswith(('.yaml', '.yml')):
+                import yaml
+                return yaml.safe_load(f)
+            return json.load(f)
+
+    def __register_from_path(self, path):
+        """
+        :return: Register of this instance designated by a path.
+        :param path: Attribute path, such as 'uart0.reg_status'.
+        """
+        obj = self
+        for name in path.split('.'):
+            obj = getattr(obj, name)
+        if not isinstance(obj, Register):
+            raise ValueError(f'{path} is not a register')
+        return obj
+
+    def __snapshot_default_registers(self):
+        """
+        :return: List of the register paths read by :meth:`snapshot` by
+            default.
+        """
+        paths = []
+        for i in range(self.__UART_COUNT):
+            paths.append(f'uart{i}.reg_status')
+        paths.append('iso7816.reg_status')
+        for i in range(self.__I2C_COUNT):
+            paths.append(f'i2c{i}.reg_status')
+        for i in range(self.__PULSE_GENERATOR_COUNT):
+            paths.append(f'pgen{i}.reg_status')
+        # One value and event register per group of 8 I/Os. The first I/O of
+        # each group gives access to the registers of the group.
+        ios = ['a0'] + list(f'd{i}' for i in range(2, self.__IO_D_COUNT, 8))
+        for io in ios:
+            paths += [f'{io}.reg_value', f'{io}.reg_event']
+        paths.append('power.reg_control')
+        return paths
@@ -0,0 +1,469 @@
+# This file is part of Scaffold
+#
+# Scaffold is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2019 Ledger SAS, written by Olivier Hériveaux
+
+
+import os
+import socket
+import select
+import argparse
+from collections import deque
+from . import Scaffold, ScaffoldBus
+from .transport import UnixSocketTransport
+
+
+# Default path of the daemon socket.
+SOCKET_PATH = '/tmp/scaffold.sock'
+# Command answered by the daemon itself with the last value written to each
+# register address. Not a board command.
+CMD_STATE = 0xf0
+# Number of bytes of the last write to an address kept by the daemon. This is
+# the wideness of the widest register.
+SHADOW_SIZE = 3
+
+
+def parse_datagram(buf, pos):
+    """
+    Decode the header of a bus command.
+
+    :param buf: Received bytes.
+    :param pos: Position of the command in buf.
+    :return: None if the command is incomplete. Otherwise a tuple (length,
+        response size, polling, may stall), where length is the number of
+        bytes of the command.
+    :raises ValueError: If the command byte is invalid.
+    """
+    cmd = buf[pos]
+    if cmd == 0x08:
+        return (5, 0, False, False) if len(buf) - pos >= 5 else None
+    if cmd == CMD_STATE:
+        return (1, 0, False, False)
+    if cmd > 7:
+        raise ValueError(f'Invalid command 0x{cmd:02x}')
+    length = 3
+    if cmd & 4:
+        length += 4
+    if cmd & 2:
+        length += 1
+    if len(buf) - pos < length:
+        return None
+    size = buf[pos + length - 1] if cmd & 2 else 1
+    if cmd & 1:
+        length += size
+        if len(buf) - pos < length:
+            return None
+        return (length, 1, bool(cmd & 4), bool(cmd & 4))
+    # Same rule as ScaffoldBus.may_stall
+    return (length, size + 1, bool(cmd & 4), bool(cmd & 4) or (size > 3))
+
+
+class DaemonClient:
+    """ Connection of a client to a :class:`ScaffoldDaemon`. """
+    def __init__(self, sock):
+        """
+        :param sock: Connected socket.
+        """
+        self.sock = sock
+        sock.setblocking(False)
+        # Received bytes not forming a complete command yet.
+        self.input = bytearray()
+        # Responses not sent yet.
+        self.output = bytearray()
+        # Polling timeout requested by the client. Clients start with a
+        # disabled timeout, like a newly connected bus.
+        self.timeout = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class ScaffoldDaemon:
+    """
+    Owns a Scaffold board and shares it between many processes through a Unix
+    socket. The board is connected and reset once, when the daemon starts.
+    Clients then speak the bus protocol over the socket, usually through
+    :class:`ScaffoldClient`, and start without paying the connection and reset
+    sequence.
+
+    The commands of all the clients are pipelined onto the serial link: each
+    loop iteration sends the commands received from every client in a single
+    write, and the responses of the board are routed back to their clients in
+    order. The commands of a client are sent atomically and in order, but may
+    be interleaved with the commands of other clients. As in
+    :class:`scaffold.ScaffoldBus`, the commands which may stall the bus bridge
+    are only sent when the input FIFO of the bridge can receive them.
+
+    The polling timeout is kept per client: the daemon sends a timeout
+    command only before a polling command of a client whose timeout differs
+    from the current board setting. The board setting is unknown when the
+    daemon starts, so the first polling command is always preceded by a
+    timeout command.
+
+    The daemon also keeps the last value written to each register address, so
+    the clients can restore the caches of the write-only registers.
+    """
+    def __init__(
+            self, dev='/dev/scaffold', path=SOCKET_PATH, transport='serial',
+            low_latency=False):
+        """
+        :param dev: Board device, see :class:`scaffold.Scaffold`.
+        :param path: Path of the Unix socket to be created. An existing file
+            at this path is removed.
+        :param transport: Board transport backend, see
+            :func:`scaffold.transport.open_transport`.
+        :param low_latency: If True, tune the board transport for low latency.
+        """
+        self.scaffold = Scaffold(dev, transport=transport,
+            low_latency=low_latency)
+        self.ser = self.scaffold.bus.ser
+        self.path = path
+        # Last bytes written to each address.
+        self.shadow = {}
+        for register in self.scaffold.registers().values():
+            if (register.cache is not None) and not register.volatile:
+                self.shadow[register.address] = register.cache.to_bytes(
+                    register.wideness, 'big', signed=False)
+        # Polling timeout currently set in the board, or None if unknown: the
+        # timeout is not sent when connecting, so a previous session may have
+        # left any value.
+        self.__timeout = None
+        # Commands received and not sent yet: (client, command bytes,
+        # response size, polling, may stall, polling timeout).
+        self.__pending = deque()
+        # Sent commands awaiting for their response: [client, command size,
+        # remaining response size, may stall, shadow update]. The command
+        # size includes the timeout command sent before it, if any. The
+        # shadow update is (address, data, size) for writes, applied when the
+        # write is acknowledged, or None. Entries with no remaining response
+        # are CMD_STATE commands, answered when they reach the head.
+        self.__inflight = deque()
+        self.__inflight_bytes = 0
+        self.__inflight_stalls = 0
+        self.clients = []
+        # Number of writes to the board and of forwarded commands, to monitor
+        # the batching efficiency.
+        self.writes = 0
+        self.commands = 0
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.__stop_r, self.__stop_w = os.pipe()
+        self.__running = False
+
+    def serve_forever(self):
+        """
+        Serve the clients until :meth:`stop` is called. This is a single
+        threaded select loop.
+        """
+        self.__running = True
+        ser_fd = self.ser.fileno()
+        while self.__running:
+            rlist = [self.listener, ser_fd, self.__stop_r] + self.clients
+            wlist = [c for c in self.clients if len(c.output)]
+            r, w, _ = select.select(rlist, wlist, [])
+            if ser_fd in r:
+                self.__receive()
+            if self.listener in r:
+                sock, _ = self.listener.accept()
+                self.clients.append(DaemonClient(sock))
+            for client in r:
+                if isinstance(client, DaemonClient):
+                    self.__read_client(client)
+            self.__pump()
+            for client in w:
+                self.__write_client(client)
+            if self.__stop_r in r:
+                os.read(self.__stop_r, 64)
+
+    def stop(self):
+        """ Stop :meth:`serve_forever`. Can be called from another thread. """
+        self.__running = False
+        os.write(self.__stop_w, b'\0')
+
+    def close(self):
+        """ Disconnect the clients and the board, and remove the socket. """
+        for client in self.clients:
+            client.sock.close()
+        self.clients = []
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.close(self.__stop_r)
+        os.close(self.__stop_w)
+        self.ser.close()
+
+    def __drop(self, client):
+        """ Close the connection of a client. """
+        client.closed = True
+        client.sock.close()
+        self.clients.remove(client)
+
+    def __read_client(self, client):
+        """ Receive and decode the commands of a client. """
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.__drop(client)
+            return
+        buf = client.input
+        buf += data
+        pos = 0
+        while pos < len(buf):
+            try:
+                header = parse_datagram(buf, pos)
+            except ValueError:
+                self.__drop(client)
+                return
+            if header is None:
+                break
+            length, size, polling, stalls = header
+            cmd = buf[pos]
+            if cmd == 0x08:
+                client.timeout = int.from_bytes(buf[pos + 1:pos + 5], 'big')
+            else:
+                # The timeout is the one set when the command was received,
+                # not a later one of the same batch.
+                self.__pending.append(
+                    (client, bytes(buf[pos:pos + length]), size, polling,
+                        stalls, client.timeout))
+            pos += length
+        del buf[:pos]
+
+    def __state(self):
+        """
+        :return: Response to the CMD_STATE command: the number of addresses
+            on 2 bytes, then for each address, the address on 2 bytes, the
+            number of data bytes and the last written bytes.
+        """
+        res = bytearray(len(self.shadow).to_bytes(2, 'big'))
+        for addr, data in self.shadow.items():
+            res += addr.to_bytes(2, 'big')
+            res.append(len(data))
+            res += data
+        return res
+
+    def __pump(self):
+        """
+        Send the pending commands of all the clients to the board in a single
+        write, as long as the credit window allows it.
+        """
+        pending = self.__pending
+        out = bytearray()
+        window = ScaffoldBus.FIFO_SIZE - ScaffoldBus.CREDIT_HEADROOM
+        while len(pending):
+            client, datagram, size, polling, stalls, timeout = pending[0]
+            if client.closed:
+                pending.popleft()
+                continue
+            if datagram[0] == CMD_STATE:
+                # Answered after the responses of the commands sent before
+                # it: an entry without response is kept in the in-flight
+                # queue until then.
+                pending.popleft()
+                if len(self.__inflight):
+                    self.__inflight.append([client, 0, 0, False, None])
+                else:
+                    client.output += self.__state()
+                continue
+            set_timeout = polling and (timeout != self.__timeout)
+            length = len(datagram) + (5 if set_timeout else 0)
+            if (stalls or self.__inflight_stalls) and \
+                    (self.__inflight_bytes + length > window) and \
+                    len(self.__inflight):
+                break
+            pending.popleft()
+            if set_timeout:
+                out.append(0x08)
+                out += timeout.to_bytes(4, 'big')
+                self.__timeout = timeout
+            out += datagram
+            update = None
+            cmd = datagram[0]
+            if cmd & 1:
+                # Data bytes follow the address, the polling parameters and
+                # the size byte.
+                start = 3 + (4 if cmd & 4 else 0) + (1 if cmd & 2 else 0)
+                update = ((datagram[1] << 8) | datagram[2],
+                    datagram[start:][-SHADOW_SIZE:], len(datagram) - start)
+            self.__inflight.append([client, length, size, stalls, update])
+            self.__inflight_bytes += length
+            self.__inflight_stalls += stalls
+            self.commands += 1
+        if len(out):
+            self.ser.write(out)
+            self.writes += 1
+
+    def __receive(self):
+        """ Read the responses of the board and route them to the clients. """
+        n = self.ser.in_waiting
+        if n == 0:
+            return
+        data = self.ser.read(n)
+        pos = 0
+        touched = []
+        while pos < len(data):
+            if len(self.__inflight) == 0:
+                raise RuntimeError('Unexpected data received from board')
+            entry = self.__inflight[0]
+            client = entry[0]
+            take = min(entry[2], len(data) - pos)
+            update = entry[4]
+            if (update is not None) and (data[pos] == update[2]):
+                # Write acknowledged: all the data bytes have been written.
+                self.shadow[update[0]] = update[1]
+            if not client.closed:
+                client.output += data[pos:pos + take]
+                touched.append(client)
+            entry[2] -= take
+            pos += take
+            if entry[2] == 0:
+                self.__inflight.popleft()
+                self.__inflight_bytes -= entry[1]
+                self.__inflight_stalls -= entry[3]
+                # Answer the CMD_STATE commands waiting for this response.
+                while len(self.__inflight) and (self.__inflight[0][2] == 0):
+                    client = self.__inflight.popleft()[0]
+                    if not client.closed:
+                        client.output += self.__state()
+                        touched.append(client)
+        for client in set(touched):
+            self.__write_client(client)
+
+    def __write_client(self, client):
+        """ Send as much as possible of the pending responses of a client. """
+        if client.closed or not len(client.output):
+            return
+        try:
+            n = client.sock.send(client.output)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.__drop(client)
+            return
+        del client.output[:n]
+
+
+def fetch_state(path=SOCKET_PATH):
+    """
+    Query the last value written to each register address from a daemon.
+
+    :param path: Daemon socket path.
+    :return: dict of bytes, indexed by address.
+    """
+    transport = UnixSocketTransport(path)
+    try:
+        transport.write(bytes([CMD_STATE]))
+        count = int.from_bytes(transport.read(2), 'big')
+        state = {}
+        for _ in range(count):
+            header = transport.read(3)
+            addr = int.from_bytes(header[:2], 'big')
+            state[addr] = transport.read(header[2])
+    finally:
+        transport.close()
+    return state
+
+
+class ScaffoldClient(Scaffold):
+    """
+    Drop-in replacement of :class:`scaffold.Scaffold` using a board shared by
+    a :class:`ScaffoldDaemon`. Connecting only checks the board version: the
+    peripherals are not reset, and the caches of the registers are restored
+    from the values last written by any client.
+
+    The registers written by other clients after the connection are not
+    tracked, and the values derived from the registers, such as
+    :attr:`scaffold.UART.baudrate`, are unknown until set.
+    """
+    def __init__(self, path=SOCKET_PATH, full_duplex=False):
+        """
+        :param path: Daemon socket path.
+        :param full_duplex: If True, use a background thread to receive the
+            responses. See :meth:`scaffold.ScaffoldBus.connect`.
+        """
+        super().__init__(path, full_duplex, 'unix')
+
+    def connect(
+            self, dev=SOCKET_PATH, full_duplex=False, transport='unix',
+            low_latency=False, reset=False, resume=None, verify=False):
+        """
+        Connect to the daemon. See :meth:`scaffold.Scaffold.connect`.
+
+        :param dev: Daemon socket path.
+        :param reset: If True, reset the peripherals as
+            :class:`scaffold.Scaffold` does. This affects all the clients.
+        :param resume: State saved by :meth:`scaffold.Scaffold.get_state`, as
+            a dict or a file path. The caches are then restored from this
+            state instead of the state of the daemon.
+        :param verify: If True and resume is set, read back the cached
+            registers to check the board matches the resumed state.
+        """
+        super().connect(dev, full_duplex, transport, low_latency, reset,
+            resume, verify)
+        if (not reset) and (resume is None):
+            self.__restore(fetch_state(dev))
+
+    def __restore(self, state):
+        """
+        Set the register caches from the state of the daemon.
+
+        :param state: dict returned by :func:`fetch_state`.
+        """
+        for register in self.registers().values():
+            data = state.get(register.address)
+            if (data is None) or register.volatile or \
+                    (len(data) < register.wideness):
+                continue
+            try:
+                register.cache = int.from_bytes(
+                    data[-register.wideness:], 'big')
+            except ValueError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Share a Scaffold board between many processes.')
+    parser.add_argument('--dev', default='/dev/scaffold',
+        help='Board device.')
+    parser.add_argument('--transport', default='serial',
+        help='Board transport: serial, raw, tcp or emulator.')
+    parser.add_argument('--socket', default=SOCKET_PATH,
+        help='Path of the Unix socket served to the clients.')
+    parser.add_argument('--low-latency', action='store_true',
+        help='Tune the board transport for low latency.')
+    args = parser.parse_args()
+    daemon = ScaffoldDaemon(
+        args.dev, args.socket, args.transport, args.low_latency)
+    print(args.socket, flush=True)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,626 @@
+# This file is part of Scaffold
+#
+# Scaffold is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2019 Ledger SAS, written by Olivier Hériveaux
+
+
+import os
+import socket
+import threading
+import argparse
+from collections import deque
+from time import perf_counter, sleep
+from .transport import FdTransport
+
+
+# System clock frequency of the board, in Hz.
+SYS_FREQ = 100e6
+# Duration of one unit of the polling timeout register, in seconds.
+TIMEOUT_UNIT = 3.0 / SYS_FREQ
+
+
+class VersionModel:
+    """
+    Emulated version module. The data register loops over the version string,
+    separated by null characters.
+    """
+    def __init__(self, version='scaffold-0.2'):
+        """
+        :param version: Version string returned by the board.
+        """
+        self.data = version.encode() + b'\0'
+        self.__pos = 0
+
+    def read(self, offset):
+        result = self.data[self.__pos]
+        self.__pos = (self.__pos + 1) % len(self.data)
+        return result
+
+    def write(self, offset, value):
+        pass
+
+
+class RegistersModel:
+    """
+    Emulated module which registers only store the written values. Wide
+    registers are loaded by shifting the written bytes, MSB first.
+    """
+    def __init__(self, widths):
+        """
+        :param widths: Width in bytes of each register, indexed by offset
+            from the module base address.
+        """
+        self.widths = widths
+        self.values = [0] * len(widths)
+
+    def read(self, offset):
+        return self.values[offset] & 0xff
+
+    def write(self, offset, value):
+        mask = (1 << (8 * self.widths[offset])) - 1
+        self.values[offset] = ((self.values[offset] << 8) | value) & mask
+
+
+class LEDsModel(RegistersModel):
+    """ Emulated LEDs module. """
+    def __init__(self):
+        super().__init__([1, 1, 1, 1, 1, 3])
+
+
+class PowerModel(RegistersModel):
+    """
+    Emulated power module. Bit 0 of the control register value is the DUT
+    power supply, bit 1 the platform power supply.
+    """
+    def __init__(self):
+        super().__init__([1])
+
+
+class PulseGeneratorModel(RegistersModel):
+    """
+    Emulated pulse generator. Pulses are generated instantly: the generator is
+    always ready, and the fired attribute counts the pulse trains.
+    """
+    def __init__(self):
+        super().__init__([1, 1, 1, 3, 3, 3, 2])
+        self.fired = 0
+
+    def read(self, offset):
+        if offset == 0:
+            # Status: always ready
+            return 1
+        return super().read(offset)
+
+    def write(self, offset, value):
+        if (offset == 1) and (value & 1):
+            self.fired += 1
+        super().write(offset, value)
+
+
+class TransceiverModel(RegistersModel):
+    """
+    Emulated UART or ISO7816 peripheral. Transmission is instantaneous: the
+    transmitted bytes are appended to the tx bytearray. Bytes to be received by
+    the peripheral can be appended to the rx bytearray.
+    """
+    def __init__(self, widths, data_offset):
+        """
+        :param widths: Width in bytes of each register.
+        :param data_offset: Offset of the data register.
+        """
+        super().__init__(widths)
+        self.data_offset = data_offset
+        self.tx = bytearray()
+        self.rx = bytearray()
+        # When True, transmitted bytes are also received.
+        self.loopback = False
+        self.parity_error = 0
+
+    def read(self, offset):
+        if offset == 0:
+            # Status: always ready, empty flag from rx FIFO.
+            return 1 | (self.parity_error << 1) | ((len(self.rx) == 0) << 2)
+        if offset == self.data_offset:
+            if len(self.rx):
+                return self.rx.pop(0)
+            return 0
+        return super().read(offset)
+
+    def write(self, offset, value):
+        if offset == 0:
+            self.parity_error &= (value >> 1) & 1
+        elif (offset == 1) and (value & 1):
+            self.rx.clear()
+        elif offset == self.data_offset:
+            self.tx.append(value)
+            if self.loopback:
+                self.rx.append(value)
+        else:
+            super().write(offset, value)
+
+
+class UARTModel(TransceiverModel):
+    """ Emulated UART peripheral. """
+    def __init__(self):
+        super().__init__([1, 1, 1, 2, 1], 4)
+
+
+class ISO7816Model(TransceiverModel):
+    """ Emulated ISO7816 peripheral. """
+    def __init__(self):
+        super().__init__([1, 1, 1, 1, 2, 1], 5)
+
+
+class I2CModel(RegistersModel):
+    """
+    Emulated I2C peripheral. Slave devices are callables registered in the
+    devices dictionary, indexed by their address byte with R/W bit cleared
+    (for instance 0x50 for the address 0x28 in 7 bits notation). Each callable
+    receives the transmitted bytes following the address byte and the number
+    of bytes to be read, and returns the read bytes. Transactions with an
+    address which is not in the devices dictionary are NACKed.
+    """
+    def __init__(self):
+        super().__init__([1, 1, 1, 2, 1, 1, 1])
+        self.devices = {}
+        self.fifo = bytearray()
+        self.nack = 0
+        self.read_size = 0
+        # Number of untransmitted bytes of the last transaction
+        self.remaining = 0
+
+    def read(self, offset):
+        if offset == 0:
+            return 1 | (self.nack << 1) | ((len(self.fifo) > 0) << 2)
+        elif offset == 4:
+            if len(self.fifo):
+                return self.fifo.pop(0)
+            return 0
+        elif offset == 5:
+            return self.remaining >> 8
+        elif offset == 6:
+            return self.remaining & 0xff
+        return super().read(offset)
+
+    def write(self, offset, value):
+        if offset == 1:
+            if value & 2:
+                self.fifo.clear()
+            if value & 1:
+                self.__transaction()
+        elif offset == 4:
+            self.fifo.append(value)
+        elif offset == 5:
+            self.read_size = (value << 8) | (self.read_size & 0xff)
+        elif offset == 6:
+            self.read_size = (self.read_size & 0xff00) | value
+        else:
+            super().write(offset, value)
+
+    def __transaction(self):
+        data = bytes(self.fifo)
+        self.fifo.clear()
+        device = self.devices.get(data[0] & 0xfe) if len(data) else None
+        if device is None:
+            # NACK on address byte: the rest of the FIFO is not transmitted.
+            self.nack = 1
+            self.fifo += data[1:]
+            self.remaining = max(len(data) - 1, 0)
+            return
+        self.nack = 0
+        self.remaining = 0
+        size = self.read_size if (data[0] & 1) else 0
+        self.fifo += bytes(device(data[1:], size))[:size]
+
+
+class IOModel:
+    """
+    Emulated I/Os. The values list holds the input state of each group of 8
+    I/Os, and the events list their event flags.
+    """
+    def __init__(self, groups=3):
+        self.values = [0] * groups
+        self.events = [0] * groups
+
+    def read(self, offset):
+        group, reg = offset >> 4, offset & 0x0f
+        if reg == 0:
+            return self.values[group]
+        return self.events[group]
+
+    def write(self, offset, value):
+        group, reg = offset >> 4, offset & 0x0f
+        if reg == 1:
+            # Writing 0 clears the event flags
+            self.events[group] &= value
+
+
+class MatrixModel:
+    """
+    Emulated routing matrix. The routes attribute stores the selected input
+    index of each output.
+    """
+    def __init__(self, outputs):
+        self.routes = [0] * outputs
+
+    def read(self, offset):
+        return 0
+
+    def write(self, offset, value):
+        self.routes[offset] = value
+
+
+class BoardEmulator:
+    """
+    Emulates the bus bridge of a Scaffold board and the registers of its
+    modules. Commands are given to :meth:`feed` in the exact format sent by
+    :class:`scaffold.ScaffoldBus`, and the responses of the board are
+    returned.
+
+    The emulated peripherals have no notion of time: transfers complete
+    instantly, and a polling condition which is not met when a command is
+    executed will never be. Such a polling command times out immediately,
+    even if the timeout is disabled (a real board would then hang until
+    reset). The time the board would have spent waiting is accumulated in
+    the busy_time attribute, which transports use to delay the responses.
+    """
+    def __init__(self):
+        self.version = VersionModel()
+        self.leds = LEDsModel()
+        self.power = PowerModel()
+        self.pgens = [PulseGeneratorModel() for i in range(4)]
+        self.uarts = [UARTModel() for i in range(2)]
+        self.iso7816 = ISO7816Model()
+        self.i2cs = [I2CModel()]
+        self.io = IOModel()
+        self.mtxl = MatrixModel(9)
+        self.mtxr = MatrixModel(22)
+        # Module of each register address, with the module base address.
+        self.__map = {}
+        self.__map_module(self.version, 0x0100, 1)
+        self.__map_module(self.leds, 0x0200, 6)
+        for i, pgen in enumerate(self.pgens):
+            self.__map_module(pgen, 0x0300 + 0x10 * i, 7)
+        for i, uart in enumerate(self.uarts):
+            self.__map_module(uart, 0x0400 + 0x10 * i, 5)
+        self.__map_module(self.iso7816, 0x0500, 6)
+        self.__map_module(self.power, 0x0600, 1)
+        for i, i2c in enumerate(self.i2cs):
+            self.__map_module(i2c, 0x0700 + 0x10 * i, 7)
+        for group in range(len(self.io.values)):
+            self.__map[0xe000 + 0x10 * group] = (self.io, 0xe000)
+            self.__map[0xe001 + 0x10 * group] = (self.io, 0xe000)
+        self.__map_module(self.mtxl, 0xf000, len(self.mtxl.routes))
+        self.__map_module(self.mtxr, 0xf100, len(self.mtxr.routes))
+        # Polling timeout register, set by the 0x08 command.
+        self.timeout = 0
+        # Received bytes of an incomplete command
+        self.__input = bytearray()
+        # Time spent in polling timeouts, in seconds.
+        self.busy_time = 0.0
+        # Number of processed commands
+        self.commands = 0
+
+    def __map_module(self, module, base, count):
+        for i in range(count):
+            self.__map[base + i] = (module, base)
+
+    def read_register(self, address):
+        """
+        Read a register, as the bus bridge does. Unmapped addresses read 0.
+
+        :param address: Register address.
+        """
+        entry = self.__map.get(address)
+        if entry is None:
+            return 0
+        module, base = entry
+        return module.read(address - base)
+
+    def write_register(self, address, value):
+        """
+        Write a register, as the bus bridge does. Writes to unmapped addresses
+        are ignored.
+
+        :param address: Register address.
+        :param value: Byte value.
+        """
+        entry = self.__map.get(address)
+        if entry is not None:
+            module, base = entry
+            module.write(address - base, value)
+
+    def feed(self, data):
+        """
+        Process the bytes received by the bus bridge. Incomplete commands are
+        kept until the next call.
+
+        :param data: Received bytes.
+        :return: Response bytes of the completed commands.
+        """
+        buf = self.__input
+        buf += data
+        out = bytearray()
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            cmd = buf[pos]
+            if cmd == 0x08:
+                if end - pos < 5:
+                    break
+                self.timeout = int.from_bytes(buf[pos + 1:pos + 5], 'big')
+                pos += 5
+                continue
+            i = pos + 3
+            if cmd & 4:
+                i += 4
+            if cmd & 2:
+                i += 1
+            if i > end:
+                break
+            if cmd & 2:
+                size = buf[i - 1]
+            else:
+                size = 1
+            if (cmd & 1) and (i + size > end):
+                break
+            addr = (buf[pos + 1] << 8) | buf[pos + 2]
+            if cmd & 4:
+                poll = (buf[pos + 3] << 8) | buf[pos + 4]
+                poll_mask = buf[pos + 5]
+                poll_value = buf[pos + 6]
+            else:
+                poll = None
+            if cmd & 1:
+                values = buf[i:i + size]
+                i += size
+            n = 0
+            while n < size:
+                if (poll is not None) and \
+                        (self.read_register(poll) & poll_mask) != poll_value:
+                    self.busy_time += self.timeout * TIMEOUT_UNIT
+                    break
+                if cmd & 1:
+                    self.write_register(addr, values[n])
+                else:
+                    out.append(self.read_register(addr))
+                n += 1
+            if not (cmd & 1):
+                out += bytes(size - n)
+            out.append(n)
+            self.commands += 1
+            pos = i
+        del buf[:pos]
+        return out
+
+
+class EmulatorTransport(FdTransport):
+    """
+    Transport connected to an in-process :class:`BoardEmulator`. The commands
+    are executed when written, and the responses are delivered through a
+    socket pair, so the emulated board can be used like a real one, including
+    in full-duplex mode and with the coroutine methods of the bus.
+
+    Without link model, responses are available immediately, which allows
+    measuring the overhead of the host apart from the hardware. A latency and
+    a baudrate can be set to model a serial link: each response is then
+    delivered by a background thread after the request and response bytes
+    have been transmitted and the link latency has elapsed.
+    """
+    def __init__(self, board=None, latency=0.0, baudrate=None):
+        """
+        :param board: :class:`BoardEmulator` instance. If None, a new board is
+            created.
+        :param latency: Delay added to each response, in seconds. For
+            instance 1e-3 models the latency timer of a tuned FTDI converter.
+        :param baudrate: If not None, serial link baudrate used to calculate
+            the transmission time of the bytes (10 bits per byte).
+        """
+        self.board = board if board is not None else BoardEmulator()
+        self.latency = latency
+        self.baudrate = baudrate
+        host, self.__peer = socket.socketpair()
+        self.__host = host
+        self.__peer.setblocking(False)
+        self.__cond = threading.Condition()
+        # Responses to be delivered, as (time, bytes) tuples
+        self.__pending = deque()
+        # Responses which are due but could not be written in the socket yet
+        self.__out = bytearray()
+        # Time when each direction of the link becomes idle
+        self.__tx_free = 0.0
+        self.__rx_free = 0.0
+        self.__running = True
+        self.__thread = None
+        if latency or baudrate:
+            self.__thread = threading.Thread(
+                target=self.__deliver, daemon=True)
+            self.__thread.start()
+        super().__init__(host.fileno())
+
+    def __byte_time(self, n):
+        if self.baudrate is None:
+            return 0.0
+        return n * 10.0 / self.baudrate
+
+    def write(self, data):
+        """
+        Execute the commands on the emulated board.
+
+        :param data: Command bytes.
+        :return: Number of bytes written.
+        """
+        board = self.board
+        board.busy_time = 0.0
+        response = board.feed(data)
+        with self.__cond:
+            if self.__thread is None:
+                self.__out += response
+                self.__flush()
+            else:
+                # Both directions of the link are modeled independently.
+                sent = max(perf_counter(), self.__tx_free) \
+                    + self.__byte_time(len(data))
+                self.__tx_free = sent
+                due = max(sent + board.busy_time + self.latency,
+                    self.__rx_free) + self.__byte_time(len(response))
+                self.__rx_free = due
+                self.__pending.append((due, response))
+                self.__cond.notify()
+        return len(data)
+
+    def __flush(self):
+        """ Write as many due responses as possible in the socket. """
+        if len(self.__out):
+            try:
+                n = self.__peer.send(self.__out)
+            except BlockingIOError:
+                return
+            del self.__out[:n]
+
+    def __deliver(self):
+        """ Thread delivering the responses when they are due. """
+        with self.__cond:
+            while self.__running:
+                now = perf_counter()
+                pending = self.__pending
+                while len(pending) and (pending[0][0] <= now):
+                    self.__out += pending.popleft()[1]
+                self.__flush()
+                if len(self.__out):
+                    # Socket full, wait for the host to read.
+                    self.__cond.wait(0.001)
+                elif len(pending):
+                    self.__cond.wait(pending[0][0] - now)
+                else:
+                    self.__cond.wait()
+
+    def readinto(self, buf):
+        if self.__thread is not None:
+            return super().readinto(buf)
+        # Responses larger than the socket buffer are written in the socket
+        # as the host reads them.
+        view = memoryview(buf).cast('B')
+        total = len(view)
+        pos = 0
+        while pos < total:
+            with self.__cond:
+                self.__flush()
+                remaining = len(self.__out)
+            if remaining == 0:
+                return pos + super().readinto(view[pos:])
+            available = max(1, super().in_waiting)
+            pos += super().readinto(view[pos:pos + available])
+        return pos
+
+    @property
+    def in_waiting(self):
+        with self.__cond:
+            self.__flush()
+        return super().in_waiting
+
+    def close(self):
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+        self.__host.detach()
+        super().close()
+        self.__peer.close()
+
+
+class PtyEmulator(threading.Thread):
+    """
+    Serves a :class:`BoardEmulator` on a pseudo-terminal, so it can be opened
+    as a serial port by any program, with any transport. Only available on
+    POSIX systems.
+    """
+    def __init__(self, board=None, latency=0.0, baudrate=None, link=None):
+        """
+        :param board: :class:`BoardEmulator` instance. If None, a new board is
+            created.
+        :param latency: Delay added to each response, in seconds.
+        :param baudrate: If not None, serial link baudrate used to calculate
+            the transmission time of the bytes (10 bits per byte).
+        :param link: If not None, path of a symbolic link to the
+            pseudo-terminal to be created, for instance '/dev/scaffold'.
+        """
+        import pty
+        import tty
+        super().__init__(daemon=True)
+        self.board = board if board is not None else BoardEmulator()
+        self.latency = latency
+        self.baudrate = baudrate
+        self.master, self.__slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.__slave)
+        self.path = os.ttyname(self.__slave)
+        self.link = link
+        if link is not None:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+
+    def run(self):
+        board = self.board
+        while True:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            board.busy_time = 0.0
+            response = board.feed(data)
+            delay = board.busy_time + self.latency
+            if self.baudrate is not None:
+                delay += (len(data) + len(response)) * 10.0 / self.baudrate
+            if delay > 0:
+                sleep(delay)
+            if len(response):
+                os.write(self.master, response)
+
+    def close(self):
+        """ Close the pseudo-terminal and remove the symbolic link. """
+        if self.link is not None and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+        os.close(self.__slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Emulate a Scaffold board on a pseudo-terminal.')
+    parser.add_argument('--link', help='Symbolic link to the pseudo-terminal, '
+        'for instance /dev/scaffold.')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='Link latency in seconds.')
+    parser.add_argument('--baudrate', type=int, default=None,
+        help='Link baudrate.')
+    args = parser.parse_args()
+    emulator = PtyEmulator(
+        latency=args.latency, baudrate=args.baudrate, link=args.link)
+    print(emulator.path if args.link is None else args.link, flush=True)
+    emulator.start()
+    try:
+        emulator.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -69,10 +69,14 @@ class Smartcard:
         self.scaffold = scaffold
         self.sig_nrst = scaffold.d1
         self.sig_sense = scaffold.d3
-        self.sig_nrst << 1
-        scaffold.d0 << scaffold.iso7816.io_out
-        scaffold.d0 >> scaffold.iso7816.io_in
-        scaffold.d2 << scaffold.iso7816.clk
+        plan = scaffold.routing_plan()
+        plan.connect(self.sig_nrst, 1)
+        plan.connect(scaffold.d0, scaffold.iso7816.io_out)
+        plan.connect(scaffold.iso7816.io_in, scaffold.d0)
+        plan.connect(scaffold.d2, scaffold.iso7816.clk)
+        # All the connections are written: the matrix may have been changed
+        # without the host knowing it.
+        plan.apply(force=True)
         self.atr = None
         self.convention = Convention.DIRECT
 
@@ -176,28 +180,7 @@ class Smartcard:
         :raises ValueError: if APDU data is invalid.
         :return bytes: Response data, with status word.
         """
-        if type(the_apdu) == str:
-            the_apdu = bytes.fromhex(the_apdu)
-        apdu_len = len(the_apdu)
-        if apdu_len < 5:
-            raise ValueError('APDU too short')
-        out_data_len = apdu_len - 5
-        if out_data_len > 256:
-            raise ValueError('APDU too long')
-        if out_data_len > 0:
-            # This is an outgoing data transfer
-            # Verify APDU P3 field correctness
-            p3 = the_apdu[4]
-            expected_p3 = out_data_len % 256
-            if p3 != expected_p3:
-                raise ValueError('Expected P3 (length) in APDU is '
-                    f'0x{expected_p3:02x}, got 0x{p3:02x}')
-            in_data_len = 0
-        else:
-            if the_apdu[4] > 0:
-                in_data_len = the_apdu[4]
-            else:
-                in_data_len = 256
+        the_apdu, out_data_len, in_data_len = self.__parse_apdu(the_apdu)
         # Transmit the header
         if 'a' in trigger:
             self.iso7816.transmit(the_apdu[:4])
@@ -239,6 +222,97 @@ class Smartcard:
                 self.iso7816.trigger_long = 0
             return response
 
+    async def receive_async(self, n):
+        """ Coroutine version of :meth:`receive`. """
+        data = await self.iso7816.receive_async(n)
+        if self.convention == Convention.INVERSE:
+            for i in range(len(data)):
+                data[i] = self.inverse_byte(data[i])
+        return data
+
+    async def apdu_async(self, the_apdu, trigger=''):
+        """
+        Coroutine version of :meth:`apdu`. Register writes between two
+        receptions are sent as a single bus batch.
+        """
+        the_apdu, out_data_len, in_data_len = self.__parse_apdu(the_apdu)
+        # Transmit the header
+        async with self.scaffold.lazy_section():
+            if 'a' in trigger:
+                self.iso7816.transmit(the_apdu[:4])
+                self.iso7816.trigger_long = 1
+                self.iso7816.transmit(the_apdu[4:5])
+            else:
+                # Send all the header at once
+                self.iso7816.trigger_long = 0
+                self.iso7816.transmit(the_apdu[:5])
+        # Receive procedure byte
+        procedure_byte = (await self.iso7816.receive_async(1))[0]
+        if 'a' in trigger:  # Disable only if enabled previously
+            async with self.scaffold.lazy_section():
+                self.iso7816.trigger_long = 0
+        while procedure_byte == 0x60:
+            procedure_byte = (await self.iso7816.receive_async(1))[0]
+        response = bytearray()
+        ins = the_apdu[1]
+        if (procedure_byte & 0xf0) in (0x60, 0x90):
+            # Received SW1 and SW2 bytes.
+            response.append(procedure_byte)
+            response += await self.iso7816.receive_async(1)
+            return response
+        elif procedure_byte in (ins, ~ins):
+            # Acknowledge byte.
+            # Transfer the remaining data and receive the response data and
+            # status word in a single batch.
+            async with self.scaffold.lazy_section():
+                if out_data_len > 0:
+                    if 'b' in trigger:
+                        # Enable trigger on last byte only
+                        self.iso7816.transmit(the_apdu[5:-1])
+                        self.iso7816.trigger_long = 1
+                        self.iso7816.transmit(the_apdu[-1:])
+                    else:
+                        self.iso7816.transmit(the_apdu[5:])
+                data = self.iso7816.receive(in_data_len + 2)
+                if 'b' in trigger:  # Disable only if enabled previously
+                    self.iso7816.trigger_long = 0
+            response += data.result()
+            return response
+
+    def __parse_apdu(self, the_apdu):
+        """
+        Verify an APDU and calculate the length of the data to be transmitted
+        and received.
+
+        :param the_apdu: APDU, as bytes or hexadecimal str.
+        :raises ValueError: if APDU data is invalid.
+        :return: Tuple (the_apdu, out_data_len, in_data_len), with the_apdu
+            converted to bytes.
+        """
+        if type(the_apdu) == str:
+            the_apdu = bytes.fromhex(the_apdu)
+        apdu_len = len(the_apdu)
+        if apdu_len < 5:
+            raise ValueError('APDU too short')
+        out_data_len = apdu_len - 5
+        if out_data_len > 256:
+            raise ValueError('APDU too long')
+        if out_data_len > 0:
+            # This is an outgoing data transfer
+            # Verify APDU P3 field correctness
+            p3 = the_apdu[4]
+            expected_p3 = out_data_len % 256
+            if p3 != expected_p3:
+                raise ValueError('Expected P3 (length) in APDU is '
+                    f'0x{expected_p3:02x}, got 0x{p3:02x}')
+            in_data_len = 0
+        else:
+            if the_apdu[4] > 0:
+                in_data_len = the_apdu[4]
+            else:
+                in_data_len = 256
+        return the_apdu, out_data_len, in_data_len
+
     def find_info(self):
         """
         Parse the smartcard ATR list database available at
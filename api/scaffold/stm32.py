@@ -122,10 +122,16 @@ class STM32:
         self.uart = uart = scaffold.uart0
         self.boot0 = scaffold.d6
         self.boot1 = scaffold.d7
-        # Connect the UART peripheral to D0 and D1.
-        uart.rx << scaffold.d1
-        scaffold.d0 << uart.tx
-        uart.baudrate = 115200
+        # Connect the UART peripheral to D0 and D1, and configure it, with a
+        # single batch.
+        plan = scaffold.routing_plan()
+        plan.connect(uart.rx, scaffold.d1)
+        plan.connect(scaffold.d0, uart.tx)
+        with scaffold.lazy_section():
+            # All the connections are written: the matrix may have been
+            # changed without the host knowing it.
+            plan.apply(force=True)
+            uart.baudrate = 115200
         # Instance of STM32Device, set when reading the device ID.
         self.device = None
 
@@ -337,13 +343,8 @@ class STM32:
         self.wait_ack()
         # When the chip is in RDP1 it will perform mass flash erase. This can
         # take a lot of time, so we must change the timeout setting.
-        previous_timeout = self.scaffold.timeout
-        self.scaffold.timeout = 30
-        try:
+        with self.scaffold.timeout_scope(30):
             self.wait_ack()
-        finally:
-            # Restore timeout setting, even if something bad happened!
-            self.scaffold.timeout = previous_timeout
 
     def extended_erase(self):
         """
@@ -355,12 +356,8 @@ class STM32:
         buf = bytearray(b'\xff\xff')
         buf.append(self.checksum(buf))
         self.uart.transmit(buf, 1)
-        previous_timeout = self.scaffold.timeout
-        self.scaffold.timeout = 30
-        try:
+        with self.scaffold.timeout_scope(30):
             self.wait_ack()
-        finally:
-            self.scaffold.timeout = previous_timeout
 
     def go(self, address, trigger=0):
         """
@@ -0,0 +1,384 @@
+# This file is part of Scaffold
+#
+# Scaffold is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2019 Ledger SAS, written by Olivier Hériveaux
+
+
+import os
+import mmap
+import struct
+import threading
+import argparse
+from time import monotonic_ns, time_ns
+from .transport import open_transport
+
+
+MAGIC = b'SCAFTRC1'
+FILE_HEADER = struct.Struct('<8sQ')
+RECORD_HEADER = struct.Struct('<BHIQ')
+KIND_END = 0
+KIND_WRITE = 1
+KIND_READ = 2
+KIND_TAG = 3
+
+
+class TraceRecorder:
+    """
+    Records the bytes exchanged with a board in an append-only binary trace
+    file. The file is memory-mapped and grown as needed, so a record only
+    costs a copy in memory. Thread-safe.
+
+    A trace file starts with a 16 bytes header: the magic string 'SCAFTRC1'
+    followed by the wall-clock time of the start of the recording, in
+    nanoseconds since the epoch. The header is followed by records, each made
+    of a 15 bytes record header and a payload:
+
+    - kind (8 bits): 1 for bytes sent to the board, 2 for bytes received from
+      the board, 3 for the definition of a tag (the payload is then the UTF-8
+      name of the tag). 0 marks the end of the trace.
+    - tag (16 bits): Tag index, 0 when no tag is set.
+    - length (32 bits): Payload length in bytes.
+    - timestamp (64 bits): Nanoseconds elapsed since the start of the
+      recording.
+
+    All fields are little endian. If the process crashes, the records written
+    so far are kept in the file, followed by zeros.
+    """
+    def __init__(self, path, size=1 << 24):
+        """
+        :param path: Trace file path. An existing file is overwritten.
+        :param size: Initial size of the file in bytes. The file is grown by
+            doubling its size when full, and truncated to the recorded data
+            when closed.
+        """
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.__size = max(size, 4096)
+        os.ftruncate(self.__fd, self.__size)
+        self.__mm = mmap.mmap(self.__fd, self.__size)
+        self.__start = monotonic_ns()
+        FILE_HEADER.pack_into(self.__mm, 0, MAGIC, time_ns())
+        self.__pos = FILE_HEADER.size
+        # Tag indexes, by tag name.
+        self.__tags = {None: 0}
+        self.__tag = 0
+        self.__tag_name = None
+
+    @property
+    def tag(self):
+        """
+        Current tag, attached to the following records. str or None.
+        Typically used to mark the call sites or the steps of a campaign.
+        """
+        return self.__tag_name
+
+    @tag.setter
+    def tag(self, name):
+        index = self.__tags.get(name)
+        if index is None:
+            index = len(self.__tags)
+            if index > 0xffff:
+                raise ValueError('Too many trace tags')
+            self.__tags[name] = index
+            self.__append(KIND_TAG, index, name.encode())
+        self.__tag = index
+        self.__tag_name = name
+
+    def tagged(self, name):
+        """
+        :return: Context manager setting the tag of the records for the
+            duration of a with block, and restoring the previous tag when
+            leaving it.
+        :param name: Tag name.
+        """
+        return TraceTag(self, name)
+
+    def record(self, kind, data):
+        """
+        Append a record tagged with the current tag.
+
+        :param kind: KIND_WRITE or KIND_READ.
+        :param data: Payload bytes.
+        """
+        self.__append(kind, self.__tag, data)
+
+    def __append(self, kind, tag, data):
+        n = len(data)
+        timestamp = monotonic_ns() - self.__start
+        with self.__lock:
+            pos = self.__pos
+            end = pos + RECORD_HEADER.size + n
+            if end > self.__size:
+                self.__grow(end)
+            mm = self.__mm
+            RECORD_HEADER.pack_into(mm, pos, kind, tag, n, timestamp)
+            mm[pos + RECORD_HEADER.size:end] = data
+            self.__pos = end
+
+    def __grow(self, end):
+        """ Enlarge the file so it can store at least end bytes. """
+        size = self.__size
+        while size < end:
+            size *= 2
+        self.__mm.close()
+        os.ftruncate(self.__fd, size)
+        self.__mm = mmap.mmap(self.__fd, size)
+        self.__size = size
+
+    def wrap(self, transport):
+        """
+        :return: :class:`TracingTransport` recording the traffic of a
+            transport in this trace.
+        :param transport: Transport to be wrapped.
+        """
+        return TracingTransport(transport, self)
+
+    def close(self):
+        """ Close the trace and truncate the file to the recorded data. """
+        with self.__lock:
+            self.__mm.close()
+            os.ftruncate(self.__fd, self.__pos)
+            os.close(self.__fd)
+
+
+class TraceTag:
+    """ Context manager returned by :meth:`TraceRecorder.tagged`. """
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.previous = self.recorder.tag
+        self.recorder.tag = self.name
+
+    def __exit__(self, type, value, traceback):
+        self.recorder.tag = self.previous
+
+
+class TracingTransport:
+    """
+    Wraps a transport and records all the sent and received bytes in a
+    :class:`TraceRecorder`. Other attributes are forwarded to the wrapped
+    transport.
+    """
+    def __init__(self, transport, recorder):
+        """
+        :param transport: Wrapped transport.
+        :param recorder: :class:`TraceRecorder` instance.
+        """
+        self.transport = transport
+        self.recorder = recorder
+
+    def write(self, data):
+        self.recorder.record(KIND_WRITE, data)
+        return self.transport.write(data)
+
+    def read(self, n):
+        data = self.transport.read(n)
+        if len(data):
+            self.recorder.record(KIND_READ, data)
+        return data
+
+    def readinto(self, buf):
+        n = self.transport.readinto(buf)
+        if n:
+            self.recorder.record(KIND_READ, memoryview(buf).cast('B')[:n])
+        return n
+
+    @property
+    def timeout(self):
+        return self.transport.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.transport.timeout = value
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+class TraceRecord:
+    """ A record read from a trace file. """
+    def __init__(self, index, kind, tag, timestamp, data):
+        """
+        :param index: Position of the record in the trace.
+        :param kind: KIND_WRITE or KIND_READ.
+        :param tag: Tag name or None.
+        :param timestamp: Time of the record, in nanoseconds since the start
+            of the recording.
+        :param data: Payload bytes.
+        """
+        self.index = index
+        self.kind = kind
+        self.tag = tag
+        self.timestamp = timestamp
+        self.data = data
+
+    def __str__(self):
+        direction = '>' if self.kind == KIND_WRITE else '<'
+        tag = '' if self.tag is None else f' [{self.tag}]'
+        return (f'{self.timestamp / 1e9:.9f} {direction} {self.data.hex()}'
+            f'{tag}')
+
+
+def read_trace(path):
+    """
+    Parse a trace file.
+
+    :param path: Trace file path.
+    :return: Iterator of :class:`TraceRecord`, for sent and received data.
+        The start time of the recording, in nanoseconds since the epoch, is
+        given by :func:`trace_start_time`.
+    :raises ValueError: If the file is not a trace.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, _ = FILE_HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a Scaffold trace file')
+    pos = FILE_HEADER.size
+    tags = {0: None}
+    index = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        kind, tag, n, timestamp = RECORD_HEADER.unpack_from(data, pos)
+        if kind == KIND_END:
+            break
+        pos += RECORD_HEADER.size
+        payload = data[pos:pos + n]
+        pos += n
+        if kind == KIND_TAG:
+            tags[tag] = payload.decode()
+        else:
+            yield TraceRecord(index, kind, tags[tag], timestamp, payload)
+            index += 1
+
+
+def trace_start_time(path):
+    """
+    :return: Wall-clock time of the start of the recording of a trace, in
+        nanoseconds since the epoch.
+    :param path: Trace file path.
+    """
+    with open(path, 'rb') as f:
+        magic, start = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('Not a Scaffold trace file')
+    return start
+
+
+class TraceMismatch:
+    """ Difference between a recorded response and a replayed one. """
+    def __init__(self, record, offset, expected, received):
+        """
+        :param record: :class:`TraceRecord` of the recorded response.
+        :param offset: Position of the first differing byte in the record.
+        :param expected: Recorded bytes.
+        :param received: Bytes received during the replay.
+        """
+        self.record = record
+        self.offset = offset
+        self.expected = expected
+        self.received = received
+
+    def __str__(self):
+        tag = '' if self.record.tag is None else f' [{self.record.tag}]'
+        return (f'Record {self.record.index}{tag} at '
+            f'{self.record.timestamp / 1e9:.9f}, offset {self.offset}: '
+            f'expected {self.expected.hex()}, received {self.received.hex()}')
+
+
+def replay(path, dev, transport='serial', timeout=1.0):
+    """
+    Re-issue the commands of a trace against a board or an emulator, and
+    compare the responses. The sent and received bytes are replayed in the
+    recorded order, without the recorded delays: each read waits only for the
+    bytes it expects, so the replay runs at wire speed with the same flow
+    control as the recording.
+
+    :param path: Trace file path.
+    :param dev: Device, as accepted by
+        :func:`scaffold.transport.open_transport`. Can be an already opened
+        transport, such as an :class:`scaffold.emulator.EmulatorTransport`,
+        which is not closed. A transport opened by this function is closed
+        when the replay ends.
+    :param transport: Transport backend, see
+        :func:`scaffold.transport.open_transport`.
+    :param timeout: Time in seconds a read may wait for its response, on top
+        of the time elapsed since the previous record during the recording.
+        A response which is missing or short is reported as a mismatch, and
+        the replay stops there since the following responses would be out of
+        sync.
+    :return: List of :class:`TraceMismatch`, empty if all the responses
+        match.
+    """
+    ser = open_transport(dev, transport)
+    previous_timeout = ser.timeout
+    mismatches = []
+    try:
+        last = None
+        for record in read_trace(path):
+            if record.kind == KIND_WRITE:
+                ser.write(record.data)
+            elif record.kind == KIND_READ:
+                elapsed = 0 if last is None else \
+                    max(0, record.timestamp - last) / 1e9
+                ser.timeout = timeout + elapsed
+                received = ser.read(len(record.data))
+                if received != record.data:
+                    offset = 0
+                    while (offset < len(received)) and \
+                            (received[offset] == record.data[offset]):
+                        offset += 1
+                    mismatches.append(
+                        TraceMismatch(record, offset, record.data, received))
+                    if len(received) < len(record.data):
+                        break
+            last = record.timestamp
+    finally:
+        # Transports passed by the caller are left open.
+        if ser is not dev:
+            ser.close()
+        else:
+            ser.timeout = previous_timeout
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Dump or replay a Scaffold bus trace.')
+    parser.add_argument('trace', help='Trace file.')
+    parser.add_argument('--replay', metavar='DEV',
+        help='Replay the trace on the given device and print the differences.')
+    parser.add_argument('--transport', default='serial',
+        help='Transport used for replay: serial, raw, tcp or emulator.')
+    parser.add_argument('--timeout', type=float, default=1.0,
+        help='Time in seconds a replayed read may wait for its response, in '
+        'addition to the recorded delay.')
+    args = parser.parse_args()
+    if args.replay is None:
+        for record in read_trace(args.trace):
+            print(record)
+    else:
+        mismatches = replay(
+            args.trace, args.replay, args.transport, args.timeout)
+        for mismatch in mismatches:
+            print(mismatch)
+        print(f'{len(mismatches)} differences')
+
+
+if __name__ == '__main__':
+    main()
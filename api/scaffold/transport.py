@@ -0,0 +1,484 @@
+# This file is part of Scaffold
+#
+# Scaffold is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2019 Ledger SAS, written by Olivier Hériveaux
+
+
+import os
+import abc
+import array
+import select
+import time
+import socket
+import struct
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Not available on Windows, where only SerialTransport can be used.
+    fcntl = termios = None
+
+
+# Linux serial_struct flag asking the tty layer to push received bytes to the
+# readers immediately.
+ASYNC_LOW_LATENCY = 0x2000
+# Size of the transport buffers in low latency mode, in bytes.
+LOW_LATENCY_BUFFER_SIZE = 65536
+
+
+def set_async_low_latency(fd):
+    """
+    Set the ASYNC_LOW_LATENCY flag of a Linux serial port.
+
+    :param fd: File descriptor of the serial port.
+    :return: True if the flag has been set, False if the device does not
+        support it.
+    """
+    if termios is None or not hasattr(termios, 'TIOCGSERIAL'):
+        return False
+    # The flags field is the fifth int of serial_struct.
+    buf = array.array('i', [0] * 32)
+    try:
+        fcntl.ioctl(fd, termios.TIOCGSERIAL, buf)
+        buf[4] |= ASYNC_LOW_LATENCY
+        fcntl.ioctl(fd, termios.TIOCSSERIAL, buf)
+    except OSError:
+        return False
+    return True
+
+
+def set_latency_timer(dev, value=1):
+    """
+    Set the latency timer of a FTDI USB serial converter, which defaults to
+    16 ms and then delays every response of the board. The timer is set with
+    the sysfs latency_timer attribute of the device, which is usually only
+    writable by root or with a udev rule.
+
+    :param dev: Serial port device path, such as '/dev/ttyUSB0'. Symbolic
+        links are resolved.
+    :param value: Latency timer value, in milliseconds.
+    :return: True if the latency timer has been set, False if the attribute
+        does not exist or cannot be written.
+    """
+    name = os.path.basename(os.path.realpath(dev))
+    path = f'/sys/bus/usb-serial/devices/{name}/latency_timer'
+    try:
+        with open(path, 'w') as f:
+            f.write(str(value))
+    except OSError:
+        return False
+    return True
+
+
+class Transport(abc.ABC):
+    """
+    Byte stream between the host and the bus bridge of the board. Subclasses
+    must implement the abstract methods below, and provide a timeout
+    attribute: the read timeout in seconds, or None to block without limit.
+    When the timeout expires, read and readinto return the bytes received so
+    far, as pyserial does. It is set by :class:`ScaffoldBus` to enforce its
+    host deadlines.
+
+    A transport may also provide a set_low_latency() method, called by
+    :meth:`ScaffoldBus.connect` in low latency mode.
+
+    Objects providing the same interface without subclassing this class,
+    such as :class:`serial.Serial` instances, can be passed directly to
+    :meth:`ScaffoldBus.connect`.
+    """
+    @abc.abstractmethod
+    def write(self, data):
+        """
+        Send all the given bytes.
+
+        :param data: bytes, bytearray or memoryview.
+        """
+
+    @abc.abstractmethod
+    def read(self, n):
+        """
+        Block until n bytes are received, the read timeout expires or the read
+        is cancelled.
+
+        :param n: Number of bytes to read.
+        :return: Received bytes.
+        """
+
+    @abc.abstractmethod
+    def readinto(self, buf):
+        """
+        Block until the buffer is filled with received bytes, the read timeout
+        expires or the read is cancelled.
+
+        :param buf: Writable contiguous buffer.
+        :return: Number of bytes received.
+        """
+
+    @property
+    @abc.abstractmethod
+    def in_waiting(self):
+        """ Number of received bytes which can be read without blocking. """
+
+    @abc.abstractmethod
+    def fileno(self):
+        """
+        :return: File descriptor which can be watched for received data. Used
+            by the coroutine methods of the bus.
+        """
+
+    @abc.abstractmethod
+    def cancel_read(self):
+        """
+        Interrupt a blocking read from another thread. Used to stop the
+        full-duplex reader thread.
+        """
+
+    @abc.abstractmethod
+    def close(self):
+        """ Close the connection. """
+
+
+class SerialTransport(Transport):
+    """
+    Serial port opened with pyserial. This is the default transport, and the
+    only one available on every platform. pyserial is imported when the first
+    port is opened, so importing this module does not import it.
+
+    :ivar serial: :class:`serial.Serial` instance. Its other attributes, such
+        as port or baudrate, can also be accessed through the transport.
+    """
+    def __init__(self, dev, baudrate=2000000):
+        """
+        :param dev: Serial port device path. For instance '/dev/ttyUSB0' on
+            linux, 'COM0' on Windows.
+        :param baudrate: Serial port baudrate.
+        """
+        import serial
+        self.serial = serial.Serial(dev, baudrate=baudrate)
+
+    def __getattr__(self, name):
+        # Only called for the attributes the transport does not define.
+        if name == 'serial':
+            raise AttributeError(name)
+        return getattr(self.serial, name)
+
+    def write(self, data):
+        return self.serial.write(data)
+
+    def read(self, n):
+        return self.serial.read(n)
+
+    def readinto(self, buf):
+        return self.serial.readinto(buf)
+
+    @property
+    def timeout(self):
+        """ Read timeout in seconds, or None to block without limit. """
+        return self.serial.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.serial.timeout = value
+
+    @property
+    def in_waiting(self):
+        return self.serial.in_waiting
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def cancel_read(self):
+        self.serial.cancel_read()
+
+    def close(self):
+        self.serial.close()
+
+    def set_low_latency(self):
+        """
+        Reduce the latency of the serial port as much as possible. See
+        :func:`set_async_low_latency` and :func:`set_latency_timer`. On
+        Windows, the driver buffers are resized instead.
+        """
+        ser = self.serial
+        if hasattr(ser, 'set_buffer_size'):
+            ser.set_buffer_size(
+                rx_size=LOW_LATENCY_BUFFER_SIZE,
+                tx_size=LOW_LATENCY_BUFFER_SIZE)
+        else:
+            set_async_low_latency(ser.fileno())
+            set_latency_timer(ser.port)
+
+
+class FdTransport(Transport):
+    """
+    Byte stream over a file descriptor, using os.read and os.write directly.
+    Base class of :class:`RawSerialTransport` and :class:`SocketTransport`.
+    Only available on POSIX systems.
+
+    The descriptor is non-blocking: a read only waits with select when the
+    received data is not already available, and a pipe wakes up this wait
+    when the read is cancelled.
+
+    :ivar timeout: Read timeout in seconds, or None to block without limit.
+    """
+    def __init__(self, fd):
+        """
+        :param fd: Opened file descriptor. Ownership is transferred to the
+            transport, which closes it in :meth:`close`.
+        """
+        self.fd = fd
+        os.set_blocking(fd, False)
+        self.__cancel_r, self.__cancel_w = os.pipe()
+        os.set_blocking(self.__cancel_r, False)
+        self.__cancelled = False
+        self.timeout = None
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        """
+        Send all the given bytes.
+
+        :param data: bytes, bytearray or memoryview.
+        :return: Number of bytes written.
+        """
+        view = memoryview(data)
+        total = len(view)
+        pos = 0
+        while pos < total:
+            try:
+                pos += os.write(self.fd, view[pos:])
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+        return total
+
+    def read(self, n):
+        """
+        Receive n bytes. Blocks until all the bytes are received, the read
+        timeout expires or the read is cancelled.
+
+        :param n: Number of bytes to read.
+        :return: Received bytes.
+        """
+        buf = bytearray(n)
+        count = self.readinto(buf)
+        return bytes(buf[:count])
+
+    def readinto(self, buf):
+        """
+        Receive bytes until the buffer is filled, the read timeout expires or
+        the read is cancelled.
+
+        :param buf: Writable contiguous buffer.
+        :return: Number of bytes received.
+        """
+        view = memoryview(buf).cast('B')
+        total = len(view)
+        pos = 0
+        end = None
+        while pos < total:
+            try:
+                n = os.readv(self.fd, [view[pos:]])
+            except BlockingIOError:
+                timeout = self.timeout
+                if timeout is not None:
+                    if end is None:
+                        end = time.monotonic() + timeout
+                    timeout = max(0, end - time.monotonic())
+                if not self.__wait(timeout):
+                    break
+                continue
+            if n == 0:
+                raise EOFError('Connection closed')
+            pos += n
+        return pos
+
+    def __wait(self, timeout=None):
+        """
+        Wait until data can be read.
+
+        :param timeout: Maximum waiting time in seconds, or None.
+        :return: False if the read has been cancelled or the timeout expired.
+        """
+        r, _, _ = select.select([self.fd, self.__cancel_r], [], [], timeout)
+        if len(r) == 0:
+            return False
+        if self.__cancel_r in r:
+            os.read(self.__cancel_r, 64)
+            if self.__cancelled:
+                self.__cancelled = False
+                return False
+        return True
+
+    @property
+    def in_waiting(self):
+        """ Number of received bytes which can be read without blocking. """
+        return struct.unpack(
+            'i', fcntl.ioctl(self.fd, termios.FIONREAD, bytes(4)))[0]
+
+    def cancel_read(self):
+        """ Interrupt a blocking read from another thread. """
+        self.__cancelled = True
+        os.write(self.__cancel_w, b'\0')
+
+    def close(self):
+        os.close(self.__cancel_r)
+        os.close(self.__cancel_w)
+        os.close(self.fd)
+
+
+class RawSerialTransport(FdTransport):
+    """
+    Serial port opened and configured with termios, without pyserial. Each
+    read or write is a single system call, which reduces the latency of the
+    bus in tight loops. Only available on POSIX systems.
+    """
+    def __init__(self, dev, baudrate=2000000):
+        """
+        :param dev: Serial port device path. For instance '/dev/ttyUSB0'.
+        :param baudrate: Serial port baudrate.
+        :raises ValueError: If the baudrate is not supported by the system.
+        """
+        speed = getattr(termios, f'B{baudrate}', None)
+        if speed is None:
+            raise ValueError(f'Unsupported baudrate {baudrate}')
+        fd = os.open(dev, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            # Raw mode, 8 data bits, no parity, one stop bit, no flow control.
+            iflag, oflag, cflag, lflag, ispeed, ospeed, cc = \
+                termios.tcgetattr(fd)
+            iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK |
+                termios.ISTRIP | termios.INLCR | termios.IGNCR |
+                termios.ICRNL | termios.IXON | termios.IXOFF |
+                termios.IXANY | termios.INPCK)
+            oflag &= ~termios.OPOST
+            lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON |
+                termios.ISIG | termios.IEXTEN)
+            cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB |
+                getattr(termios, 'CRTSCTS', 0))
+            cflag |= termios.CS8 | termios.CREAD | termios.CLOCAL
+            cc[termios.VMIN] = 1
+            cc[termios.VTIME] = 0
+            termios.tcsetattr(fd, termios.TCSANOW,
+                [iflag, oflag, cflag, lflag, speed, speed, cc])
+            termios.tcflush(fd, termios.TCIOFLUSH)
+        except Exception:
+            os.close(fd)
+            raise
+        super().__init__(fd)
+        self.dev = dev
+
+    def set_low_latency(self):
+        """
+        Reduce the latency of the serial port as much as possible. See
+        :func:`set_async_low_latency` and :func:`set_latency_timer`.
+        """
+        set_async_low_latency(self.fd)
+        set_latency_timer(self.dev)
+
+
+class SocketTransport(FdTransport):
+    """
+    TCP connection to a board exposed on the network by a serial-to-network
+    bridge (ser2net, socat...). Nagle's algorithm is disabled so small
+    commands are sent immediately. Only available on POSIX systems.
+    """
+    def __init__(self, host, port):
+        """
+        :param host: Host name or address of the bridge.
+        :param port: TCP port of the bridge.
+        """
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().__init__(self.sock.fileno())
+
+    def set_low_latency(self):
+        """
+        Enlarge the socket buffers, so the responses to a large batch of
+        commands never throttle the bridge. Delayed acknowledgements are also
+        disabled when the system supports it.
+        """
+        self.sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, LOW_LATENCY_BUFFER_SIZE)
+        self.sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, LOW_LATENCY_BUFFER_SIZE)
+        if hasattr(socket, 'TCP_QUICKACK'):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+    def close(self):
+        # The socket object owns the descriptor.
+        self.sock.detach()
+        super().close()
+
+
+class UnixSocketTransport(FdTransport):
+    """
+    Connection to a local Unix socket, such as the one of a
+    :class:`scaffold.daemon.ScaffoldDaemon` sharing a board between many
+    processes. Only available on POSIX systems.
+    """
+    def __init__(self, path):
+        """
+        :param path: Socket path.
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        super().__init__(self.sock.fileno())
+
+    def close(self):
+        # The socket object owns the descriptor.
+        self.sock.detach()
+        super().close()
+
+
+def open_transport(dev, transport='serial'):
+    """
+    Open a connection to a board.
+
+    :param dev: Device path, 'host:port' string for the 'tcp' transport, socket
+        path for the 'unix' transport, or an already opened transport instance
+        which is returned as is.
+    :param transport: 'serial', 'raw', 'tcp', 'unix' or 'emulator'. The
+        'emulator' transport connects to a new in-process
+        :class:`scaffold.emulator.BoardEmulator` and ignores dev.
+    :type transport: str
+    :return: Transport instance.
+    :raises ValueError: If the transport is unknown or dev is invalid.
+    """
+    if not isinstance(dev, str):
+        return dev
+    if transport == 'serial':
+        return SerialTransport(dev)
+    elif transport == 'raw':
+        return RawSerialTransport(dev)
+    elif transport == 'emulator':
+        # In-process emulated board. dev is ignored.
+        from .emulator import EmulatorTransport
+        return EmulatorTransport()
+    elif transport == 'tcp':
+        host, sep, port = dev.rpartition(':')
+        if not sep:
+            raise ValueError('TCP transport requires a \'host:port\' string')
+        return SocketTransport(host, int(port))
+    elif transport == 'unix':
+        return UnixSocketTransport(dev)
+    else:
+        raise ValueError(f'Invalid transport \'{transport}\'')
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+#
+# This file is part of Scaffold
+#
+# Scaffold is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2019 Ledger SAS, written by Olivier Hériveaux
+
+
+# Measures the startup cost of the API: import time in a fresh interpreter,
+# and construction time of Scaffold instances. No board is required, the
+# connection is made to the emulator. Run it before and after a change to
+# track regressions; --json prints the results for automated tracking.
+
+import sys
+import json
+import argparse
+import subprocess
+from time import perf_counter
+
+
+IMPORT_SCRIPT = '''
+from time import perf_counter
+import sys
+t = perf_counter()
+import scaffold
+t = perf_counter() - t
+heavy = [m for m in ('serial', 'asyncio', 'numpy') if m in sys.modules]
+print(t, ','.join(heavy))
+'''
+
+
+def measure_import(runs):
+    """
+    :return: Minimum import time of the scaffold package in a fresh
+        interpreter, in seconds, and the list of the heavy dependencies which
+        were imported.
+    :param runs: Number of interpreters started.
+    """
+    best = None
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT], check=True,
+            capture_output=True, text=True).stdout.split()
+        t = float(out[0])
+        heavy = out[1].split(',') if len(out) > 1 else []
+        if (best is None) or (t < best):
+            best = t
+    return best, heavy
+
+
+def measure(f, runs):
+    """
+    :return: Minimum execution time of a function, in seconds.
+    :param f: Function without arguments.
+    :param runs: Number of calls.
+    """
+    best = None
+    for _ in range(runs):
+        t = perf_counter()
+        f()
+        t = perf_counter() - t
+        if (best is None) or (t < best):
+            best = t
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the import and construction time of the API.')
+    parser.add_argument('--runs', type=int, default=20,
+        help='Number of runs of each measurement. The minimum is reported.')
+    parser.add_argument('--json', action='store_true',
+        help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    import_time, heavy = measure_import(args.runs)
+    from scaffold import Scaffold
+
+    def connect():
+        s = Scaffold('emulator', transport='emulator')
+        s.bus.ser.close()
+
+    def connect_resume():
+        s = Scaffold(None)
+        s.connect('emulator', transport='emulator', reset=False)
+        s.bus.ser.close()
+
+    def access_all():
+        Scaffold(None).registers()
+
+    results = {
+        'import': import_time,
+        'construct': measure(lambda: Scaffold(None), args.runs),
+        'construct_all_modules': measure(access_all, args.runs),
+        'connect_emulator': measure(connect, args.runs),
+        'connect_emulator_no_reset': measure(connect_resume, args.runs)}
+    if args.json:
+        results['heavy_imports'] = heavy
+        print(json.dumps(results))
+        return
+    for name, t in results.items():
+        print(f'{name:28} {t * 1e3:9.3f} ms')
+    print('heavy imports:', ', '.join(heavy) if len(heavy) else 'none')
+
+
+if __name__ == '__main__':
+    main()